@@ -0,0 +1,126 @@
+import sys
+import pandas as pd
+import numpy as np
+
+sys.path.append("..")
+sys.path.append("permutation")
+from utils.params import (
+    ALPHA,
+    PERMUTATION_BLOCK_SIZE,
+    SKETCH_SIZE,
+    ABTestStats,
+    BootstrapStats,
+    ARMS,
+)
+from analytics.permutation_engine import (
+    ProgressMatrices,
+    permutation_blocks,
+    contrast_index,
+)
+from analytics.sketches import PermutationSketch
+
+
+def weighted_rates(
+    matrices: ProgressMatrices, weights: np.ndarray
+) -> np.ndarray:
+    """
+    Conversion rate of every cell and metric, with each user
+    counted as many times as their weight, for a (replicates,
+    users) array of weights.
+    """
+    numerators = (matrices.numerators.T @ weights.T).T
+    denominators = np.repeat(
+        (matrices.denominators.T @ weights.T).T,
+        matrices.n_metrics,
+        axis=1,
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return numerators / denominators
+
+
+def bootstrap_block(
+    arms: list, n: int, seed: np.random.SeedSequence
+) -> np.ndarray:
+    """
+    Difference between each arm and Control for `n`
+    replicates, shaped (replicates, cells × metrics ×
+    contrasts), from the matrices of each variant's users:
+    each user gets a Poisson(1) weight.
+    """
+    rng = np.random.default_rng(seed)
+    control, *others = (
+        weighted_rates(
+            arm,
+            rng.poisson(1.0, size=(n, arm.n_users)).astype(
+                np.float32
+            ),
+        )
+        for arm in arms
+    )
+    return np.stack(
+        [rates - control for rates in others], axis=-1
+    ).reshape(n, -1)
+
+
+def poisson_bootstrap(
+    matrices: ProgressMatrices,
+    variants: np.ndarray,
+    n_replicates: int,
+    alpha: float = ALPHA,
+    seed: int = None,
+    block_size: int = PERMUTATION_BLOCK_SIZE,
+    sketch_size: int = SKETCH_SIZE,
+    arms: tuple = ARMS,
+) -> pd.DataFrame:
+    """
+    Percentile confidence interval, at level 1 - alpha, and
+    standard error of the difference between variants, for
+    every cell and metric of per-user matrices; `variants`
+    holds the observed variant code of each user, its
+    position in `arms`. With more than two arms, rows follow
+    contrast_index.
+    Replicates run in blocks, reproducibly for a seed, and
+    only their sketch stays in memory, whatever their number.
+    """
+    difference = ABTestStats.DIFFERENCE.value
+    matrices_by_arm = [
+        ProgressMatrices(
+            index=matrices.index,
+            numerators=matrices.numerators[variants == arm],
+            denominators=matrices.denominators[
+                variants == arm
+            ],
+            n_metrics=matrices.n_metrics,
+        )
+        for arm in range(len(arms))
+    ]
+    index = contrast_index(matrices.index, arms)
+    sketch = PermutationSketch(index, sketch_size, seed=seed)
+    for n, block_seed in permutation_blocks(
+        n_replicates, matrices.block_size(block_size), seed
+    ):
+        sketch.update(
+            {
+                difference: bootstrap_block(
+                    matrices_by_arm, n, block_seed
+                )
+            },
+            quantiles=[difference],
+        )
+    return pd.DataFrame(
+        {
+            BootstrapStats.STDEV.value: sketch.std(
+                difference
+            ),
+            BootstrapStats.LOWER.value: sketch.quantile(
+                difference, alpha / 2
+            ),
+            BootstrapStats.UPPER.value: sketch.quantile(
+                difference, 1 - alpha / 2
+            ),
+            BootstrapStats.REPLICATES.value: sketch.count(
+                difference
+            ).astype(int),
+        },
+        index=index,
+    )
@@ -11,7 +11,23 @@ from utils.params import (
     PerformanceMetrics,
 )
 
-# Configuration typically stored in a system of metrics
+# Aggregates over all the events of each user, kept in the
+# user_dimensions table (see dimensions.py) as
+# column: (aggregate, expression). Aggregates must merge
+# with themselves across days: MIN, MAX, or COUNT (summed).
+USER_DIMENSIONS: dict = {
+    "user_min_country": ("MIN", COUNTRY),
+    "user_max_country": ("MAX", COUNTRY),
+    "user_min_device": ("MIN", "device_type"),
+    "user_max_device": ("MAX", "device_type"),
+    "user_events": ("COUNT", "1"),
+    "user_min_session": ("MIN", SESSION_ID),
+    "user_max_session": ("MAX", SESSION_ID),
+}
+
+# Configuration typically stored in a system of metrics.
+# Categories that only depend on the user read the
+# user_dimensions table rather than windows over events.
 CATEGORY_EXAMPLES: dict = {
     # Marketing
     "utm_source": "utm_source",
@@ -29,50 +45,26 @@ CATEGORY_EXAMPLES: dict = {
             'FI', 'SE', )
           THEN 'European Union'
         ELSE 'Rest of the World' END""",
-    "international": f"""CASE
-        WHEN MIN({COUNTRY}) OVER (
-              PARTITION BY {UNIT_ID}) !=
-           MAX({COUNTRY}) OVER (
-              PARTITION BY {UNIT_ID})
+    "international": """CASE
+        WHEN user_min_country != user_max_country
           THEN 'international'
         ELSE 'domestic' END""",
     # Interface
     # 'device_type': 'device_type',
     # 'browser_name': 'browser_name',
-    "interface": f"""CASE
-        WHEN MIN(device_type) OVER (
-            PARTITION BY {UNIT_ID}) !=
-          MAX(device_type) OVER (
-            PARTITION BY {UNIT_ID})
+    "interface": """CASE
+        WHEN user_min_device != user_max_device
           THEN 'hybrid'
         ELSE device_type END""",
-    # Local Time
-    "hour_of_day": f"""
-      EXTRACT("hour" FROM
-        CONCAT(
-          {TIME_STAMP_NAME}, ' ',
-          REPLACE(geo_timezone, '-', '_')
-        )::TIMESTAMPTZ
-      )/4*4""",
-    "day_of_week": f"""
-      EXTRACT("weekday"
-        FROM CONCAT(
-          {TIME_STAMP_NAME}, ' ',
-          REPLACE(geo_timezone, '-', '_')          
-        )::TIMESTAMPTZ
-      )""",
-    "week_of_year": f"""
-      EXTRACT("WEEK"
-        FROM {TIME_STAMP_NAME}::TIMESTAMP
-      )""",
+    # Local Time, from the columns of the event_local_time
+    # view (see refresh_local_time in dimensions.py)
+    "hour_of_day": "local_hour / 4 * 4",
+    "day_of_week": "local_weekday",
+    "week_of_year": "week_of_year",
     #  Activity
-    "activity_level": f"""CASE
-        WHEN COUNT(1) OVER (
-            PARTITION BY {UNIT_ID}
-            ) <  3 THEN 'low_activity'
-        WHEN COUNT(1) OVER (
-            PARTITION BY {UNIT_ID}
-            ) < 30 THEN 'some_activity'
+    "activity_level": """CASE
+        WHEN user_events <  3 THEN 'low_activity'
+        WHEN user_events < 30 THEN 'some_activity'
         ELSE 'high_activity' END""",
     "deliberate": f"""CASE
         WHEN COUNT(1) OVER (
@@ -82,12 +74,18 @@ CATEGORY_EXAMPLES: dict = {
             PARTITION BY {SESSION_ID}
             ) < 6 THEN 'attentive'
         ELSE 'thorough' END""",
+    # Per event: 'new' on the last event of the user
     "is_returning": f"""CASE
         WHEN LEAD({SESSION_ID}) OVER (
                 PARTITION BY {UNIT_ID}
                 ORDER BY {TIME_STAMP_NAME}
-            ) IS NULL THEN 'new'                    
+            ) IS NULL THEN 'new'
         ELSE 'returning' END""",
+    # Per user: more than one session
+    "multi_session": """CASE
+        WHEN user_min_session != user_max_session
+          THEN 'multi_session'
+        ELSE 'single_session' END""",
 }
 
 # Those parameters are typically controlled via an drop-
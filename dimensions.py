@@ -0,0 +1,435 @@
+import sys, re, logging
+from warnings import warn
+import pandas as pd
+
+sys.path.append("..")
+sys.path.append("permutation")
+from utils.db import DBConnection
+from utils.params import UNIT_ID, TIME_STAMP_NAME, TIMEZONE
+from analytics.categories import USER_DIMENSIONS
+
+# How the aggregate of each day merges across days
+MERGE: dict = {"MIN": "MIN", "MAX": "MAX", "COUNT": "SUM"}
+TABLES: tuple = (
+    "user_dimensions",
+    "user_dimension_days",
+    "user_dimension_partitions",
+)
+# Columns the event_local_time view adds to events, with
+# the function of the local timestamp that fills them
+LOCAL_TIME: dict = {
+    "local_hour": "hour",
+    "local_weekday": "dayofweek",
+    "week_of_year": "weekofyear",
+}
+
+
+def _reads(columns, definitions) -> bool:
+    "Whether any of the SQL `definitions` reads `columns`"
+    pattern = re.compile(r"\b(" + "|".join(columns) + r")\b")
+    return any(pattern.search(d) for d in definitions)
+
+
+def uses_user_dimensions(definitions) -> bool:
+    "Whether any of the SQL `definitions` reads a dimension"
+    return _reads(USER_DIMENSIONS, definitions)
+
+
+def uses_local_time(definitions) -> bool:
+    "Whether any of the SQL `definitions` reads local time"
+    return _reads(LOCAL_TIME, definitions)
+
+
+def prepare_events(conn: DBConnection, definitions):
+    """
+    Bring what the category `definitions` read, besides
+    the columns of events, up to date
+    """
+    if uses_local_time(definitions):
+        refresh_local_time(conn)
+    if uses_user_dimensions(definitions):
+        refresh_user_dimensions(conn)
+
+
+def events_source(
+    definitions, dimensions: str = "user_dimensions"
+) -> str:
+    """
+    What reports select from to compute categories with
+    `definitions`: events, or the event_local_time view of
+    them when a category reads local time, joined to the
+    `dimensions` table when a category needs it
+    """
+    source = "events"
+    if uses_local_time(definitions):
+        source = "event_local_time"
+    if uses_user_dimensions(definitions):
+        return (
+            f"{source} LEFT JOIN {dimensions} "
+            f"USING ({UNIT_ID})"
+        )
+    return source
+
+
+def _exists(conn: DBConnection, table: str) -> bool:
+    return bool(
+        conn.execute(
+            """
+            SELECT COUNT(*) FROM information_schema.tables
+            WHERE table_name = ?
+            """,
+            [table],
+        ).fetchall()[0][0]
+    )
+
+
+def available_dimensions(conn: DBConnection) -> dict:
+    "Dimensions whose column is in the events table"
+    columns = set(
+        conn.execute("SELECT * FROM events LIMIT 0")
+        .df()
+        .columns
+    )
+    return {
+        name: (aggregate, expression)
+        for name, (aggregate, expression) in (
+            USER_DIMENSIONS.items()
+        )
+        if expression == "1" or expression in columns
+    }
+
+
+def _utc_offsets(hours: pd.DataFrame) -> pd.Series:
+    """
+    Offset from UTC of the timezone (name of the group) at
+    each of its UTC `hours`
+    """
+    utc = hours["utc_hour"]
+    for name in dict.fromkeys(
+        [hours.name, hours.name.replace("-", "_")]
+    ):
+        try:
+            local = utc.dt.tz_localize("UTC").dt.tz_convert(
+                name
+            )
+        except KeyError:
+            continue
+        return local.dt.tz_localize(None) - utc
+    warn(f"Unknown timezone {hours.name}: using UTC.")
+    return utc - utc
+
+
+def refresh_local_time(conn: DBConnection) -> int:
+    """
+    Bring the event_local_time view, events with their
+    LOCAL_TIME columns, up to date, without changing the
+    events table.
+    Offsets from UTC come from local_time_offsets, a lookup
+    of each timezone at each UTC hour the events span: only
+    hours missing from it are converted, a few thousand
+    timestamps, daylight saving time included, and the view
+    shifts the timestamp of each event by its offset.
+    Events without a timezone stay in UTC.
+    Returns how many offsets were added.
+    """
+    timestamp = f"CAST(e.{TIME_STAMP_NAME} AS TIMESTAMP)"
+    timezone = f"COALESCE(e.{TIMEZONE}, 'UTC')"
+    same_hour = f"""o.timezone = {timezone}
+            AND o.utc_hour = date_trunc('hour', {timestamp})"""
+    if not _exists(conn, "local_time_offsets"):
+        conn.execute(
+            """
+            CREATE TABLE local_time_offsets (
+                timezone VARCHAR,
+                utc_hour TIMESTAMP,
+                utc_offset INTERVAL
+            )
+            """
+        )
+    hours = conn.execute(
+        f"""
+        SELECT DISTINCT {timezone} AS timezone
+            , date_trunc('hour', {timestamp}) AS utc_hour
+        FROM events AS e
+        LEFT JOIN local_time_offsets AS o
+            ON {same_hour}
+        WHERE o.timezone IS NULL
+        """
+    ).df()
+    if not hours.empty:
+        offsets = hours.assign(
+            utc_offset=hours.groupby(
+                "timezone", group_keys=False
+            ).apply(_utc_offsets)
+        )
+        conn.execute(
+            "INSERT INTO local_time_offsets "
+            "SELECT timezone, utc_hour, utc_offset "
+            "FROM offsets"
+        )
+        logging.info(
+            f"{len(offsets)} local time offsets added"
+        )
+    local = f"{timestamp} + o.utc_offset"
+    columns = "".join(
+        f"\n, {function}({local}) AS {name}"
+        for name, function in LOCAL_TIME.items()
+    )
+    conn.execute(
+        f"""
+        CREATE OR REPLACE VIEW event_local_time AS
+        SELECT e.*
+            {columns}
+        FROM events AS e
+        LEFT JOIN local_time_offsets AS o
+            ON {same_hour}
+        """
+    )
+    return len(hours)
+
+
+def reset_user_dimensions(conn: DBConnection):
+    "Drop the dimension tables, to rebuild from scratch"
+    for table in TABLES:
+        conn.execute(f"DROP TABLE IF EXISTS {table}")
+
+
+def refresh_user_dimensions(conn: DBConnection) -> int:
+    """
+    Bring user_dimensions, one row per user with the
+    aggregates of USER_DIMENSIONS over all their events, up
+    to date with the events table.
+    Aggregates are kept per user and day of events in
+    user_dimension_days; only days whose number of events
+    changed (new or late events, or removed ones) are read
+    again, and user_dimensions is merged from the days.
+    Returns how many days were read.
+    """
+    dimensions = available_dimensions(conn)
+    columns = [UNIT_ID, "day"] + list(dimensions)
+    built = all(_exists(conn, table) for table in TABLES)
+    if built:
+        days = conn.execute(
+            "SELECT * FROM user_dimension_days LIMIT 0"
+        ).df()
+        if list(days.columns) != columns:
+            logging.info(
+                "User dimensions changed: rebuilding them"
+            )
+            built = False
+    aggregates = "".join(
+        f"\n, {aggregate}({expression}) AS {name}"
+        for name, (
+            aggregate,
+            expression,
+        ) in dimensions.items()
+    )
+    per_day = f"""
+        SELECT {UNIT_ID}
+            , CAST({TIME_STAMP_NAME} AS DATE) AS day
+            {aggregates}
+        FROM events
+        WHERE CAST({TIME_STAMP_NAME} AS DATE)
+            IN (SELECT day FROM stale_days)
+        GROUP BY 1, 2
+        """
+    if not built:
+        reset_user_dimensions(conn)
+        conn.execute(
+            """
+            CREATE TABLE user_dimension_partitions
+                (day DATE, events BIGINT)
+            """
+        )
+    conn.execute(
+        f"""
+        CREATE OR REPLACE TEMP TABLE stale_days AS
+        WITH days AS (
+            SELECT CAST({TIME_STAMP_NAME} AS DATE) AS day
+                , COUNT(*) AS events
+            FROM events
+            GROUP BY 1
+        )
+        SELECT COALESCE(d.day, p.day) AS day
+            , COALESCE(d.events, 0) AS events
+        FROM days AS d
+        FULL JOIN user_dimension_partitions AS p
+            ON p.day = d.day
+        WHERE p.events IS DISTINCT FROM d.events
+        """
+    )
+    (n_days,) = conn.execute(
+        "SELECT COUNT(*) FROM stale_days"
+    ).fetchall()[0]
+    if not _exists(conn, "user_dimension_days"):
+        conn.execute(
+            f"CREATE TABLE user_dimension_days AS {per_day}"
+        )
+    elif n_days:
+        conn.execute(
+            """
+            DELETE FROM user_dimension_days
+            WHERE day IN (SELECT day FROM stale_days)
+            """
+        )
+        conn.execute(
+            f"INSERT INTO user_dimension_days {per_day}"
+        )
+    if n_days or not _exists(conn, "user_dimensions"):
+        conn.execute(
+            """
+            DELETE FROM user_dimension_partitions
+            WHERE day IN (SELECT day FROM stale_days)
+            """
+        )
+        conn.execute(
+            """
+            INSERT INTO user_dimension_partitions
+            SELECT day, events FROM stale_days
+            WHERE events > 0
+            """
+        )
+        merged = "".join(
+            f"\n, {MERGE[aggregate]}({name}) AS {name}"
+            for name, (aggregate, _) in dimensions.items()
+        )
+        conn.execute(
+            f"""
+            CREATE OR REPLACE TABLE user_dimensions AS
+            SELECT {UNIT_ID}
+                {merged}
+            FROM user_dimension_days
+            GROUP BY {UNIT_ID}
+            """
+        )
+        logging.info(
+            f"User dimensions refreshed from {n_days} "
+            f"day{'s' if n_days != 1 else ''} of events"
+        )
+    return n_days
+
+
+def freeze_user_dimensions(
+    conn: DBConnection, table: str, day
+) -> int:
+    """
+    Add to `table` the dimensions of users with events up
+    to `day` who are not in it yet, from those events only:
+    each user keeps the dimensions of the first day they
+    were counted, whatever they did after, so that a test
+    looked at day by day never reads later events, and
+    never moves a user to another cell.
+    user_dimension_days must be up to date.
+    Returns how many users were added.
+    """
+    dimensions = available_dimensions(conn)
+    merged = "".join(
+        f"\n, {MERGE[aggregate]}({name}) AS {name}"
+        for name, (aggregate, _) in dimensions.items()
+    )
+    per_user = f"""
+        SELECT {UNIT_ID}
+            {merged}
+        FROM user_dimension_days
+        WHERE day <= CAST(? AS DATE)
+        GROUP BY {UNIT_ID}
+        """
+    if not _exists(conn, table):
+        conn.execute(
+            f"CREATE TABLE {table} AS {per_user} LIMIT 0",
+            [day],
+        )
+    (n_users,) = conn.execute(
+        f"""
+        INSERT INTO {table}
+        SELECT * FROM ({per_user})
+        WHERE {UNIT_ID} NOT IN (SELECT {UNIT_ID} FROM {table})
+        """,
+        [day],
+    ).fetchall()[0]
+    return n_users
+
+
+if __name__ == "__main__":
+    # Benchmark FlexibleReport with local time categories
+    # cast from strings on every event, as they used to be,
+    # against the event_local_time view
+    from time import perf_counter
+    import duckdb
+    import numpy as np
+    from analytics.reporting import FlexibleReport
+    from analytics.categories import CATEGORY_EXAMPLES
+
+    rng = np.random.default_rng(0)
+    n_events = 1_000_000
+    users = rng.integers(0, n_events // 10, n_events)
+    events = pd.DataFrame(
+        {
+            UNIT_ID: users.astype(str),
+            "variant": np.where(
+                users % 2 == 0, "Control", "Treatment"
+            ),
+            "page_url_path": rng.choice(
+                ["/home", "/cart", "/confirmation"], n_events
+            ),
+            TIME_STAMP_NAME: (
+                pd.Timestamp("2023-03-20")
+                + pd.to_timedelta(
+                    rng.uniform(0, 21, n_events), unit="D"
+                )
+            ).astype(str),
+            TIMEZONE: rng.choice(
+                [
+                    "America/Chicago",
+                    "America/New_York",
+                    "Asia/Kolkata",
+                    "Asia/Shanghai",
+                    "Europe/Berlin",
+                    "Europe/London",
+                ],
+                n_events,
+            ),
+        }
+    )
+    conn = duckdb.connect()
+    conn.execute(
+        "CREATE TABLE events AS SELECT * FROM events"
+    )
+    per_row = {
+        "hour_of_day": f"""
+          EXTRACT("hour" FROM CONCAT(
+            {TIME_STAMP_NAME}, ' ',
+            REPLACE({TIMEZONE}, '-', '_')
+          )::TIMESTAMPTZ)/4*4""",
+        "day_of_week": f"""
+          EXTRACT("weekday" FROM CONCAT(
+            {TIME_STAMP_NAME}, ' ',
+            REPLACE({TIMEZONE}, '-', '_')
+          )::TIMESTAMPTZ)""",
+        "week_of_year": f"""
+          EXTRACT("WEEK" FROM {TIME_STAMP_NAME}::TIMESTAMP)""",
+    }
+    local = {k: CATEGORY_EXAMPLES[k] for k in per_row}
+
+    def seconds(categories: dict) -> float:
+        "Best of three runs of the report"
+        times = []
+        for _ in range(3):
+            start = perf_counter()
+            FlexibleReport(
+                conn=conn,
+                categories=categories,
+                use_cache=False,
+            ).run()
+            times.append(perf_counter() - start)
+        return min(times)
+
+    start = perf_counter()
+    refresh_local_time(conn)
+    enrichment = perf_counter() - start
+    before, after = seconds(per_row), seconds(local)
+    print(
+        f"{n_events:,} events: local time offsets in "
+        f"{enrichment:.2f}s; report {before:.2f}s before, "
+        f"{after:.2f}s after, {before / after:.1f}x faster"
+    )
@@ -1,14 +1,11 @@
 import os, logging, warnings
 from dataclasses import dataclass
+from numpy.random import default_rng
 from pandas import DataFrame, concat, read_pickle
 from pandera import (
     DataFrameSchema,
     Column,
     String,
-    Object,
-    Check,
-    check_output,
-    # check_input
 )
 import sys
 
@@ -17,7 +14,8 @@ sys.path.append("permutation")
 
 from utils.db import LocalDB, DBConnection
 from utils.params import (
-    Assignment,
+    ARMS,
+    EXTRA_ARM_KEEP,
     EVENT_PICKLE_FILE,
     USER_POOL_SIZE,
     SESSIONS_PER_DAY,
@@ -25,8 +23,12 @@ from utils.params import (
     UNIT_ID,
     VARIANT,
     STEP_NAME,
+    SESSION_ID,
+    UserFlowStep,
 )
 from utils.helper import prompt_for_duration
+from utils.validation import check_output
+from analytics.reporting import REPORT_CACHE
 from generator.control.fake_events import (
     simulate as simulate_control,
 )
@@ -34,18 +36,30 @@ from generator.treatment.fake_events import (
     simulate as simulate_treatment,
 )
 
-assignment_type = Check(
-    lambda x: x.map(lambda x: x in Assignment.list())
-)
 event_schema = DataFrameSchema(
     {
         UNIT_ID: Column(String),
-        VARIANT: Column(Object, assignment_type),
+        VARIANT: Column(String),
         STEP_NAME: Column(String),
     }
 )
 
 
+def thin_funnel(
+    events: DataFrame, keep: float, seed: int = None
+) -> DataFrame:
+    """
+    Keep the later steps of only a share `keep` of the
+    sessions: the others stop after the home page.
+    """
+    sessions = events[SESSION_ID].unique()
+    rng = default_rng(seed)
+    kept = sessions[rng.random(len(sessions)) < keep]
+    home = UserFlowStep.HOME.value
+    first = events[STEP_NAME] == f"/{home}"
+    return events[first | events[SESSION_ID].isin(kept)]
+
+
 @dataclass
 class Events:
     """
@@ -55,6 +69,8 @@ class Events:
 
     conn: DBConnection = LocalDB().conn
     has_events: bool = False
+    # Values of the variant column, Control first
+    arms: tuple = ARMS
 
     def _repr_(self) -> str:
         if self.has_events:
@@ -88,6 +104,7 @@ class Events:
             """CREATE TABLE events AS
                SELECT * FROM events_df"""
         )
+        REPORT_CACHE.events_changed(self.conn)
         self.has_events = True
         return events_df
 
@@ -101,24 +118,36 @@ class Events:
         """
         Randomly generates events using both the Control
         and the Treament configuration files.
+        Arms after Treatment replay its configuration, and
+        convert less and less: see EXTRA_ARM_KEEP.
         Merges them and stores them through the class
         database connection.
         Pickles the DataFrame to avoid having to regenerate
         it later.
         """
         _events_list = []
-        simulate = {
-            Assignment.CONTROL: simulate_control,
-            Assignment.TREATMENT: simulate_treatment,
-        }
-        for variant in Assignment:
-            _events = simulate[variant](
-                user_pool_size=int(user_pool_size / 2),
-                sessions_per_day=int(sessions_per_day / 2),
+        n_arms = len(self.arms)
+        for arm, variant in enumerate(self.arms):
+            simulate_arm = (
+                simulate_control
+                if arm == 0
+                else simulate_treatment
+            )
+            _events = simulate_arm(
+                user_pool_size=int(user_pool_size / n_arms),
+                sessions_per_day=int(
+                    sessions_per_day / n_arms
+                ),
                 duration_seconds=int(duration_seconds / 2),
             )
             _events_df = DataFrame(_events)
-            _events_df["variant"] = variant.value
+            if arm > 1:
+                _events_df = thin_funnel(
+                    _events_df,
+                    keep=EXTRA_ARM_KEEP ** (arm - 1),
+                    seed=arm,
+                )
+            _events_df["variant"] = variant
             _events_list.append(_events_df)
             print("added")
 
@@ -132,6 +161,7 @@ class Events:
             SELECT * FROM events_df
             """
         )
+        REPORT_CACHE.events_changed(self.conn)
 
         # Store events_df (unless it exists)
         # to save time when we need it again
@@ -154,6 +184,7 @@ class Events:
             SELECT * FROM events_df
             """
         )
+        REPORT_CACHE.events_changed(self.conn)
         self.has_events = True
         return events_df
 
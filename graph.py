@@ -12,15 +12,18 @@ sys.path.append("permutation")
 from utils.db import LocalDB
 from utils.params import (
     IMAGE_FOLDER,
-    PERMUTATIONS_PICKLE_FILE,
+    METRIC_NAME,
+    DURATION,
+    PLANNED_DAYS,
     ABTestSettings,
+    PowerAnalyticStats,
 )
 from analytics.statistical_test import (
     ABTestStats,
     UserFlowStep,
     PowerAnalysis,
 )
-from utils.helper import get_index
+from analytics.permutation_engine import cell_array
 
 
 @dataclass
@@ -54,31 +57,42 @@ class PowerGraph(ABTestSettings):
             setattr(self, k, v)
         self.check_consistency()
 
-        # Filter the data for a single step: “page”
-        _data_ = (
-            self.power_analysis.permutation_tests.filter(
-                like=self.page.value, axis=0
-            )
-        )
+        # Only load the data for a single step: “page”,
+        # and the appropriate breakdown
+        _data_ = self._read_cell(self.breakdown_col)
 
-        # Filter data source for the appropriate breakdown
         if self.breakdown:
-            
-            if self.breakdown_col:
-                brk, col = self.breakdown_col
-                _data_ = _data_.xs(col, level=brk)
-            else:
-                _data_ = _data_.xs(
-                    ("All",) * len(self.breakdown),
-                    level=tuple(self.breakdown),
-                )
-
             # Check that data size match the permutation number
             assert (
                 _data_.shape[0] == self.n_permutations
             ), "Wrong number of permutations"
         self.permutation_tests = _data_
 
+    def _read_cell(
+        self, breakdown_col: tuple = None
+    ) -> pd.DataFrame:
+        """
+        Read the permutation tests for the page, and for one
+        breakdown value, or overall (“All”), from the store.
+        """
+        where = {METRIC_NAME: "reach_" + self.page.value}
+        if self.breakdown:
+            where.update(
+                {brk: "All" for brk in self.breakdown}
+            )
+        if breakdown_col:
+            # Other breakdown columns are rolled up
+            brk, col = breakdown_col
+            where[brk] = col
+        return self.power_analysis.read_permutation_tests(
+            columns=[
+                ABTestStats.DIFFERENCE.value,
+                ABTestStats.MDE.value,
+                ABTestStats.P_VALUE.value,
+            ],
+            **where,
+        )
+
     @property
     def data(self):
         return self.permutation_tests[self.metric.value]
@@ -282,11 +296,8 @@ class PowerGraph(ABTestSettings):
         plt.cla()
         breakdown_col = kwargs.get("breakdown_col")
         if breakdown_col:
-            brk, col = breakdown_col
-            self.permutation_tests = (
-                self.power_analysis.permutation_tests.xs(
-                    col, level=brk
-                )
+            self.permutation_tests = self._read_cell(
+                breakdown_col
             )
         mde = self.mde
         min_x, max_x = self.min_max
@@ -372,6 +383,61 @@ class PowerGraph(ABTestSettings):
         )
         return plot
 
+    def draw_power_by_duration(
+        self,
+        durations: tuple = PLANNED_DAYS,
+        breakdown_col: tuple = None,
+    ):
+        """
+        Draw the reliably detected effect of each step
+        against the number of days the test runs, for one
+        breakdown value or overall.
+        """
+        power = self.power_analysis.power_by_duration(
+            durations
+        )
+        breakdown = [
+            name
+            for name in power.index.names
+            if name in (self.power_analysis.breakdown or [])
+        ]
+        rde, cells, metrics = cell_array(
+            power[[PowerAnalyticStats.REL_DET_EFFECT.value]],
+            breakdown,
+        )
+        # The cell of one breakdown value, or overall
+        brk, col = breakdown_col or (None, None)
+        cell = tuple(
+            col if name == brk else "All" for name in breakdown
+        )
+        rde = pd.DataFrame(
+            rde[:, cells[cell], :, 0],
+            index=pd.Index(durations, name=DURATION),
+            columns=metrics,
+        )
+        plt.cla()
+        plot = rde.plot(marker="o")
+        plot.set_xscale("log")
+        plot.set_xticks(list(durations))
+        plot.xaxis.set_major_formatter(tkr.ScalarFormatter())
+        plot.set_xlabel("Days running")
+        plot.set_ylabel("Reliably detected effect")
+        plot.yaxis.set_major_formatter(
+            tkr.PercentFormatter(1.0, decimals=1)
+        )
+        title = "Reliably detected effect by test duration"
+        file_name = "power_by_duration.png"
+        if breakdown_col:
+            title += "\n" + " ".join(breakdown_col)
+            file_name = (
+                "_".join(breakdown_col) + "_" + file_name
+            )
+        plot.set_title(title)
+        plot.figure.savefig(
+            os.path.join(self.folder, file_name)
+        )
+        return plot
+
     def draw_p_value_distribution(self):
         """Draw a histogram of the p-values.
         Expected to be uniform on [0, 1]."""
@@ -437,10 +503,8 @@ class PowerGraph(ABTestSettings):
                     f"{brk}; options are: {self.values[brk]}"
                 )
 
-        self.permutation_tests = (
-            self.power_analysis.permutation_tests.xs(
-                col, level=brk
-            )
+        self.permutation_tests = self._read_cell(
+            breakdown_col
         )
         self.draw_reliably_detected(
             breakdown_col=breakdown_col
@@ -450,11 +514,9 @@ class PowerGraph(ABTestSettings):
         self, breakdown: tuple = None
     ) -> None:
         if not self.values:
-            if self.power_analysis.permutation_tests is None:
+            if not self.power_analysis.store.exists():
                 warn("Missing permutation tests data.")
-            self.values = get_index(
-                self.power_analysis.permutation_tests.index
-            )
+            self.values = self.power_analysis.store.values()
 
         if breakdown is None:
             if self.breakdown:
@@ -468,12 +530,9 @@ class PowerGraph(ABTestSettings):
 
 
 if __name__ == "__main__":
-    # Load pickled power analysis data and draw graphs
+    # Load stored power analysis data and draw graphs
     db = LocalDB()
     power_analysis = PowerAnalysis(db.conn)
-    power_analysis.permutation_tests = pd.read_pickle(
-        PERMUTATIONS_PICKLE_FILE
-    )
     power_analysis.should_run = False
     power_graph = PowerGraph(db.conn, power_analysis)
     power_graph.load_power_analysis()
@@ -0,0 +1,333 @@
+import sys
+from functools import lru_cache
+import numpy as np
+from numpy.polynomial.hermite_e import hermegauss
+from scipy.special import stdtr, stdtrit, ndtr, ndtri
+
+sys.path.append("..")
+sys.path.append("permutation")
+from utils.params import (
+    ABTestStats,
+    SequentialStats,
+    ALPHA,
+    DUNNETT_NODES,
+    MSPRT_TAU,
+    PERMUTATION_BLOCK_SIZE,
+    T_TABLE_DOF,
+)
+
+
+@lru_cache(maxsize=None)
+def critical_values(alpha: float = ALPHA) -> np.ndarray:
+    """
+    Two-sided critical value of Student's t for each integer
+    degree of freedom up to T_TABLE_DOF (NaN for zero),
+    computed once per alpha.
+    """
+    table = stdtrit(np.arange(T_TABLE_DOF + 1), 1 - alpha / 2)
+    table.flags.writeable = False
+    return table
+
+
+def critical_value(dof: np.ndarray, alpha: float = ALPHA):
+    """
+    Critical values for integer degrees of freedom, from the
+    table; past T_TABLE_DOF, from the normal distribution
+    (relative error under 1e-5).
+    """
+    dof = np.asarray(dof)
+    value = critical_values(alpha)[
+        np.clip(dof, 0, T_TABLE_DOF)
+    ]
+    return np.where(
+        dof > T_TABLE_DOF, ndtri(1 - alpha / 2), value
+    )
+
+
+def two_sided_p_value(t_score: np.ndarray, dof: np.ndarray):
+    """
+    Two-sided tail probability of Student's t, straight from
+    the special functions rather than scipy.stats' t.sf;
+    past T_TABLE_DOF, from the normal distribution.
+    """
+    t_score, dof = np.broadcast_arrays(
+        -np.abs(t_score), np.asarray(dof)
+    )
+    p_value = np.empty(t_score.shape)
+    large = dof > T_TABLE_DOF
+    p_value[large] = 2 * ndtr(t_score[large])
+    p_value[~large] = 2 * stdtr(dof[~large], t_score[~large])
+    return p_value
+
+
+def welch_t_test(
+    numerators: np.ndarray,
+    denominators: np.ndarray,
+    alpha: float = ALPHA,
+    variance: bool = False,
+) -> dict:
+    """
+    Welch's t-test on conversion counts, for any number of
+    tables at once, e.g. shaped (permutations, cells,
+    variants).
+    The last axis holds the variants, Control first and
+    Treatment second; all leading axes are kept as they are.
+    Returns one array per ABTestStats value; the variance of
+    each variant only with `variance`.
+    """
+    numerators = np.asarray(numerators, dtype=float)
+    denominators = np.asarray(denominators, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rate = numerators / denominators
+        variances = rate * (1 - rate) / denominators
+        v0, v1 = variances[..., 0], variances[..., 1]
+        stdev = (v0 + v1) ** 0.5
+        difference = rate[..., 1] - rate[..., 0]
+        t_score = difference / stdev
+        dof = (v0 + v1) ** 2 / (
+            v0**2 / (denominators[..., 0] - 1)
+            + v1**2 / (denominators[..., 1] - 1)
+        )
+    dof = np.nan_to_num(dof, nan=0, posinf=0, neginf=0)
+    dof = dof.astype(np.int32)
+    p_value = two_sided_p_value(t_score, dof)
+    mde = stdev * critical_value(dof, alpha)
+    stats = {
+        ABTestStats.DIFFERENCE.value: difference,
+        ABTestStats.STDEV.value: stdev,
+        ABTestStats.T_SCORE.value: t_score,
+        ABTestStats.DEGREES_OF_FREEDOM.value: dof,
+        ABTestStats.P_VALUE.value: p_value,
+        # A single contrast needs no adjustment
+        ABTestStats.ADJUSTED_P_VALUE.value: p_value,
+        ABTestStats.MDE.value: mde,
+        ABTestStats.SIGNIFICANT.value: p_value < alpha,
+    }
+    if variance:
+        stats[ABTestStats.VARIANCE.value] = variances
+    return stats
+
+
+@lru_cache(maxsize=None)
+def _hermite_nodes(n: int = DUNNETT_NODES) -> tuple:
+    "Gauss–Hermite nodes and weights for a standard normal"
+    nodes, weights = hermegauss(n)
+    return nodes, weights / np.sqrt(2 * np.pi)
+
+
+def _all_within(bound: np.ndarray, loadings: np.ndarray):
+    """
+    Probability that every one of the (..., k) standard
+    normal contrasts lies within ±bound, when contrasts i and
+    j have correlation loadings[i] * loadings[j]: given a
+    common normal factor, they are independent, and the
+    factor is integrated out by Gauss–Hermite quadrature.
+    """
+    nodes, weights = _hermite_nodes()
+    spread = np.sqrt(1 - loadings**2)[..., None]
+    shift = loadings[..., None] * nodes
+    bound = np.asarray(bound)[..., None, None]
+    inside = ndtr((bound - shift) / spread) - ndtr(
+        (-bound - shift) / spread
+    )
+    return (inside.prod(axis=-2) * weights).sum(axis=-1)
+
+
+def dunnett_critical_value(
+    loadings: np.ndarray, alpha: float = ALPHA
+) -> np.ndarray:
+    """
+    Bound that all (..., k) contrasts stay within with
+    probability 1 - alpha, for every row at once: a few
+    bisection steps from the unadjusted and Bonferroni
+    bounds, then linear interpolation in the last bracket.
+    """
+    target = 1 - alpha
+    low = np.full(loadings.shape[:-1], ndtri(1 - alpha / 2))
+    high = np.full(
+        loadings.shape[:-1],
+        ndtri(1 - alpha / 2 / loadings.shape[-1]),
+    )
+    f_low = _all_within(low, loadings)
+    f_high = _all_within(high, loadings)
+    for _ in range(6):
+        middle = (low + high) / 2
+        f_middle = _all_within(middle, loadings)
+        inside = f_middle >= target
+        high = np.where(inside, middle, high)
+        f_high = np.where(inside, f_middle, f_high)
+        low = np.where(inside, low, middle)
+        f_low = np.where(inside, f_low, f_middle)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        step = (target - f_low) / (f_high - f_low)
+    return low + (high - low) * np.clip(
+        np.nan_to_num(step, nan=1), 0, 1
+    )
+
+
+def dunnett_test(
+    numerators: np.ndarray,
+    denominators: np.ndarray,
+    alpha: float = ALPHA,
+    variance: bool = False,
+) -> dict:
+    """
+    Every arm against the first one (Control), for
+    (..., arms) tables of conversions and visitors.
+    Statistics are shaped (..., arms - 1), one per contrast.
+    Besides Welch's t-test of each contrast, p-values and
+    minimum detectable effects are adjusted for comparing
+    all arms to the same control (Dunnett's test, with the
+    normal approximation): contrasts sharing the control
+    have correlation sqrt(v0 / (v0 + vi)) · sqrt(v0 / (v0 + vj)),
+    for the variances v of each arm's rate.
+    """
+    numerators = np.asarray(numerators, dtype=float)
+    denominators = np.asarray(denominators, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rate = numerators / denominators
+        variances = rate * (1 - rate) / denominators
+        v0, vi = variances[..., :1], variances[..., 1:]
+        stdev = (v0 + vi) ** 0.5
+        difference = rate[..., 1:] - rate[..., :1]
+        t_score = difference / stdev
+        dof = (v0 + vi) ** 2 / (
+            v0**2 / (denominators[..., :1] - 1)
+            + vi**2 / (denominators[..., 1:] - 1)
+        )
+        loadings = np.sqrt(v0 / (v0 + vi))
+    dof = np.nan_to_num(dof, nan=0, posinf=0, neginf=0)
+    dof = dof.astype(np.int32)
+    valid = np.isfinite(loadings).all(axis=-1, keepdims=True)
+    # Contrasts with a constant arm are kept away from
+    # perfect correlation
+    loadings = np.clip(
+        np.where(valid, loadings, 0), 0, 1 - 1e-9
+    )
+    adjusted = 1 - _all_within(
+        np.abs(t_score), loadings[..., None, :]
+    )
+    adjusted = np.where(
+        valid & np.isfinite(t_score), adjusted, np.nan
+    )
+    mde = (
+        stdev
+        * dunnett_critical_value(loadings, alpha)[..., None]
+    )
+    stats = {
+        ABTestStats.DIFFERENCE.value: difference,
+        ABTestStats.STDEV.value: stdev,
+        ABTestStats.T_SCORE.value: t_score,
+        ABTestStats.DEGREES_OF_FREEDOM.value: dof,
+        ABTestStats.P_VALUE.value: two_sided_p_value(
+            t_score, dof
+        ),
+        ABTestStats.ADJUSTED_P_VALUE.value: adjusted,
+        ABTestStats.MDE.value: np.where(valid, mde, np.nan),
+        ABTestStats.SIGNIFICANT.value: adjusted < alpha,
+    }
+    if variance:
+        stats[ABTestStats.VARIANCE.value] = variances
+    return stats
+
+
+def compare_arms(
+    numerators: np.ndarray,
+    denominators: np.ndarray,
+    alpha: float = ALPHA,
+    variance: bool = False,
+) -> dict:
+    """
+    Welch's t-test for two arms; Dunnett's test, with one
+    trailing contrast axis, for more
+    """
+    if np.shape(numerators)[-1] > 2:
+        return dunnett_test(
+            numerators, denominators, alpha, variance
+        )
+    return welch_t_test(
+        numerators, denominators, alpha, variance
+    )
+
+
+def msprt(
+    numerators: np.ndarray,
+    denominators: np.ndarray,
+    alpha: float = ALPHA,
+    tau: float = MSPRT_TAU,
+) -> dict:
+    """
+    Mixture sequential probability ratio test on
+    (..., variants) running totals, with a normal mixture of
+    standard deviation `tau` over the difference in rates.
+    Returns the difference, the p-value and the confidence
+    sequence at this look; the p-value is always valid once
+    its running minimum over looks is taken.
+    """
+    numerators = np.asarray(numerators, dtype=float)
+    denominators = np.asarray(denominators, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rate = numerators / denominators
+        variance = (rate * (1 - rate) / denominators).sum(-1)
+        difference = rate[..., 1] - rate[..., 0]
+        mixed = variance + tau**2
+        log_ratio = 0.5 * np.log(
+            variance / mixed
+        ) + difference**2 * tau**2 / (
+            2 * variance * mixed
+        )
+        radius = np.sqrt(
+            variance
+            * mixed
+            / tau**2
+            * (np.log(mixed / variance) - 2 * np.log(alpha))
+        )
+    return {
+        ABTestStats.DIFFERENCE.value: difference,
+        SequentialStats.P_VALUE.value: np.minimum(
+            1, np.exp(-log_ratio)
+        ),
+        SequentialStats.LOWER.value: difference - radius,
+        SequentialStats.UPPER.value: difference + radius,
+    }
+
+
+if __name__ == "__main__":
+    # Benchmark against scipy.stats, on one block of
+    # permutation tests with Welch degrees of freedom
+    from timeit import timeit
+    from scipy.stats import t
+
+    rng = np.random.default_rng(0)
+    shape = (PERMUTATION_BLOCK_SIZE, 300)
+    for visitors in [100, 10_000, 1_000_000]:
+        dof = rng.integers(visitors, 2 * visitors, shape)
+        t_score = rng.normal(size=shape)
+        scipy_time = timeit(
+            lambda: (
+                t.sf(np.abs(t_score), dof) * 2,
+                t.ppf(1 - ALPHA / 2, dof),
+            ),
+            number=5,
+        )
+        cache_time = timeit(
+            lambda: (
+                two_sided_p_value(t_score, dof),
+                critical_value(dof),
+            ),
+            number=5,
+        )
+        p_error = np.abs(
+            two_sided_p_value(t_score, dof)
+            - t.sf(np.abs(t_score), dof) * 2
+        ).max()
+        c_error = np.abs(
+            critical_value(dof) / t.ppf(1 - ALPHA / 2, dof)
+            - 1
+        ).max()
+        print(
+            f"~{visitors:>9,} visitors: "
+            f"{scipy_time / cache_time:5.1f}x faster, "
+            f"p-value error {p_error:.1e}, "
+            f"critical value relative error {c_error:.1e}"
+        )
@@ -16,6 +16,38 @@ from utils.db import DBConnection, LocalDB
 ALPHA: float = 0.05
 BETA: float = 0.2
 N_PERMUTATIONS: int = 10_000
+# Critical values of t are tabulated up to that many degrees
+# of freedom, normal beyond
+T_TABLE_DOF: int = 100_000
+# Permutations are drawn in blocks: one row of variant codes
+# per permutation, with at most that many cells in memory.
+PERMUTATION_BLOCK_SIZE: int = 1_000
+PERMUTATION_BLOCK_BUDGET: int = 2**24
+# Adaptive power analysis: first check, and interval level
+MIN_ADAPTIVE_PERMUTATIONS: int = 500
+ADAPTIVE_CONFIDENCE: float = 0.95
+# Items kept by the top level of each quantile sketch
+SKETCH_SIZE: int = 256
+# Poisson bootstrap of A/B test results
+BOOTSTRAP_REPLICATES: int = 2_000
+# Quadrature nodes of Dunnett's multivariate normal
+DUNNETT_NODES: int = 32
+# Sequential tests: spread of the effects the mixture of
+# the mSPRT expects, as a difference in conversion rate
+MSPRT_TAU: float = 0.01
+# Default grid of the analytic planner: differences in
+# conversion rate to detect; test durations in days, also
+# simulated by the power analysis
+PLANNED_EFFECTS: tuple = (0.005, 0.01, 0.02, 0.05)
+PLANNED_DAYS: tuple = (1, 3, 7, 14, 28)
+# Arms of a test, Control first: every other arm is
+# compared to it. Set ABTestSettings.arms, e.g. with
+# "Treatment B", for A/B/n tests
+ARMS: tuple = ("Control", "Treatment")
+# Generated events: arms after Treatment replay its
+# simulation, then each drops the later steps of a further
+# share of sessions, so every arm has its own effect
+EXTRA_ARM_KEEP: float = 0.9
 
 
 @dataclass
@@ -121,6 +153,15 @@ class ABTestSettings(DataObject):
     alpha: float = ALPHA
     beta: float = BETA
     n_permutations: int = N_PERMUTATIONS
+    # Reproducible, parallel permutations
+    seed: int = None
+    n_workers: int = 1
+    # Stop permutations once estimates are this precise
+    tolerance: float = None
+    # Schema checks; the shared policy's mode by default
+    validation: "ValidationMode" = None
+    # Values of the variant column, Control first
+    arms: tuple = ARMS
 
 
 #########################
@@ -132,7 +173,11 @@ def _storage_file_(name) -> os.path:
 
 EVENT_PICKLE_FILE = _storage_file_("events")
 AB_TEST_PICKLE_FILE = _storage_file_("ab_test")
-PERMUTATIONS_PICKLE_FILE = _storage_file_("permutations")
+PERMUTATIONS_FOLDER = os.path.join("data", "permutations")
+# Stored permutation tests, across analyses, before eviction
+PERMUTATIONS_CACHE_BYTES: int = 2 * 2**30
+# Results of reports kept in memory, across report objects
+REPORT_CACHE_BYTES: int = 512 * 2**20
 POWER_ANALYSIS_PICKLE_FILE = _storage_file_("power_analysis")
 IMAGE_FOLDER = os.path.join("docs", "img")
 
@@ -150,11 +195,16 @@ VARIANT = "variant"
 UNIT_ID = "user_domain_id"
 STEP_NAME = "page_url_path"
 TIME_STAMP_NAME = "event_timestamp"
+FIRST_EVENT = "first_event"
+# Days a test has been running, simulated or planned
+DURATION = "days"
 NUMERATOR = "conversions"
 DENOMINATOR = "visitors"
 METRIC_NAME = "conversion_rate"
+PERMUTATION_ID = "permutation"
 SESSION_ID = "click_id"
 COUNTRY = "geo_country"
+TIMEZONE = "geo_timezone"
 
 # Generate a description of the steps from the config file.
 # This section depends on the generation has to be adapted
@@ -242,6 +292,17 @@ class PerformanceMetrics(ExtendedEnum):
     # )
 
 
+# Prefixes of the columns of the detailed report that are
+# per-user averages, rather than steps reached
+AVERAGED: tuple = tuple(
+    f"{metric.value}_"
+    for metric in (
+        PerformanceMetrics.DELAY,
+        PerformanceMetrics.ABANDONMENT,
+    )
+)
+
+
 class Assignment(ExtendedEnum):
     "Possible assignment segments"
     CONTROL = "Control"
@@ -260,6 +321,8 @@ class ABTestStats(ExtendedEnum):
     T_SCORE = "t-score"
     DEGREES_OF_FREEDOM = "degrees_of_freedom"
     P_VALUE = "p-value"
+    # Multi-arm tests: adjusted for all arms against Control
+    ADJUSTED_P_VALUE = "adjusted_p-value"
     MDE = "minimum_detectable_effect"
     SIGNIFICANT = "significant"
 
@@ -272,6 +335,79 @@ class PowerAnalyticStats(ExtendedEnum):
     MEAN_MDE = "minimal_detectable_effect (mean)"
     QUANT_DIFF = "difference (beta-quantile)"
     REL_DET_EFFECT = "reliably_detected_effect"
+    N_PERMUTATIONS = "permutations"
+
+
+class BootstrapStats(ExtendedEnum):
+    """
+    Bootstrap distribution of the difference between
+    variants, column names
+    """
+
+    STDEV = "bootstrap_stdev"
+    LOWER = "ci_lower"
+    UPPER = "ci_upper"
+    REPLICATES = "replicates"
+
+
+class SequentialStats(ExtendedEnum):
+    """
+    Always-valid statistics of a sequential test,
+    column names
+    """
+
+    P_VALUE = "always_valid_p-value"
+    LOWER = "cs_lower"
+    UPPER = "cs_upper"
+    SIGNIFICANT = "significant"
+
+
+class PlannerStats(ExtendedEnum):
+    """
+    Analytic sample sizes and durations, column names
+    """
+
+    BASELINE = "baseline"
+    VISITORS = "visitors"
+    DAILY_VISITORS = "visitors_per_day"
+    SAMPLE_SIZE = "sample_size"
+    DAYS = DURATION
+    MDE = "minimum_detectable_effect"
+
+
+class PermutationMethod(ExtendedEnum):
+    """
+    How PowerAnalysis draws random splits
+    """
+
+    # Each user picks a variant at random, drawn as how
+    # many users of each profile go to each variant
+    USERS = "users"
+    # Draw how many users of each profile go to each
+    # variant, keeping the observed number in every variant
+    HYPERGEOMETRIC = "hypergeometric"
+    # Assign users with a seeded hash, inside DuckDB
+    DATABASE = "database"
+    # Shuffle the observed variants inside each breakdown
+    # cell
+    STRATIFIED = "stratified"
+
+
+class ValidationMode(ExtendedEnum):
+    """
+    How much of the dataframes pandera schemas check
+    """
+
+    FULL = "full"
+    # First call of each check, for each object
+    ONCE = "once"
+    # A random sample of rows, on every call
+    SAMPLE = "sample"
+    OFF = "off"
+
+
+VALIDATION_MODE = ValidationMode.FULL
+VALIDATION_SAMPLE_ROWS: int = 1_000
 
 
 class RunType(ExtendedEnum):
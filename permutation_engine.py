@@ -0,0 +1,1090 @@
+import sys, warnings
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import numpy as np
+from scipy.sparse import coo_matrix, csr_matrix, diags, hstack
+from scipy.stats import norm
+
+sys.path.append("..")
+sys.path.append("permutation")
+from utils.params import (
+    UNIT_ID,
+    VARIANT,
+    METRIC_NAME,
+    FIRST_EVENT,
+    DURATION,
+    ALPHA,
+    PERMUTATION_BLOCK_SIZE,
+    PERMUTATION_BLOCK_BUDGET,
+    ARMS,
+)
+from analytics.kernels import compare_arms
+
+
+@dataclass
+class CompactProgress:
+    """
+    Detailed report packed into small integer arrays, built
+    once per report: one bitmask of reached steps per row,
+    the variant and category values as codes, and a dense
+    index of users; with a first event column, the date of
+    the first event of each row, in days since the earliest;
+    and per-user averages, such as delays, as floats.
+    Permutations only ever need these arrays, not the
+    string and object columns of the report.
+    """
+
+    users: np.ndarray
+    reached: np.ndarray
+    variants: np.ndarray
+    metrics: list
+    codes: dict
+    labels: dict
+    user_ids: pd.Index = None
+    first_days: np.ndarray = None
+    # Rows × `averages`, NaN where a row has no value
+    values: np.ndarray = None
+    averages: list = None
+
+    @property
+    def n_users(self) -> int:
+        return (
+            int(self.users.max()) + 1
+            if len(self.users)
+            else 0
+        )
+
+    @property
+    def nbytes(self) -> int:
+        "Memory used by the arrays, without user labels"
+        return (
+            self.users.nbytes
+            + self.reached.nbytes
+            + self.variants.nbytes
+            + sum(c.nbytes for c in self.codes.values())
+            + getattr(self.first_days, "nbytes", 0)
+            + getattr(self.values, "nbytes", 0)
+        )
+
+    @classmethod
+    def from_user_progress(
+        cls,
+        user_progress: pd.DataFrame,
+        metrics: list,
+        averages: list = None,
+        arms: tuple = ARMS,
+    ) -> "CompactProgress":
+        """
+        Pack the detailed report: `metrics` become bits of
+        `reached`, in order, `averages` columns of `values`,
+        and every other column but the user and the variant
+        becomes a category. Variants are coded by their
+        position in `arms`.
+        """
+        if len(metrics) > 64:
+            raise ValueError(
+                f"Cannot pack {len(metrics)} metrics in 64 bits"
+            )
+        users, user_ids = pd.factorize(user_progress[UNIT_ID])
+        reached = np.zeros(
+            len(user_progress),
+            dtype=np.min_scalar_type(
+                2 ** max(len(metrics), 8) - 1
+            ),
+        )
+        for bit, metric in enumerate(metrics):
+            values = (
+                user_progress[metric]
+                .astype(float)
+                .fillna(0)
+                .to_numpy()
+            )
+            reached |= (values > 0).astype(
+                reached.dtype
+            ) << bit
+        variants = pd.Categorical(
+            user_progress[VARIANT],
+            categories=list(arms),
+        ).codes.astype(np.int8)
+        first_days = None
+        if FIRST_EVENT in user_progress:
+            first = pd.to_datetime(
+                user_progress[FIRST_EVENT]
+            ).dt.normalize()
+            first_days = (
+                (first - first.min())
+                .dt.days.fillna(0)
+                .to_numpy()
+            )
+            first_days = first_days.astype(
+                np.min_scalar_type(-int(first_days.max()) - 1)
+            )
+        averages = list(averages) if averages else []
+        values = None
+        if averages:
+            values = (
+                user_progress[averages]
+                .astype(float)
+                .to_numpy(dtype=np.float32)
+            )
+        codes, labels = {}, {}
+        for col in user_progress.columns:
+            if (
+                col
+                in [UNIT_ID, VARIANT, FIRST_EVENT]
+                + list(metrics)
+                + averages
+            ):
+                continue
+            col_codes, labels[col] = pd.factorize(
+                user_progress[col], sort=True
+            )
+            codes[col] = col_codes.astype(
+                np.min_scalar_type(-len(labels[col]) - 1)
+            )
+        return cls(
+            users=users.astype(
+                np.min_scalar_type(-len(user_ids) - 1)
+            ),
+            reached=reached,
+            variants=variants,
+            metrics=list(metrics),
+            codes=codes,
+            labels=labels,
+            user_ids=pd.Index(user_ids, name=UNIT_ID),
+            first_days=first_days,
+            values=values,
+            averages=averages,
+        )
+
+    def user_variants(self) -> np.ndarray:
+        "Variant code of each user, from their last row"
+        variants = np.zeros(self.n_users, dtype=np.int8)
+        variants[self.users] = self.variants
+        return variants
+
+    def user_strata(self, breakdown: list) -> np.ndarray:
+        """
+        Breakdown cell of each user, from their last row
+        (-1 if a value is missing); 0 for everyone without
+        a breakdown
+        """
+        strata = np.zeros(self.n_users, dtype=np.int64)
+        if breakdown:
+            cells, _ = self.cells(list(breakdown))
+            strata[self.users] = cells
+        return strata
+
+    def user_first_days(self) -> np.ndarray:
+        "Day of the first event of each user, over all rows"
+        if self.first_days is None:
+            raise ValueError(
+                f"The detailed report has no {FIRST_EVENT} "
+                f"column: run it again"
+            )
+        first = np.full(self.n_users, np.iinfo(np.int64).max)
+        np.minimum.at(first, self.users, self.first_days)
+        return first
+
+    def metric_values(self, metrics: list) -> np.ndarray:
+        "0/1 array of rows × `metrics`, unpacked from the bits"
+        bits = np.array(
+            [self.metrics.index(m) for m in metrics],
+            dtype=self.reached.dtype,
+        )
+        return ((self.reached[:, None] >> bits) & 1).astype(
+            np.int64
+        )
+
+    def cells(self, breakdown: list) -> tuple:
+        """
+        Joint breakdown cell of each row (-1 if a value is
+        missing), and the sorted labels of the cells.
+        """
+        codes = np.stack(
+            [self.codes[col] for col in breakdown], axis=1
+        ).astype(np.int64)
+        valid = (codes >= 0).all(axis=1)
+        cells = np.full(len(codes), -1)
+        combinations, cells[valid] = np.unique(
+            codes[valid], axis=0, return_inverse=True
+        )
+        labels = [
+            tuple(
+                self.labels[col][code]
+                for col, code in zip(breakdown, combination)
+            )
+            for combination in combinations
+        ]
+        return cells, labels
+
+
+def grouping_sets(breakdown: list) -> list:
+    """
+    Breakdown columns of each grouping set, besides the
+    overall one: all of them, then each on its own.
+    """
+    if len(breakdown) < 2:
+        return [list(breakdown)]
+    return [list(breakdown)] + [[col] for col in breakdown]
+
+
+def memberships(
+    compact: CompactProgress, breakdown: list
+) -> tuple:
+    """
+    Map each row of the packed detailed report to every
+    grouping set at once: its cell for all breakdown
+    columns, its value of each breakdown column on its
+    own (the others are “All”), and the overall cell.
+    Returns the rows and cells of each membership, and the
+    labels of the cells.
+    """
+    rows = np.arange(len(compact.users))
+    # Every row belongs to the overall cell (“All”),
+    # and to its own cell of each grouping set if it
+    # has a value for it.
+    if not breakdown:
+        return rows, np.zeros_like(rows), []
+    members, labels = [], []
+    for columns in grouping_sets(breakdown):
+        codes, cells = compact.cells(columns)
+        valid = codes >= 0
+        members.append(
+            (rows[valid], codes[valid] + len(labels))
+        )
+        labels += [
+            tuple(
+                dict(zip(columns, cell)).get(col, "All")
+                for col in breakdown
+            )
+            for cell in cells
+        ]
+    members.append((rows, np.full_like(rows, len(labels))))
+    labels.append(("All",) * len(breakdown))
+    return (
+        np.concatenate([m[0] for m in members]),
+        np.concatenate([m[1] for m in members]),
+        labels,
+    )
+
+
+def cell_metric_index(
+    labels: list, metrics: list, breakdown: list
+) -> pd.Index:
+    "Index of (cell, metric) pairs, metrics varying fastest"
+    if not breakdown:
+        return pd.Index(metrics, name=METRIC_NAME)
+    return pd.MultiIndex.from_tuples(
+        [
+            (*label, metric)
+            for label in labels
+            for metric in metrics
+        ],
+        names=list(breakdown) + [METRIC_NAME],
+    )
+
+
+@dataclass
+class ProgressMatrices:
+    """
+    Per-user version of the detailed report, built once
+    before running permutations.
+    Each column of `numerators` is a (cell, metric) pair of
+    the aggregated report, each column of `denominators` is
+    a cell: the overall population, or one combination of
+    breakdown values.
+    Summing the rows of users assigned to a variant gives the
+    same counts as grouping the detailed report by variant.
+    """
+
+    index: pd.Index
+    numerators: csr_matrix
+    denominators: csr_matrix
+    n_metrics: int
+    # Users behind each row, when a row stands for a profile
+    sizes: np.ndarray = None
+
+    @property
+    def n_users(self) -> int:
+        "Number of randomisation units: users, or cells"
+        return self.numerators.shape[0]
+
+    @classmethod
+    def from_user_progress(
+        cls,
+        user_progress: pd.DataFrame,
+        metrics: list,
+        breakdown: list = None,
+        arms: tuple = ARMS,
+    ) -> "ProgressMatrices":
+        return cls.from_compact(
+            CompactProgress.from_user_progress(
+                user_progress, metrics, arms=arms
+            ),
+            metrics,
+            breakdown,
+        )
+
+    @classmethod
+    def from_compact(
+        cls,
+        compact: CompactProgress,
+        metrics: list,
+        breakdown: list = None,
+    ) -> "ProgressMatrices":
+        """
+        Per-user matrices of the binary `metrics` of the
+        packed report, counted in every cell its rows belong
+        to (see memberships).
+        """
+        breakdown = list(breakdown) if breakdown else []
+        users = compact.users
+        reached = compact.metric_values(metrics)
+        member_rows, member_cells, labels = memberships(
+            compact, breakdown
+        )
+        n_cells = max(len(labels), 1)
+        n_metrics = len(metrics)
+
+        denominators = coo_matrix(
+            (
+                np.ones(len(member_rows)),
+                (users[member_rows], member_cells),
+            ),
+            shape=(compact.n_users, n_cells),
+        ).tocsr()
+        # A user counts once in a cell, however many rows
+        denominators.data[:] = 1
+
+        values = reached[member_rows].ravel()
+        numerators = coo_matrix(
+            (
+                values,
+                (
+                    np.repeat(users[member_rows], n_metrics),
+                    (
+                        member_cells[:, None] * n_metrics
+                        + np.arange(n_metrics)
+                    ).ravel(),
+                ),
+            ),
+            shape=(compact.n_users, n_cells * n_metrics),
+        ).tocsr()
+
+        return cls(
+            index=cell_metric_index(
+                labels, metrics, breakdown
+            ),
+            numerators=numerators,
+            denominators=denominators,
+            n_metrics=n_metrics,
+        )
+
+    @classmethod
+    def from_averages(
+        cls,
+        compact: CompactProgress,
+        averages: list,
+        breakdown: list = None,
+    ) -> "ProgressMatrices":
+        """
+        Per-user matrices of `averages` of the packed report,
+        such as delays: a user's numerator in a cell is the
+        mean of their values there, and only users with a
+        value count in its denominator. Each (cell, metric)
+        pair thus has its own denominator column, and
+        n_metrics is 1; the rates are means of per-user
+        means.
+        """
+        breakdown = list(breakdown) if breakdown else []
+        member_rows, member_cells, labels = memberships(
+            compact, breakdown
+        )
+        n_cells, n_metrics = max(len(labels), 1), len(
+            averages
+        )
+        values = compact.values[
+            :, [compact.averages.index(m) for m in averages]
+        ][member_rows]
+        rows, metrics = np.nonzero(~np.isnan(values))
+        coordinates = (
+            compact.users[member_rows][rows],
+            member_cells[rows] * n_metrics + metrics,
+        )
+        shape = (compact.n_users, n_cells * n_metrics)
+        sums = coo_matrix(
+            (values[rows, metrics], coordinates), shape=shape
+        ).tocsr()
+        counts = coo_matrix(
+            (np.ones(len(rows)), coordinates), shape=shape
+        ).tocsr()
+        # Same coordinates, so the same sparsity pattern
+        numerators = counts.copy()
+        numerators.data = sums.data / counts.data
+        counts.data[:] = 1
+        return cls(
+            index=cell_metric_index(
+                labels, averages, breakdown
+            ),
+            numerators=numerators,
+            denominators=counts,
+            n_metrics=1,
+        )
+
+    def by_duration(
+        self, first_days: np.ndarray, durations: list
+    ) -> "ProgressMatrices":
+        """
+        One copy of every cell for each test duration, in
+        days, keeping the users whose first event falls
+        within it: the index gains a leading DURATION level.
+        Permuting these matrices assigns each user once for
+        all durations, as one test looked at on several days.
+        """
+        numerators, denominators = [], []
+        for days in durations:
+            kept = diags((first_days < days).astype(float))
+            numerators.append(kept @ self.numerators)
+            denominators.append(kept @ self.denominators)
+        cells = self.index.to_frame(index=False)
+        index = pd.MultiIndex.from_frame(
+            pd.concat(
+                [
+                    cells.assign(**{DURATION: days})
+                    for days in durations
+                ]
+            )[[DURATION] + list(cells.columns)]
+        )
+        return ProgressMatrices(
+            index=index,
+            numerators=hstack(numerators).tocsr(),
+            denominators=hstack(denominators).tocsr(),
+            n_metrics=self.n_metrics,
+            sizes=self.sizes,
+        )
+
+    def _profiles(self) -> tuple:
+        """
+        Group users with the same breakdown values who
+        reached the same steps: they contribute exactly the
+        same to every count.
+        Returns the group of each user, and group sizes.
+        """
+        units = hstack(
+            [self.numerators, self.denominators]
+        ).toarray()
+        _, groups, sizes = np.unique(
+            units,
+            axis=0,
+            return_inverse=True,
+            return_counts=True,
+        )
+        groups = groups.ravel()
+        if self.sizes is not None:
+            # Rows already stand for several users
+            sizes = np.bincount(groups, weights=self.sizes)
+            sizes = sizes.astype(int)
+        return groups, sizes
+
+    def totals(self, matrix: csr_matrix) -> np.ndarray:
+        "Column sums over all users"
+        if self.sizes is None:
+            return np.asarray(matrix.sum(axis=0)).ravel()
+        return matrix.T @ self.sizes
+
+    def profiles(self) -> tuple:
+        """
+        One row per distinct user profile, with the number of
+        users sharing it.
+        """
+        groups, sizes = self._profiles()
+        _, first = np.unique(groups, return_index=True)
+        profiles = ProgressMatrices(
+            index=self.index,
+            numerators=self.numerators[first],
+            denominators=self.denominators[first],
+            n_metrics=self.n_metrics,
+            sizes=sizes,
+        )
+        return profiles, sizes
+
+    def block_size(
+        self, block_size: int = PERMUTATION_BLOCK_SIZE
+    ) -> int:
+        "Cap the block so the assignment matrix fits in memory"
+        cap = PERMUTATION_BLOCK_BUDGET // max(self.n_users, 1)
+        return int(max(1, min(block_size, cap)))
+
+    def aggregate(
+        self, assignments: np.ndarray, n_arms: int = 2
+    ) -> tuple:
+        """
+        Sum numerators and denominators for each variant,
+        given one row of variant codes per permutation.
+        Returns two arrays shaped
+        (permutations, cells × metrics, variants).
+        """
+        return self.split(
+            [assignments == arm for arm in range(1, n_arms)]
+        )
+
+    def split(self, shares: list) -> tuple:
+        """
+        Sum numerators and denominators for each variant,
+        given, for each variant but the first, how many of
+        each unit's users it gets in every permutation.
+        Returns two arrays shaped
+        (permutations, cells × metrics, variants).
+        """
+        n, n_arms = shares[0].shape[0], len(shares) + 1
+        numerators = np.empty(
+            (n, self.numerators.shape[1], n_arms)
+        )
+        denominators = np.empty(
+            (n, self.denominators.shape[1], n_arms)
+        )
+        for arm, share in enumerate(shares, start=1):
+            share = share.T.astype(float)
+            numerators[..., arm] = (
+                self.numerators.T @ share
+            ).T
+            denominators[..., arm] = (
+                self.denominators.T @ share
+            ).T
+        # The first variant gets whatever is left
+        numerators[..., 0] = self.totals(
+            self.numerators
+        ) - numerators[..., 1:].sum(axis=-1)
+        denominators[..., 0] = self.totals(
+            self.denominators
+        ) - denominators[..., 1:].sum(axis=-1)
+        denominators = np.repeat(
+            denominators, self.n_metrics, axis=1
+        )
+        return numerators, denominators
+
+
+def draw_assignments(
+    rng: np.random.Generator,
+    n_permutations: int,
+    n_users: int,
+    n_arms: int = 2,
+) -> np.ndarray:
+    "Uniform random variant codes, one row per permutation"
+    return rng.integers(
+        0,
+        n_arms,
+        size=(n_permutations, n_users),
+        dtype=np.int8,
+    )
+
+
+def contrast_index(
+    index: pd.Index, arms: tuple = ARMS
+) -> pd.Index:
+    """
+    Rows of the tests of an aggregated report: one per row
+    of `index` with two arms; with more, one per row and arm
+    compared to Control, the first of `arms`, in an extra
+    variant level.
+    """
+    if len(arms) <= 2:
+        return index
+    contrasts = pd.DataFrame({VARIANT: list(arms[1:])})
+    return pd.MultiIndex.from_frame(
+        index.to_frame(index=False).merge(
+            contrasts, how="cross"
+        )
+    )
+
+
+def stratify(strata: np.ndarray) -> tuple:
+    """
+    Users sorted by stratum, and the group of each sorted
+    user: groups are contiguous, between sorted offsets.
+    """
+    order = np.argsort(strata, kind="stable")
+    _, sizes = np.unique(strata[order], return_counts=True)
+    groups = np.repeat(np.arange(len(sizes)), sizes)
+    return order, groups
+
+
+def stratified_assignments(
+    rng: np.random.Generator,
+    n_permutations: int,
+    order: np.ndarray,
+    groups: np.ndarray,
+    variants: np.ndarray,
+) -> np.ndarray:
+    """
+    Observed variant codes shuffled inside each stratum,
+    one row per permutation, from the sorted users and
+    groups of stratify: a single argsort of group plus a
+    uniform key shuffles every group of every permutation
+    at once, and keeps the number of users of each variant
+    in each stratum.
+    """
+    keys = groups + rng.random((n_permutations, len(order)))
+    shuffled = np.argsort(keys, axis=1)
+    codes = np.empty(
+        (n_permutations, len(order)), dtype=variants.dtype
+    )
+    codes[:, order] = variants[order][shuffled]
+    return codes
+
+
+def cell_array(
+    frame: pd.DataFrame, breakdown: list = None
+) -> tuple:
+    """
+    Values of results indexed like the permutation tests
+    (leading levels such as days, then breakdown cells, then
+    metrics and arms) as an array shaped (leading, cells,
+    rows per cell, columns), with the position of each cell
+    and the labels of the rows of a cell: one reshape
+    instead of a cross-section per cell.
+    """
+    breakdown = list(breakdown) if breakdown else []
+    names = list(frame.index.names)
+    levels = frame.index.to_frame(index=False)
+    start = names.index((breakdown or [METRIC_NAME])[0])
+    leading = names[:start]
+    inner = names[start + len(breakdown) :]
+    n_leading = (
+        len(levels[leading].drop_duplicates())
+        if leading
+        else 1
+    )
+    block = levels.iloc[: len(levels) // n_leading]
+    cells = [()]
+    if breakdown:
+        cells = list(
+            dict.fromkeys(
+                block[breakdown].itertuples(
+                    index=False, name=None
+                )
+            )
+        )
+    rows = block[inner].iloc[: len(block) // len(cells)]
+    rows = (
+        pd.Index(rows[inner[0]])
+        if len(inner) == 1
+        else pd.MultiIndex.from_frame(rows)
+    )
+    array = frame.to_numpy().reshape(
+        n_leading, len(cells), len(rows), frame.shape[1]
+    )
+    positions = {cell: i for i, cell in enumerate(cells)}
+    return array, positions, rows
+
+
+def tests_to_frame(
+    stats: dict,
+    index: pd.Index,
+    columns: list,
+    arms: tuple = ARMS,
+) -> pd.DataFrame:
+    """
+    Flatten (permutations, rows) arrays of test statistics
+    into one frame, with the index of the aggregated report
+    repeated for each permutation; (permutations, rows,
+    contrasts) arrays of multi-arm tests get one row per
+    arm compared to Control.
+    """
+    shape = stats[columns[0]].shape
+    if len(shape) == 3:
+        index = contrast_index(index, arms)
+        stats = {
+            col: stats[col].reshape(shape[0], -1)
+            for col in columns
+        }
+    n_permutations, n_rows = stats[columns[0]].shape
+    positions = np.tile(np.arange(n_rows), n_permutations)
+    return pd.DataFrame(
+        {col: stats[col].ravel() for col in columns},
+        index=index.take(positions),
+    )
+
+
+def permutation_blocks(
+    n_permutations: int, block_size: int, seed: int = None
+) -> list:
+    """
+    Split the permutations into blocks, each with its own
+    random stream derived from the master seed.
+    Streams follow blocks rather than workers, so results
+    do not depend on how many workers ran.
+    """
+    sizes = [
+        min(block_size, n_permutations - start)
+        for start in range(0, n_permutations, block_size)
+    ]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    return list(zip(sizes, seeds))
+
+
+def run_block(
+    matrices: ProgressMatrices,
+    n: int,
+    seed: np.random.SeedSequence,
+    alpha: float = ALPHA,
+    columns: list = None,
+    draw=None,
+    arms: tuple = ARMS,
+) -> pd.DataFrame:
+    "t-test results for one block of `n` permutations"
+    rng = np.random.default_rng(seed)
+    n_arms = len(arms)
+    if draw is None:
+        numerators, denominators = matrices.aggregate(
+            draw_assignments(
+                rng, n, matrices.n_users, n_arms
+            ),
+            n_arms,
+        )
+    else:
+        numerators, denominators = matrices.split(
+            draw(rng, n)
+        )
+    stats = compare_arms(numerators, denominators, alpha)
+    return tests_to_frame(
+        stats, matrices.index, columns or list(stats), arms
+    )
+
+
+# Each worker process receives the matrices once
+_worker_matrices: ProgressMatrices = None
+
+
+def _init_worker(matrices: ProgressMatrices):
+    global _worker_matrices
+    _worker_matrices = matrices
+
+
+def _run_worker_block(*args, **kwargs) -> pd.DataFrame:
+    return run_block(_worker_matrices, *args, **kwargs)
+
+
+def run_permutations(
+    matrices: ProgressMatrices,
+    n_permutations: int,
+    alpha: float = ALPHA,
+    columns: list = None,
+    seed: int = None,
+    block_size: int = PERMUTATION_BLOCK_SIZE,
+    progress=None,
+    draw=None,
+    n_workers: int = 1,
+    only: list = None,
+    arms: tuple = ARMS,
+):
+    """
+    Draw random assignments block by block and yield one
+    frame of t-test results per block, in block order.
+    `draw(rng, n)` can replace the uniform assignment of
+    units: it returns the shares of each unit that go to
+    each variant but the first, as in ProgressMatrices.split.
+    With several workers, blocks run in a process pool and
+    `draw` must be picklable.
+    `only` lists the blocks to run, to complete a run whose
+    other blocks are already known. Users are drawn between
+    `arms`, Control first.
+    """
+    blocks = permutation_blocks(
+        n_permutations, matrices.block_size(block_size), seed
+    )
+    if only is not None:
+        blocks = [blocks[block] for block in only]
+    kwargs = {
+        "alpha": alpha,
+        "columns": columns,
+        "draw": draw,
+        "arms": arms,
+    }
+    if n_workers is None or n_workers <= 1:
+        for n, block_seed in blocks:
+            result = run_block(
+                matrices, n, block_seed, **kwargs
+            )
+            if progress is not None:
+                progress.update(n)
+            yield result
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        initializer=_init_worker,
+        initargs=(matrices,),
+    ) as executor:
+        futures = []
+        for n, block_seed in blocks:
+            future = executor.submit(
+                _run_worker_block, n, block_seed, **kwargs
+            )
+            if progress is not None:
+                future.add_done_callback(
+                    lambda _, n=n: progress.update(n)
+                )
+            futures.append(future)
+        try:
+            for future in futures:
+                yield future.result()
+        finally:
+            # Stopping early should not run the blocks left
+            for future in futures:
+                future.cancel()
+
+
+def mean_interval(
+    samples: np.ndarray, confidence: float = 0.95
+) -> tuple:
+    """
+    Mean of each column of (permutations, rows) samples,
+    and the half-width of its confidence interval.
+    """
+    n = np.sum(~np.isnan(samples), axis=0)
+    z = norm.ppf(0.5 + confidence / 2)
+    with warnings.catch_warnings():
+        # Cells without any test stay NaN
+        warnings.simplefilter("ignore", RuntimeWarning)
+        mean = np.nanmean(samples, axis=0)
+        half_width = (
+            z * np.nanstd(samples, axis=0, ddof=1) / n**0.5
+        )
+    return mean, half_width
+
+
+def quantile_interval(
+    samples: np.ndarray, q: float, confidence: float = 0.95
+) -> tuple:
+    """
+    `q`-quantile of each column of (permutations, rows)
+    samples, and the half-width of its distribution-free
+    confidence interval: the order statistics whose ranks
+    bracket n·q by z·√(n·q·(1-q)).
+    """
+    z = norm.ppf(0.5 + confidence / 2)
+    ordered = np.sort(samples, axis=0)  # NaN sort last
+    n = np.sum(~np.isnan(samples), axis=0)
+    spread = z * (n * q * (1 - q)) ** 0.5
+    last = np.maximum(n - 1, 0)
+    lower = np.clip(np.floor(n * q - spread), 0, last)
+    upper = np.clip(np.ceil(n * q + spread), 0, last)
+    columns = np.arange(samples.shape[1])
+    with np.errstate(invalid="ignore"):
+        half_width = (
+            ordered[upper.astype(int), columns]
+            - ordered[lower.astype(int), columns]
+        ) / 2
+    with warnings.catch_warnings():
+        # Cells without any test stay NaN
+        warnings.simplefilter("ignore", RuntimeWarning)
+        quantile = np.nanquantile(samples, q, axis=0)
+    return quantile, half_width
+
+
+def _quote(column: str) -> str:
+    return f'"{column}"'
+
+
+def database_index(
+    conn,
+    metrics: list,
+    breakdown: list = None,
+    table: str = "user_progress",
+) -> pd.Index:
+    """
+    Rows of the permutation tests run in the database, in
+    the same order as ProgressMatrices.index.
+    """
+    breakdown = list(breakdown) if breakdown else []
+    if not breakdown:
+        return pd.Index(metrics, name=METRIC_NAME)
+    cells = []
+    for columns in grouping_sets(breakdown):
+        cells += [
+            tuple(
+                dict(zip(columns, cell)).get(col, "All")
+                for col in breakdown
+            )
+            for cell in conn.execute(
+                f"""
+                SELECT DISTINCT {', '.join(map(_quote, columns))}
+                FROM {table}
+                WHERE {' AND '.join(
+                    f'{_quote(col)} IS NOT NULL'
+                    for col in columns
+                )}
+                ORDER BY ALL
+                """
+            ).fetchall()
+        ]
+    return pd.MultiIndex.from_tuples(
+        [
+            (*cell, metric)
+            for cell in cells + [("All",) * len(breakdown)]
+            for metric in metrics
+        ],
+        names=breakdown + [METRIC_NAME],
+    )
+
+
+def database_user_cells(
+    conn,
+    metrics: list,
+    breakdown: list = None,
+    table: str = "user_progress",
+) -> str:
+    """
+    Sum each user's rows once per cell of every grouping set
+    and once overall, with GROUPING SETS, in a temporary
+    table: every permutation then only needs to hash and
+    count its rows.
+    Returns the name of the table.
+    """
+    breakdown = list(breakdown) if breakdown else []
+    cells = ", ".join(map(_quote, [UNIT_ID] + breakdown))
+    sets = f"({_quote(UNIT_ID)})"
+    overall = "1"
+    having = ""
+    if breakdown:
+        sets = (
+            ", ".join(
+                f"({', '.join(map(_quote, [UNIT_ID] + columns))})"
+                for columns in grouping_sets(breakdown)
+            )
+            + f", {sets}"
+        )
+        overall = "CAST({} AS INTEGER)".format(
+            " AND ".join(
+                f"GROUPING({_quote(col)}) = 1"
+                for col in breakdown
+            )
+        )
+        # Rows without a value only count in the sets that
+        # leave their column out
+        having = "HAVING " + " AND ".join(
+            f"NOT (GROUPING({_quote(col)}) = 0 "
+            f"AND {_quote(col)} IS NULL)"
+            for col in breakdown
+        )
+    conn.execute(
+        f"""
+        CREATE OR REPLACE TEMP TABLE user_cells AS
+        SELECT {cells}
+            , {overall} AS overall
+            , {', '.join(
+                f'SUM({_quote(m)}::INT) AS {_quote(m)}'
+                for m in metrics
+            )}
+        FROM {table}
+        GROUP BY GROUPING SETS ({sets})
+        {having}
+        """
+    )
+    return "user_cells"
+
+
+def database_counts(
+    conn,
+    index: pd.Index,
+    metrics: list,
+    start: int,
+    n: int,
+    seed: int,
+    breakdown: list = None,
+    n_arms: int = 2,
+    table: str = "user_cells",
+) -> tuple:
+    """
+    Numerators and denominators of each arm for
+    permutations `start` to `start + n`, aggregated by
+    DuckDB from the table of database_user_cells: every
+    user is crossed with each permutation id, and sent to
+    an arm by the high bits of a seeded hash of
+    (permutation, user). Only the counts per permutation,
+    variant and cell leave the database.
+    Returns two arrays shaped (permutations, rows of
+    `index`, arms), like ProgressMatrices.aggregate.
+    """
+    breakdown = list(breakdown) if breakdown else []
+    n_metrics = len(metrics)
+    counts = conn.execute(
+        f"""
+        SELECT p.range - ? AS permutation
+            , (hash(p.range, {_quote(UNIT_ID)}, ?) >> 32)
+                % {n_arms} AS arm
+            , {''.join(f'{_quote(col)}, ' for col in breakdown)}
+            overall
+            , COUNT(*) AS visitors
+            , {', '.join(
+                f'SUM({_quote(m)}) AS {_quote(m)}'
+                for m in metrics
+            )}
+        FROM {table}
+        CROSS JOIN range(?, ?) p
+        GROUP BY ALL
+        """,
+        [start, seed, start, start + n],
+    ).df()
+
+    if breakdown:
+        # Columns rolled up by a grouping set are “All”
+        counts[breakdown] = (
+            counts[breakdown].astype(object).fillna("All")
+        )
+        cells = pd.MultiIndex.from_tuples(
+            [row[:-1] for row in index[::n_metrics]]
+        )
+        positions = cells.get_indexer(
+            pd.MultiIndex.from_frame(counts[breakdown])
+        )
+    else:
+        positions = np.zeros(len(counts), dtype=int)
+    permutations = counts["permutation"].to_numpy(int)
+    arms = counts["arm"].to_numpy(int)
+    numerators = np.zeros((n, len(index), n_arms))
+    denominators = np.zeros((n, len(index), n_arms))
+    for m, metric in enumerate(metrics):
+        rows = positions * n_metrics + m
+        numerators[permutations, rows, arms] = counts[metric]
+        denominators[permutations, rows, arms] = counts[
+            "visitors"
+        ]
+    return numerators, denominators
+
+
+def database_block(
+    conn,
+    index: pd.Index,
+    metrics: list,
+    start: int,
+    n: int,
+    seed: int,
+    breakdown: list = None,
+    alpha: float = ALPHA,
+    columns: list = None,
+    arms: tuple = ARMS,
+    table: str = "user_cells",
+) -> pd.DataFrame:
+    """
+    t-test results for permutations `start` to `start + n`,
+    from the counts of database_counts, between `arms`.
+    """
+    numerators, denominators = database_counts(
+        conn,
+        index,
+        metrics,
+        start,
+        n,
+        seed,
+        breakdown=breakdown,
+        n_arms=len(arms),
+        table=table,
+    )
+    stats = compare_arms(numerators, denominators, alpha)
+    return tests_to_frame(
+        stats, index, columns or list(stats), arms
+    )
@@ -0,0 +1,329 @@
+import sys, logging
+from dataclasses import dataclass
+from itertools import product
+import pandas as pd
+import numpy as np
+from scipy.special import ndtri
+from pandera import DataFrameSchema, Column
+
+sys.path.append("..")
+sys.path.append("permutation")
+from utils.db import DBConnection
+from utils.params import (
+    NUMERATOR,
+    DENOMINATOR,
+    TIME_STAMP_NAME,
+    ALPHA,
+    BETA,
+    PLANNED_EFFECTS,
+    PLANNED_DAYS,
+    ABTestStats,
+    ABTestSettings,
+    PlannerStats,
+    PowerAnalyticStats,
+)
+from analytics.statistical_test import ABTest, PowerAnalysis
+from utils.validation import check_output
+
+sample_size_schema = DataFrameSchema(
+    {
+        PlannerStats.BASELINE.value: Column(float),
+        PlannerStats.DAILY_VISITORS.value: Column(float),
+        PlannerStats.SAMPLE_SIZE.value: Column(float),
+        PlannerStats.DAYS.value: Column(float),
+    }
+)
+mde_schema = DataFrameSchema(
+    {
+        PlannerStats.BASELINE.value: Column(float),
+        PlannerStats.VISITORS.value: Column(float),
+        PlannerStats.MDE.value: Column(float),
+    }
+)
+
+
+def _z(alpha, beta) -> np.ndarray:
+    "Two-sided critical value plus the power quantile"
+    return ndtri(1 - np.asarray(alpha) / 2) + ndtri(
+        1 - np.asarray(beta)
+    )
+
+
+def minimum_detectable_effect(
+    baseline,
+    visitors,
+    alpha=ALPHA,
+    beta=BETA,
+    share: float = 0.5,
+) -> np.ndarray:
+    """
+    Smallest difference in conversion rate that a test with
+    `visitors` in total, `share` of them in Treatment,
+    detects with power 1 - beta at level alpha.
+    Normal approximation, with the baseline variance in both
+    variants, as under the permutations; arguments broadcast.
+    """
+    variance = baseline * (1 - baseline) / share / (1 - share)
+    with np.errstate(divide="ignore"):
+        return _z(alpha, beta) * np.sqrt(variance / visitors)
+
+
+def sample_size(
+    baseline,
+    effect,
+    alpha=ALPHA,
+    beta=BETA,
+    share: float = 0.5,
+) -> np.ndarray:
+    """
+    Visitors, in total, for `effect` to be the minimum
+    detectable effect: the inverse of
+    minimum_detectable_effect.
+    """
+    variance = baseline * (1 - baseline) / share / (1 - share)
+    return np.ceil(
+        variance * (_z(alpha, beta) / np.asarray(effect)) ** 2
+    )
+
+
+def _grid(index: pd.Index, axes: dict) -> pd.MultiIndex:
+    """
+    Every row of `index` with every combination of `axes`,
+    in the order of arrays shaped (rows, *axes)
+    """
+    cells = index.to_frame(index=False)
+    combinations = pd.DataFrame(
+        list(product(*axes.values())), columns=list(axes)
+    )
+    return pd.MultiIndex.from_frame(
+        cells.merge(combinations, how="cross")
+    )
+
+
+@dataclass
+class SampleSizePlanner(ABTestSettings):
+    """
+    Analytic power analysis, for planning a test before it
+    runs: how many visitors, and how many days, to detect a
+    difference in conversion rate, or what difference a
+    test of a given length can detect.
+    Baselines come from the conversion_rate table, for each
+    step and breakdown cell, pooling both variants; traffic
+    per day divides the visitors of each cell by the number
+    of days of events (`days`), which overstates it a little
+    when visitors come back on several days.
+    Every grid is one array operation. `calibrate` checks
+    the results against the reliably detected effects of a
+    permutation-based PowerAnalysis.
+    """
+
+    conn: DBConnection = None
+    ab_test: ABTest = None
+    # Days of traffic behind the conversion_rate table
+    days: float = None
+    # Share of visitors assigned to Treatment
+    share: float = 0.5
+    baselines: pd.DataFrame = None
+
+    def observed_days(self) -> float:
+        if self.days is None:
+            self.days = self.conn.execute(
+                f"""
+                SELECT COUNT(DISTINCT
+                    CAST({TIME_STAMP_NAME} AS DATE))
+                FROM events
+                """
+            ).fetchone()[0]
+        return self.days
+
+    def load_baselines(self) -> pd.DataFrame:
+        """
+        Conversion rate, visitors and visitors per day for
+        each breakdown cell and step
+        """
+        if self.ab_test is None:
+            self.ab_test = ABTest(
+                conn=self.conn,
+                categories=self.categories,
+                filters=self.filters,
+                breakdown=self.breakdown,
+                steps=self.steps,
+                validation=self.validation,
+            )
+        c = self.ab_test.format_conversion_rate()
+        conversions = c[NUMERATOR].sum(axis=1)
+        visitors = c[DENOMINATOR].sum(axis=1)
+        self.baselines = pd.DataFrame(
+            {
+                PlannerStats.BASELINE.value: (
+                    conversions / visitors
+                ),
+                PlannerStats.VISITORS.value: visitors.astype(
+                    float
+                ),
+                PlannerStats.DAILY_VISITORS.value: (
+                    visitors / self.observed_days()
+                ),
+            }
+        )
+        return self.baselines
+
+    @check_output(sample_size_schema)
+    def sample_sizes(
+        self,
+        alphas: tuple = (ALPHA,),
+        betas: tuple = (BETA,),
+        effects: tuple = PLANNED_EFFECTS,
+    ) -> pd.DataFrame:
+        """
+        Visitors and days needed to detect each difference
+        in conversion rate, in each cell, for each alpha and
+        beta.
+        """
+        if self.baselines is None:
+            self.load_baselines()
+        baseline = self.baselines[
+            PlannerStats.BASELINE.value
+        ].to_numpy()[:, None, None, None]
+        daily = self.baselines[
+            PlannerStats.DAILY_VISITORS.value
+        ].to_numpy()[:, None, None, None]
+        visitors = sample_size(
+            baseline,
+            np.asarray(effects)[None, None, None, :],
+            np.asarray(alphas)[None, :, None, None],
+            np.asarray(betas)[None, None, :, None],
+            self.share,
+        )
+        visitors, baseline, daily = np.broadcast_arrays(
+            visitors, baseline, daily
+        )
+        with np.errstate(divide="ignore"):
+            days = np.ceil(visitors / daily)
+        return pd.DataFrame(
+            {
+                PlannerStats.BASELINE.value: baseline.ravel(),
+                PlannerStats.DAILY_VISITORS.value: daily.ravel(),
+                PlannerStats.SAMPLE_SIZE.value: visitors.ravel(),
+                PlannerStats.DAYS.value: days.ravel(),
+            },
+            index=_grid(
+                self.baselines.index,
+                {
+                    "alpha": alphas,
+                    "beta": betas,
+                    "effect": effects,
+                },
+            ),
+        )
+
+    @check_output(mde_schema)
+    def minimum_detectable_effects(
+        self,
+        alphas: tuple = (ALPHA,),
+        betas: tuple = (BETA,),
+        days: tuple = PLANNED_DAYS,
+    ) -> pd.DataFrame:
+        """
+        Difference in conversion rate each cell can detect
+        after each number of days, for each alpha and beta.
+        """
+        if self.baselines is None:
+            self.load_baselines()
+        baseline = self.baselines[
+            PlannerStats.BASELINE.value
+        ].to_numpy()[:, None, None, None]
+        visitors = (
+            self.baselines[
+                PlannerStats.DAILY_VISITORS.value
+            ].to_numpy()[:, None, None, None]
+            * np.asarray(days)[None, None, None, :]
+        )
+        mde = minimum_detectable_effect(
+            baseline,
+            visitors,
+            np.asarray(alphas)[None, :, None, None],
+            np.asarray(betas)[None, None, :, None],
+            self.share,
+        )
+        mde, baseline, visitors = np.broadcast_arrays(
+            mde, baseline, visitors
+        )
+        return pd.DataFrame(
+            {
+                PlannerStats.BASELINE.value: baseline.ravel(),
+                PlannerStats.VISITORS.value: visitors.ravel(),
+                PlannerStats.MDE.value: mde.ravel(),
+            },
+            index=_grid(
+                self.baselines.index,
+                {
+                    "alpha": alphas,
+                    "beta": betas,
+                    "days": days,
+                },
+            ),
+        )
+
+    def calibrate(
+        self, power_analysis: PowerAnalysis
+    ) -> pd.DataFrame:
+        """
+        Compare the analytic minimum detectable effect with
+        the reliably detected effect of each metric and
+        breakdown cell of a power analysis, for the same
+        users, alpha and beta: the ratio should be close
+        to one. The power analysis must have run.
+        """
+        power_analysis.load_user_progress()
+        if power_analysis.user_progress is None:
+            # Permutations ran in the database
+            power_analysis.user_progress = self.conn.execute(
+                "SELECT * FROM user_progress"
+            ).df()
+        matrices = power_analysis.progress_matrices(
+            per_user=True
+        )
+        visitors = np.repeat(
+            matrices.totals(matrices.denominators),
+            matrices.n_metrics,
+        )
+        baseline = (
+            matrices.totals(matrices.numerators) / visitors
+        )
+        power = power_analysis.power_by_cell(
+            power_analysis.read_permutation_tests(
+                columns=[
+                    ABTestStats.MDE.value,
+                    ABTestStats.DIFFERENCE.value,
+                ]
+            )
+        )
+        rde = PowerAnalyticStats.REL_DET_EFFECT.value
+        calibration = pd.DataFrame(
+            {
+                PlannerStats.BASELINE.value: baseline,
+                PlannerStats.VISITORS.value: visitors,
+                PlannerStats.MDE.value: (
+                    minimum_detectable_effect(
+                        baseline,
+                        visitors,
+                        power_analysis.alpha,
+                        power_analysis.beta,
+                    )
+                ),
+            },
+            index=matrices.index,
+        ).join(power[[rde]])
+        calibration["ratio"] = (
+            calibration[PlannerStats.MDE.value]
+            / calibration[rde]
+        )
+        logging.info(
+            f"Analytic over permutation-based detectable "
+            f"effects: median "
+            f"{calibration['ratio'].median():.3f}, from "
+            f"{calibration['ratio'].min():.3f} to "
+            f"{calibration['ratio'].max():.3f}"
+        )
+        return calibration
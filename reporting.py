@@ -1,4 +1,7 @@
-import sys
+import sys, re, hashlib, weakref, itertools
+from warnings import warn
+from collections import OrderedDict
+import duckdb
 import pandas as pd
 import logging
 from pandera import (
@@ -20,14 +23,26 @@ from utils.params import (
     STEPS_URL_LABEL,
     VARIANT,
     TIME_STAMP_NAME,
+    FIRST_EVENT,
     NUMERATOR,
     DENOMINATOR,
     METRIC_NAME,
-    Assignment,
+    REPORT_CACHE_BYTES,
     UserFlowStep,
     DataObject,
 )
 from metrics import METRICS_DEFINITIONS
+from analytics.dimensions import (
+    events_source,
+    prepare_events,
+    uses_user_dimensions,
+)
+
+# Tables created by a report query
+CREATE_TABLE = re.compile(
+    r"CREATE\s+(?:OR\s+REPLACE\s+)?TABLE\s+(\w+)",
+    re.IGNORECASE,
+)
 
 # Data structure classes for dataframe type checking
 ConversionRate = Column(
@@ -51,25 +66,17 @@ conversion_rate_raw_schema = DataFrameSchema(
         DENOMINATOR: Column(int),
     }
 )
+# One column per arm, whatever the arms of the test
 pivoted_cr_schema = DataFrameSchema(
     {
-        (NUMERATOR, Assignment.CONTROL.value): Column(
-            Int32, nullable=True
-        ),
-        (NUMERATOR, Assignment.TREATMENT.value): Column(
-            Int32, nullable=True
-        ),
-        (DENOMINATOR, Assignment.CONTROL.value): Column(
-            Int32, nullable=True
-        ),
-        (DENOMINATOR, Assignment.TREATMENT.value): Column(
-            Int32, nullable=True
-        ),
-        (METRIC_NAME, Assignment.CONTROL.value): Column(
-            float, nullable=True
-        ),
-        (METRIC_NAME, Assignment.TREATMENT.value): Column(
-            float, nullable=True
+        **{
+            (total, ".+"): Column(
+                Int32, nullable=True, regex=True
+            )
+            for total in [NUMERATOR, DENOMINATOR]
+        },
+        (METRIC_NAME, ".+"): Column(
+            float, nullable=True, regex=True
         ),
     }
 )
@@ -77,31 +84,275 @@ user_progress_schema = DataFrameSchema(
     {
         UNIT_ID: Column(str),
         VARIANT: Column(str),
+        # Older reports lack it
+        FIRST_EVENT: Column(required=False, nullable=True),
         **{"reach_"+k: Column(bool)
            for k in UserFlowStep.list()},
     },
 )
 
 
+def date_window(start_date=None, end_date=None) -> tuple:
+    """
+    Condition on the event time, with both dates bound as
+    parameters; empty without both dates.
+    Returns the SQL and its values.
+    """
+    if not (start_date and end_date):
+        return "", []
+    assert pd.Timestamp(start_date) < pd.Timestamp(
+        end_date
+    ), "Start date must be before end date"
+    return (
+        f"{TIME_STAMP_NAME} BETWEEN CAST(? AS TIMESTAMP)"
+        " AND CAST(? AS TIMESTAMP)",
+        [str(start_date), str(end_date)],
+    )
+
+
+def filter_conditions(filters: dict = None) -> tuple:
+    """
+    One condition per filtered column, the accepted values
+    bound as a list: the SQL only changes with the columns.
+    Returns the conditions and their values.
+    """
+    conditions, values = [], []
+    for col, accepted in (filters or {}).items():
+        if isinstance(accepted, (str, int, float)):
+            accepted = [accepted]
+        conditions.append(f"list_contains(?, {col})")
+        values.append(list(accepted))
+    return conditions, values
+
+
+def where_clause(conditions: list) -> str:
+    if not conditions:
+        return ""
+    return "WHERE " + "\n                AND ".join(conditions)
+
+
+def _nbytes(frames: list) -> int:
+    return int(
+        sum(df.memory_usage(deep=True).sum() for df in frames)
+    )
+
+
+# Tokens of the connections seen by ReportCache
+_CONNECTIONS = itertools.count()
+
+
+class ReportCache:
+    """
+    Results of reports, shared by every report object, keyed
+    by a hash of the formatted query and a version stamp of
+    the events table: the same query on the same events is
+    only run once, e.g. by both the server and ABTest.
+    An entry keeps the data frame the query returned, and
+    the tables it created, to restore them if another query
+    replaced them since. The least recently used entries
+    are evicted past `max_bytes`.
+    """
+
+    def __init__(self, max_bytes: int = REPORT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        # Key of the entry each table was last written by
+        self.owners = {}
+        # Token and write count of each connection, dropped
+        # with the connection
+        self.versions = weakref.WeakKeyDictionary()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def nbytes(self) -> int:
+        return sum(
+            entry["nbytes"] for entry in self.entries.values()
+        )
+
+    def _version(self, conn) -> tuple:
+        """
+        Token of the connection, never reused by another
+        one unlike id(), and how many times its events were
+        written through `events_changed`
+        """
+        if conn not in self.versions:
+            self.versions[conn] = [next(_CONNECTIONS), 0]
+        return tuple(self.versions[conn])
+
+    def events_changed(self, conn):
+        """
+        Writers of events call this: results read from the
+        events of `conn` before are stale, whatever their
+        number of rows and last timestamp
+        """
+        self._version(conn)
+        self.versions[conn][1] += 1
+
+    def key(self, conn, statements: list) -> str:
+        """
+        Hash of the (query, arguments) statements and the
+        version of the events table: the connection, how
+        many times writers changed it, its number of rows
+        and last timestamp; None without an events table
+        """
+        try:
+            stamp = conn.execute(
+                f"""
+                SELECT COUNT(*), MAX({TIME_STAMP_NAME})
+                FROM events
+                """
+            ).fetchall()
+        except duckdb.CatalogException:
+            return None
+        return hashlib.sha256(
+            repr(
+                (self._version(conn), stamp, statements)
+            ).encode()
+        ).hexdigest()
+
+    def get(self, conn, key: str) -> pd.DataFrame:
+        "Cached result, with its tables restored; or None"
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        entry = self.entries[key]
+        for table, df in entry["tables"].items():
+            if self.owners.get(table) != key:
+                conn.execute(
+                    f"CREATE OR REPLACE TABLE {table} AS "
+                    "SELECT * FROM df"
+                )
+                self.owners[table] = key
+        # Callers may modify their frame
+        return entry["df"].copy()
+
+    def put(self, key: str, df: pd.DataFrame, tables: dict):
+        nbytes = _nbytes([df, *tables.values()])
+        for table in tables:
+            self.owners[table] = key
+        if nbytes > self.max_bytes:
+            return
+        self.entries[key] = {
+            "df": df.copy(),
+            "tables": tables,
+            "nbytes": nbytes,
+        }
+        while self.nbytes > self.max_bytes:
+            evicted, _ = self.entries.popitem(last=False)
+            logging.info(
+                f"Report cache: evicted {evicted[:8]}"
+            )
+
+    def release(self, table: str):
+        "A table was written outside the cache"
+        self.owners.pop(table, None)
+
+    def clear(self):
+        self.entries.clear()
+        self.owners.clear()
+
+
+REPORT_CACHE = ReportCache()
+
+
 # Abstract base class for reports
 @dataclass
 class Report(DataObject):
-    """Base class for reports."""
+    """
+    Base class for reports.
+    `parameters` fill the structure of the query (columns,
+    grouping sets); `arguments` are bound to its `?`
+    placeholders, in order, so that changing a filter or a
+    date keeps the same SQL.
+    A report of several statements lists them instead, each
+    with its own arguments, in `statements`: the last one
+    gives the result.
+    Runs go through REPORT_CACHE, unless `use_cache` is
+    off: the tables a query creates are found with
+    CREATE_TABLE.
+    """
 
     title: str = "Report"
     query: str = None
     parameters: dict = None
+    arguments: list = None
+    # (query, arguments) pairs, run in order
+    statements: list = None
     df: pd.DataFrame = None
+    use_cache: bool = True
+
+    def formatted_statements(self) -> list:
+        "(query, arguments) pairs, with `parameters` filled"
+        statements = self.statements or [
+            (self.query, self.arguments)
+        ]
+        return [
+            (
+                query
+                if self.parameters is None
+                else query.format(**self.parameters),
+                list(arguments or []),
+            )
+            for query, arguments in statements
+        ]
+
+    def execute(self, statements: list) -> pd.DataFrame:
+        "Run each statement with its arguments, in order"
+        for query, arguments in statements:
+            result = self.conn.execute(query, arguments)
+        return result.df()
 
     def run(self) -> pd.DataFrame:
-        if self.parameters is None:
-            query = self.query
-        else:
-            query = self.query.format(**self.parameters)
+        statements = self.formatted_statements()
+        queries = [query for query, _ in statements]
+        prepare_events(self.conn, queries)
+        key = None
+        if self.use_cache:
+            key = REPORT_CACHE.key(self.conn, statements)
+        if key is not None:
+            df = REPORT_CACHE.get(self.conn, key)
+            if df is not None:
+                logging.info(
+                    f"{self.title} from cache "
+                    f"({REPORT_CACHE.hits} hits, "
+                    f"{REPORT_CACHE.misses} misses)"
+                )
+                self.df = df
+                self.has_ran: bool = True
+                return self.df
         logging.info(f"Running {self.title}…")
-        self.df = self.conn.execute(query).df()
+        self.df = self.execute(statements)
         self.has_ran: bool = True
-        logging.info(f"{self.title} done")
+        tables = list(
+            dict.fromkeys(
+                table
+                for query in queries
+                for table in CREATE_TABLE.findall(query)
+            )
+        )
+        if key is not None:
+            REPORT_CACHE.put(
+                key,
+                self.df,
+                {
+                    table: self.conn.execute(
+                        f"SELECT * FROM {table}"
+                    ).df()
+                    for table in tables
+                },
+            )
+            logging.info(
+                f"{self.title} done, cached "
+                f"({REPORT_CACHE.hits} hits, "
+                f"{REPORT_CACHE.misses} misses)"
+            )
+        else:
+            for table in tables:
+                REPORT_CACHE.release(table)
+            logging.info(f"{self.title} done")
         return self.df
 
 
@@ -152,14 +403,26 @@ class RoughReport(Report):
         super().__init__(self.conn, self.query, self.title)
 
 
+# Layout of conversion_rate_partitions: tables built for
+# another version are rebuilt
+PARTITIONS_VERSION = 2
+
+
 class FlexibleReport(Report):
     """
     Overall A/B test report.
     Single query but with flexible columns.
     When running categorical A/B-teststs,
     this report can introduce flexible distinction.
+    With `incremental`, `run` refreshes the table from the
+    days of events that are new or changed since the last
+    run, instead of the whole history: see `refresh`. It
+    runs in full when categories cannot be computed a day
+    at a time: see `refreshable`.
     """
 
+    incremental: bool = False
+
     def __init__(self, **kwargs):
         self.update_self_with_param(kwargs)
 
@@ -171,7 +434,7 @@ class FlexibleReport(Report):
             SELECT {metrics_label}
                 , {categories_with_definition}
                 , {unit_id}
-            FROM events
+            FROM {events}
             {time_window}
         ),
         filtered AS (
@@ -217,17 +480,13 @@ class FlexibleReport(Report):
             ON {category_join}
         )
         """
-        time_window = ""
-        if self.start_date and self.end_date:
-            assert pd.Timestamp(
-                self.start_date
-            ) < pd.Timestamp(
-                self.end_date
-            ), "Start date must be before end date"
-
-            time_window = f"""WHERE {TIME_STAMP_NAME}
-                BETWEEN '{self.start_date}'
-                    AND '{self.end_date}'"""
+        window, self.window_values = date_window(
+            self.start_date, self.end_date
+        )
+        time_window = where_clause([window] if window else [])
+        filters, self.filter_values = filter_conditions(
+            self.filters
+        )
         _v = {VARIANT: VARIANT}
         detail = (
             {**_v, **self.categories}
@@ -255,6 +514,13 @@ class FlexibleReport(Report):
         group_set_w_step = format_group_set(
             [STEP_NAME, VARIANT]
         )
+        # Same grouping sets, per user, for refresh
+        self.columns = list(detail.keys())
+        self.time_window = time_window
+        self.user_group_sets = ", ".join(
+            format_group_set([UNIT_ID, VARIANT])
+            + format_group_set([UNIT_ID, STEP_NAME, VARIANT])
+        )
         self.parameters = {
             "unit_id": UNIT_ID,
             "metrics_label": STEP_NAME,
@@ -281,28 +547,380 @@ class FlexibleReport(Report):
                     for col in detail.keys()
                 ]
             ),
+            "events": events_source(detail.values()),
             "time_window": time_window,
-            "filters": (
-                "WHERE "
-                + """"
-                AND """.join(
-                    [
-                        f"{k} IN {v}"
-                        for k, v in self.filters.items()
-                    ]
-                )
-            )
-            #
-            if self.filters else "",
+            "filters": where_clause(filters),
         }
+        self.arguments = self.window_values + self.filter_values
         
         kwargs.update({
             "query":self.query,
             "title":self.title,
             "parameters":self.parameters,
+            "arguments":self.arguments,
         })
         super().__init__(**Report.filter_args(kwargs))
 
+    def run(self) -> pd.DataFrame:
+        if self.incremental:
+            if self.refreshable:
+                return self.refresh()
+            warn(
+                f"{self.title}: categories depend on more "
+                f"than a day of events, running it in full."
+            )
+        return super().run()
+
+    @property
+    def refreshable(self) -> bool:
+        """
+        Whether the category of an event only depends on the
+        events of its day: not for categories that read user
+        dimensions, over all the events of a user, nor for
+        window functions, whose value changes when events
+        of other days arrive
+        """
+        definitions = [
+            self.parameters["categories_with_definition"]
+        ]
+        return not (
+            uses_user_dimensions(definitions)
+            or re.search(
+                r"\bOVER\s*\(", definitions[0], re.IGNORECASE
+            )
+        )
+
+    def _fingerprint(self) -> str:
+        "Configuration the incremental tables were built for"
+        return hashlib.sha256(
+            repr(
+                (
+                    PARTITIONS_VERSION,
+                    sorted(self.parameters.items()),
+                    self.arguments,
+                )
+            ).encode()
+        ).hexdigest()
+
+    def reset(self):
+        "Drop the incremental tables, to rebuild from scratch"
+        for table in [
+            "conversion_rate_users",
+            "conversion_rate_counts",
+            "conversion_rate_partitions",
+        ]:
+            self.conn.execute(f"DROP TABLE IF EXISTS {table}")
+
+    def stale_partitions(self) -> list:
+        """
+        Days of events to process, each with the high-water
+        mark of its events processed so far: the last
+        `event_timestamp` read, None to read the whole day.
+        Only events past the last mark of all are read,
+        plus a count of the events, to catch late events:
+        then every day whose number of events changed is
+        read again in full.
+        """
+        window = self.time_window or "WHERE TRUE"
+        marks = dict(
+            self.conn.execute(
+                """
+                SELECT day, processed_until
+                FROM conversion_rate_partitions
+                """
+            ).fetchall()
+        )
+        last = max(marks.values(), default=None)
+        new = self.conn.execute(
+            f"""
+            SELECT CAST({TIME_STAMP_NAME} AS DATE) AS day
+                , COUNT(*) AS events
+            FROM events
+            {window}
+                AND CAST({TIME_STAMP_NAME} AS TIMESTAMP)
+                    > COALESCE(
+                        CAST(? AS TIMESTAMP), '-infinity'
+                    )
+            GROUP BY 1
+            ORDER BY 1
+            """,
+            self.window_values + [last],
+        ).fetchall()
+        (seen,) = self.conn.execute(
+            """
+            SELECT COALESCE(SUM(events), 0)
+            FROM conversion_rate_partitions
+            """
+        ).fetchone()
+        (total,) = self.conn.execute(
+            f"SELECT COUNT(*) FROM events {window}",
+            self.window_values,
+        ).fetchone()
+        if total == seen + sum(n for _, n in new):
+            return [(day, marks.get(day)) for day, _ in new]
+        logging.info(
+            "Late events before the high-water mark: "
+            "counting the events of every day"
+        )
+        return [
+            (day, None)
+            for (day,) in self.conn.execute(
+                f"""
+                WITH days AS (
+                    SELECT CAST({TIME_STAMP_NAME} AS DATE)
+                            AS day
+                        , COUNT(*) AS events
+                    FROM events
+                    {window}
+                    GROUP BY 1
+                )
+                SELECT d.day
+                FROM days AS d
+                LEFT JOIN conversion_rate_partitions AS p
+                    ON p.day = d.day
+                WHERE p.events IS DISTINCT FROM d.events
+                ORDER BY 1
+                """,
+                self.window_values,
+            ).fetchall()
+        ]
+
+    def _add_partition(self, day, since=None):
+        """
+        Merge the users of one day of events, past its
+        high-water mark `since`, into the distinct users of
+        every cell: only users new to a cell add to its
+        count, so a day can be processed again when late
+        events arrive.
+        """
+        p = self.parameters
+        cells = [STEP_NAME] + self.columns
+        window = self.time_window or "WHERE TRUE"
+        # Events of the day past its high-water mark
+        day_events = f"""
+            AND {TIME_STAMP_NAME} >= CAST(? AS DATE)
+            AND {TIME_STAMP_NAME}
+                < CAST(? AS DATE) + INTERVAL 1 DAY
+            AND CAST({TIME_STAMP_NAME} AS TIMESTAMP)
+                > COALESCE(CAST(? AS TIMESTAMP), '-infinity')
+        """
+        self.conn.execute(
+            f"""
+            CREATE OR REPLACE TEMP TABLE day_users AS
+            WITH augmented AS (
+                SELECT {STEP_NAME}
+                    , {p["categories_with_definition"]}
+                    , {UNIT_ID}
+                FROM {p["events"]}
+                {window}
+                {day_events}
+            ),
+            filtered AS (
+                SELECT *
+                FROM augmented
+                {p["filters"]}
+            )
+            SELECT GROUPING({', '.join(cells)}) AS grouping_id
+                , {', '.join(cells)}
+                , {UNIT_ID}
+            FROM filtered
+            GROUP BY GROUPING SETS ({self.user_group_sets})
+            """,
+            self.window_values
+            + [day, day, since]
+            + self.filter_values,
+        )
+        same_cell = " AND ".join(
+            f"u.{col} IS NOT DISTINCT FROM d.{col}"
+            for col in ["grouping_id", UNIT_ID] + cells
+        )
+        # Only the users of these events are looked up
+        self.conn.execute(
+            f"""
+            CREATE OR REPLACE TEMP TABLE new_users AS
+            WITH seen AS (
+                SELECT * FROM conversion_rate_users
+                WHERE {UNIT_ID} IN (
+                    SELECT {UNIT_ID} FROM day_users
+                )
+            )
+            SELECT d.* FROM day_users AS d
+            WHERE NOT EXISTS (
+                SELECT 1 FROM seen AS u
+                WHERE {same_cell}
+            )
+            """
+        )
+        self.conn.execute(
+            "INSERT INTO conversion_rate_users "
+            "SELECT * FROM new_users"
+        )
+        keys = ", ".join(["grouping_id"] + cells)
+        self.conn.execute(
+            f"""
+            CREATE OR REPLACE TABLE conversion_rate_counts AS
+            SELECT {keys}, SUM(users) AS users
+            FROM (
+                SELECT * FROM conversion_rate_counts
+                UNION ALL
+                SELECT {keys}, COUNT(*) AS users
+                FROM new_users
+                GROUP BY {keys}
+            )
+            GROUP BY {keys}
+            """
+        )
+        # Events counted so far, and the new high-water mark
+        (counted,) = self.conn.execute(
+            """
+            SELECT COALESCE(SUM(events), 0)
+            FROM conversion_rate_partitions
+            WHERE day = ? AND ? IS NOT NULL
+            """,
+            [day, since],
+        ).fetchone()
+        self.conn.execute(
+            "DELETE FROM conversion_rate_partitions "
+            "WHERE day = ?",
+            [day],
+        )
+        self.conn.execute(
+            f"""
+            INSERT INTO conversion_rate_partitions
+            SELECT CAST(? AS DATE), COUNT(*) + ?
+                , COALESCE(
+                    MAX(CAST({TIME_STAMP_NAME} AS TIMESTAMP)),
+                    CAST(? AS TIMESTAMP)
+                )
+                , ?
+            FROM events
+            {window}
+            {day_events}
+            """,
+            [day, counted, since, self._fingerprint()]
+            + self.window_values
+            + [day, day, since],
+        )
+
+    def refresh(self) -> pd.DataFrame:
+        """
+        Incremental version of `run`: per-day, per-user
+        partial aggregates, for the same grouping sets, are
+        kept in conversion_rate_users, and distinct users
+        per cell in conversion_rate_counts. Only days of
+        events that are new, or got late events, are read
+        again, and conversion_rate is rebuilt from the
+        counts: a refresh takes time in proportion to the
+        new events and the number of cells.
+        Each day keeps the high-water mark of the events
+        processed, the last `event_timestamp` read: a
+        refresh only reads events past it.
+        Events removed from a day processed before are not
+        taken back; `reset` to start over. A change of
+        configuration starts over by itself.
+        Categories must be `refreshable`.
+        """
+        if not self.refreshable:
+            raise ValueError(
+                f"{self.title} cannot be refreshed: its "
+                f"categories depend on more than a day of "
+                f"events. Run it in full."
+            )
+        logging.info(f"Refreshing {self.title}…")
+        prepare_events(self.conn, self.parameters.values())
+        cells = [STEP_NAME] + self.columns
+        exists = not self.conn.execute(
+            """
+            SELECT * FROM information_schema.tables
+            WHERE table_name = 'conversion_rate_partitions'
+            """
+        ).df().empty
+        if exists:
+            built_for = self.conn.execute(
+                "SELECT DISTINCT config "
+                "FROM conversion_rate_partitions"
+            ).fetchall()
+            if built_for and built_for != [
+                (self._fingerprint(),)
+            ]:
+                logging.info(
+                    "Report configuration changed: "
+                    "rebuilding conversion_rate"
+                )
+                self.reset()
+                exists = False
+        if not exists:
+            self.conn.execute(
+                """
+                CREATE TABLE conversion_rate_partitions (
+                    day DATE,
+                    events BIGINT,
+                    processed_until TIMESTAMP,
+                    config VARCHAR
+                )
+                """
+            )
+            self.conn.execute(
+                f"""
+                CREATE TABLE conversion_rate_users AS
+                SELECT 0 AS grouping_id
+                    , {', '.join(cells)}
+                    , {UNIT_ID}
+                FROM (
+                    SELECT {STEP_NAME}
+                        , {self.parameters[
+                            "categories_with_definition"
+                        ]}
+                        , {UNIT_ID}
+                    FROM {self.parameters["events"]}
+                )
+                LIMIT 0
+                """
+            )
+            self.conn.execute(
+                f"""
+                CREATE TABLE conversion_rate_counts AS
+                SELECT grouping_id, {', '.join(cells)}
+                    , COUNT(*) AS users
+                FROM conversion_rate_users
+                GROUP BY ALL
+                """
+            )
+        days = self.stale_partitions()
+        for day, since in days:
+            self._add_partition(day, since)
+        # Visitors are the cells without a step
+        step_bit = 2 ** len(self.columns)
+        same_cell = " AND ".join(
+            f"v.{col} IS NOT DISTINCT FROM c.{col}"
+            for col in self.columns
+        )
+        self.conn.execute(
+            f"""
+            CREATE OR REPLACE TABLE conversion_rate AS
+            SELECT {', '.join('v.' + c for c in self.columns)}
+                , v.users AS {DENOMINATOR}
+                , c.{STEP_NAME}
+                , c.users AS {NUMERATOR}
+                , c.users * 1.0 / v.users AS {METRIC_NAME}
+            FROM conversion_rate_counts AS v
+            JOIN conversion_rate_counts AS c
+                ON v.grouping_id = c.grouping_id + {step_bit}
+                AND {same_cell}
+            """
+        )
+        REPORT_CACHE.release("conversion_rate")
+        self.df = self.conn.execute(
+            "SELECT * FROM conversion_rate"
+        ).df()
+        self.has_ran = True
+        logging.info(
+            f"{self.title} refreshed from {len(days)} "
+            f"day{'s' if len(days) != 1 else ''} of events"
+        )
+        return self.df
+
+
 class DetailedReport(Report):
     """
     Detailed report that uses multiple queries to:
@@ -315,7 +933,7 @@ class DetailedReport(Report):
         self.update_self_with_param(kwargs)
 
         self.title = "Detailed report"
-        self.query = """
+        user_progress = """
         CREATE OR REPLACE TABLE user_progress AS (
             WITH
             user_with_categories AS (
@@ -324,7 +942,7 @@ class DetailedReport(Report):
                     , {time_stamp_name}
                     , {columns_with_definition}                
                     , {step_name}
-                FROM events
+                FROM {events}
                 {when}
             ),
             filtered AS (
@@ -335,63 +953,42 @@ class DetailedReport(Report):
             )
             SELECT {unit_id}
                 , {columns}
+                , MIN({time_stamp_name}) AS {first_event}
                 , {score}
             FROM filtered
             GROUP BY {unit_id}
                 , {columns}
-        );
+        )
+        """
+        conversion_rate_progress = """
         CREATE OR REPLACE TABLE conversion_rate_progress AS (
             SELECT {columns}
                 , COUNT({unit_id}) AS visitors
                 , {aggregate}
             FROM user_progress
             GROUP BY {columns}
-        );
-        SELECT * FROM user_progress;
+        )
         """
 
-        when = ""
-        if self.start_date and self.end_date:
-            assert pd.Timestamp(
-                self.start_date
-            ) < pd.Timestamp(
-                self.end_date
-            ), "Start date must be before end date"
-            when += (
-                "WHERE "
-                + f"""{TIME_STAMP_NAME}
-                BETWEEN '{self.start_date}'
-                    AND '{self.end_date}'"""
-            )
-
-        conditions = []
-        if self.filters:
-            conditions += [
-                """
-              AND """.join(
-                    [
-                        f"{k} IN {v}"
-                        for k, v in self.filters.items()
-                    ]
-                )
-            ]
-        if self.steps:
-            step_w_slsh = tuple(
-                f"/{step}" for step in self.steps
-            )
-            conditions += [f"{STEP_NAME} IN {step_w_slsh}"]
+        window, window_values = date_window(
+            self.start_date, self.end_date
+        )
+        when = where_clause([window] if window else [])
 
-        where = (
-            "WHERE "
-            + (
-                """
-              AND """.join(
-                    conditions
-                )
-            )
-            if conditions
-            else ""
+        conditions, condition_values = filter_conditions(
+            self.filters
         )
+        if self.steps:
+            conditions += [f"list_contains(?, {STEP_NAME})"]
+            condition_values += [
+                sorted(f"/{step}" for step in self.steps)
+            ]
+        where = where_clause(conditions)
+        self.statements = [
+            (user_progress, window_values + condition_values),
+            (conversion_rate_progress, []),
+            ("SELECT * FROM user_progress", []),
+        ]
 
         _v = {VARIANT: VARIANT}
         detail = _v
@@ -412,6 +1009,7 @@ class DetailedReport(Report):
             "unit_id": UNIT_ID,
             "session_id": SESSION_ID,
             "time_stamp_name": TIME_STAMP_NAME,
+            "first_event": FIRST_EVENT,
             "columns": ", ".join(detail.keys()),
             "columns_with_definition": ", ".join(
                 f"{v} AS {k}" for k, v in detail.items()
@@ -436,6 +1034,7 @@ class DetailedReport(Report):
                     for k in self.steps_label.keys()
                 )
             ),
+            "events": events_source(detail.values()),
             "when": when,
             "where": where,
         }
@@ -446,9 +1045,9 @@ class DetailedReport(Report):
             }
 
         kwargs.update({
-            "query":self.query,
             "title":self.title,
             "parameters":self.parameters,
+            "statements":self.statements,
         })
         super().__init__(**Report.filter_args(kwargs))
 
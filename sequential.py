@@ -0,0 +1,390 @@
+import sys, logging
+from warnings import warn
+from dataclasses import dataclass
+import pandas as pd
+import numpy as np
+
+sys.path.append("..")
+sys.path.append("permutation")
+from utils.db import DBConnection
+from utils.params import (
+    UNIT_ID,
+    VARIANT,
+    STEP_NAME,
+    TIME_STAMP_NAME,
+    METRIC_NAME,
+    STEPS_URL_LABEL,
+    MSPRT_TAU,
+    ABTestSettings,
+    SequentialStats,
+    UserFlowStep,
+)
+from analytics.kernels import msprt
+from analytics.dimensions import (
+    events_source,
+    prepare_events,
+    uses_user_dimensions,
+    freeze_user_dimensions,
+)
+from analytics.reporting import (
+    filter_conditions,
+    where_clause,
+)
+
+
+@dataclass
+class SequentialTest(ABTestSettings):
+    """
+    A/B test that can be looked at every day: a mixture
+    sequential probability ratio test (mSPRT), whose
+    p-values and confidence sequences stay valid however
+    often they are read.
+    Each update only reads one day of events. The database
+    keeps, for each user and breakdown cell (overall is
+    “All”), the steps they reached so far (sequential_users),
+    and
+    running totals of users and conversions per variant
+    and cell (sequential_totals): a day of events only adds
+    its new users and newly reached steps to the totals.
+    Categories that read user dimensions get the dimensions
+    of each user as of the first day they were counted
+    (sequential_dimensions): a look never reads later
+    events, and users stay in their cell.
+    Results of every look are appended to
+    sequential_results, with the running minimum of the
+    p-value.
+    """
+
+    conn: DBConnection = None
+    # Spread of the mixture over differences in rate
+    tau: float = MSPRT_TAU
+    results: pd.DataFrame = None
+
+    @property
+    def _breakdown(self) -> list:
+        return (
+            sorted(self.breakdown) if self.breakdown else []
+        )
+
+    @property
+    def _steps(self) -> list:
+        return [
+            step
+            for step in UserFlowStep.list()
+            if not self.steps or step in self.steps
+        ]
+
+    @property
+    def _keys(self) -> list:
+        return [UNIT_ID, VARIANT] + self._breakdown
+
+    def _exists(self, table: str) -> bool:
+        tables = self.conn.execute(
+            """
+            SELECT * FROM information_schema.tables
+            WHERE table_name = ?
+            """,
+            [table],
+        ).df()
+        return not tables.empty
+
+    def processed_days(self) -> list:
+        "Days already added to the running totals"
+        if not self._exists("sequential_days"):
+            return []
+        return [
+            day
+            for (day,) in self.conn.execute(
+                "SELECT day FROM sequential_days ORDER BY day"
+            ).fetchall()
+        ]
+
+    def reset(self):
+        "Drop the running totals, to start the test over"
+        for table in [
+            "sequential_users",
+            "sequential_totals",
+            "sequential_days",
+            "sequential_results",
+            "sequential_dimensions",
+        ]:
+            self.conn.execute(f"DROP TABLE IF EXISTS {table}")
+
+    def _day_cells(self, day):
+        """
+        Steps each user reached on `day`, overall and in
+        their breakdown cell
+        """
+        columns = set(self._breakdown) | set(
+            (self.filters or {}).keys()
+        )
+        definitions = [
+            self.categories[col] for col in columns
+        ]
+        prepare_events(self.conn, definitions)
+        if uses_user_dimensions(definitions):
+            freeze_user_dimensions(
+                self.conn, "sequential_dimensions", day
+            )
+        categories = "".join(
+            f"\n, {self.categories[col]} AS {col}"
+            for col in columns
+        )
+        conditions, filter_values = filter_conditions(
+            self.filters
+        )
+        reached = "".join(
+            f"\n, BOOL_OR({STEP_NAME} = "
+            f"{STEPS_URL_LABEL[step]}) AS reach_{step}"
+            for step in self._steps
+        )
+        labels = "".join(
+            f"""
+            , CASE WHEN GROUPING({col}) = 1 THEN 'All'
+                ELSE CAST({col} AS VARCHAR) END AS {col}"""
+            for col in self._breakdown
+        )
+        cell = ", ".join(self._keys)
+        complete = " AND ".join(
+            f"{col} IS NOT NULL" for col in self._breakdown
+        )
+        group_by = f"GROUP BY {cell}"
+        if self._breakdown:
+            group_by = f"""
+            GROUP BY GROUPING SETS (
+                ({cell}), ({UNIT_ID}, {VARIANT})
+            )
+            HAVING GROUPING({self._breakdown[0]}) = 1
+                OR ({complete})"""
+        self.conn.execute(
+            f"""
+            CREATE OR REPLACE TEMP TABLE day_cells AS
+            WITH day AS (
+                SELECT {UNIT_ID}
+                    , {VARIANT}
+                    , {STEP_NAME}
+                    {categories}
+                FROM {events_source(
+                    definitions, "sequential_dimensions"
+                )}
+                WHERE {TIME_STAMP_NAME} >= CAST(? AS DATE)
+                    AND {TIME_STAMP_NAME}
+                        < CAST(? AS DATE) + INTERVAL 1 DAY
+            )
+            SELECT {UNIT_ID}
+                , {VARIANT}
+                {labels}
+                {reached}
+            FROM day
+            {where_clause(conditions)}
+            {group_by}
+            """,
+            [day, day] + filter_values,
+        )
+
+    def update(self, day) -> pd.DataFrame:
+        """
+        Add one day of events to the running totals, and
+        publish the always-valid results so far
+        """
+        day = pd.Timestamp(day).date()
+        if day in self.processed_days():
+            warn(f"Events of {day} are already counted.")
+            return self.results
+        self._day_cells(day)
+        keys = self._keys
+        cells = [VARIANT] + self._breakdown
+        steps = [f"reach_{step}" for step in self._steps]
+        if not self._exists("sequential_users"):
+            self.conn.execute(
+                """
+                CREATE TABLE sequential_users AS
+                SELECT * FROM day_cells LIMIT 0
+                """
+            )
+        join = " AND ".join(f"d.{k} = u.{k}" for k in keys)
+        # Only users new to a cell, and steps newly reached,
+        # add to the totals
+        gains = "".join(
+            f"\n, SUM(CAST(d.{s} AND NOT COALESCE(u.{s}, FALSE)"
+            f" AS INTEGER)) AS {s}"
+            for s in steps
+        )
+        day_totals = f"""
+            SELECT {', '.join('d.' + c for c in cells)}
+                , SUM(CAST(u.{UNIT_ID} IS NULL AS INTEGER))
+                    AS visitors
+                {gains}
+            FROM day_cells AS d
+            LEFT JOIN sequential_users AS u ON {join}
+            GROUP BY {', '.join('d.' + c for c in cells)}
+            """
+        if self._exists("sequential_totals"):
+            sums = "".join(
+                f", SUM({s}) AS {s}" for s in steps
+            )
+            self.conn.execute(
+                f"""
+                CREATE OR REPLACE TABLE sequential_totals AS
+                SELECT {', '.join(cells)}
+                    , SUM(visitors) AS visitors
+                    {sums}
+                FROM (
+                    SELECT * FROM sequential_totals
+                    UNION ALL
+                    {day_totals}
+                )
+                GROUP BY {', '.join(cells)}
+                """
+            )
+        else:
+            self.conn.execute(
+                f"""
+                CREATE TABLE sequential_totals AS
+                {day_totals}
+                """
+            )
+        reached = ", ".join(
+            f"{s} = u.{s} OR d.{s}" for s in steps
+        )
+        self.conn.execute(
+            f"""
+            UPDATE sequential_users AS u
+            SET {reached}
+            FROM day_cells AS d
+            WHERE {join}
+            """
+        )
+        self.conn.execute(
+            f"""
+            INSERT INTO sequential_users
+            SELECT d.* FROM day_cells AS d
+            WHERE NOT EXISTS (
+                SELECT 1 FROM sequential_users AS u
+                WHERE {join}
+            )
+            """
+        )
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS sequential_days
+                (day DATE)
+            """
+        )
+        self.conn.execute(
+            "INSERT INTO sequential_days VALUES (?)", [day]
+        )
+        return self.publish(day)
+
+    def publish(self, day) -> pd.DataFrame:
+        """
+        Always-valid results after the look of `day`, for
+        each breakdown cell and step
+        """
+        totals = self.conn.execute(
+            "SELECT * FROM sequential_totals"
+        ).df()
+        steps = [f"reach_{step}" for step in self._steps]
+        index = self._breakdown + [METRIC_NAME]
+        long = totals.melt(
+            id_vars=[VARIANT]
+            + self._breakdown
+            + ["visitors"],
+            value_vars=steps,
+            var_name=METRIC_NAME,
+            value_name="conversions",
+        )
+        wide = long.pivot_table(
+            index=index,
+            columns=VARIANT,
+            values=["conversions", "visitors"],
+            aggfunc="sum",
+        ).reindex(columns=list(self.arms), level=1)
+        stats = msprt(
+            np.stack(
+                [
+                    wide["conversions"][v]
+                    for v in self.arms
+                ],
+                axis=-1,
+            ),
+            np.stack(
+                [
+                    wide["visitors"][v]
+                    for v in self.arms
+                ],
+                axis=-1,
+            ),
+            alpha=self.alpha,
+            tau=self.tau,
+        )
+        results = pd.DataFrame(stats, index=wide.index)
+        results.insert(0, "day", pd.Timestamp(day))
+        p_value = SequentialStats.P_VALUE.value
+        if self._exists("sequential_results"):
+            previous = (
+                self.conn.execute(
+                    """
+                    SELECT * FROM sequential_results
+                    WHERE day = (
+                        SELECT MAX(day) FROM sequential_results
+                    )
+                    """
+                )
+                .df()
+                .set_index(index)
+                .reindex(results.index)
+            )
+            results[p_value] = np.fmin(
+                results[p_value], previous[p_value]
+            )
+        results[SequentialStats.SIGNIFICANT.value] = (
+            results[p_value] < self.alpha
+        )
+        self.results = results
+        rows = results.reset_index()
+        if self._exists("sequential_results"):
+            self.conn.execute(
+                "INSERT INTO sequential_results SELECT * FROM rows"
+            )
+        else:
+            self.conn.execute(
+                """
+                CREATE TABLE sequential_results AS
+                SELECT * FROM rows
+                """
+            )
+        logging.info(
+            f"Sequential test after {day}: "
+            f"{results[SequentialStats.SIGNIFICANT.value].sum()}"
+            f" significant of {len(results)}"
+        )
+        return results
+
+    def run(self, end_date=None) -> pd.DataFrame:
+        """
+        Add every day of events not counted yet, up to
+        `end_date` or the last event
+        """
+        processed = self.processed_days()
+        first, last = self.conn.execute(
+            f"""
+            SELECT MIN({TIME_STAMP_NAME})::DATE
+                , MAX({TIME_STAMP_NAME})::DATE
+            FROM events
+            """
+        ).fetchone()
+        if self.start_date:
+            first = max(
+                first, pd.Timestamp(self.start_date).date()
+            )
+        if processed:
+            first = max(
+                first, processed[-1] + pd.Timedelta(days=1)
+            )
+        end = end_date or self.end_date
+        if end:
+            last = min(last, pd.Timestamp(end).date())
+        for day in pd.date_range(first, last):
+            self.update(day)
+        return self.results
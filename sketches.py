@@ -0,0 +1,373 @@
+import sys
+from dataclasses import dataclass, field
+import pandas as pd
+import numpy as np
+
+sys.path.append("..")
+sys.path.append("permutation")
+from utils.params import SKETCH_SIZE
+
+
+@dataclass
+class QuantileSketch:
+    """
+    Mergeable quantile sketch (a stack of KLL-style
+    compactors) for many rows at once, e.g. one row per
+    metric and breakdown cell.
+    Level h holds items standing for 2**h values each. Once a
+    level holds more than its capacity (`k` at the top level,
+    2/3 of the level above below it), it is sorted and every
+    other item, from a random offset, moves up a level.
+    Every row receives as many values as the others, so all
+    rows compact at the same time, as one array operation.
+    Each compaction at level h moves ranks by at most 2**h,
+    so the rank error of any quantile is at most
+    `rank_error` times the number of values.
+    NaN values are kept, but do not count in quantiles.
+    """
+
+    n_rows: int
+    k: int = SKETCH_SIZE
+    seed: int = None
+    levels: list = field(default_factory=list)
+    # Rank error so far, in number of values
+    error: float = 0
+
+    def __post_init__(self):
+        self.rng = np.random.default_rng(self.seed)
+
+    @property
+    def n(self) -> int:
+        "Number of values seen by each row"
+        return sum(
+            level.shape[1] * 2**h
+            for h, level in enumerate(self.levels)
+        )
+
+    @property
+    def rank_error(self) -> float:
+        "Bound on the rank error, as a share of the values"
+        return self.error / max(self.n, 1)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(level.nbytes for level in self.levels)
+
+    def update(self, values: np.ndarray) -> "QuantileSketch":
+        "Add (values, rows) samples, e.g. one block of tests"
+        self._add(0, np.asarray(values, dtype=float).T)
+        self._compact()
+        return self
+
+    def merge(
+        self, other: "QuantileSketch"
+    ) -> "QuantileSketch":
+        "Sketch of the values seen by both sketches"
+        merged = QuantileSketch(
+            self.n_rows,
+            self.k,
+            seed=self.rng.integers(2**32),
+        )
+        merged.error = self.error + other.error
+        for sketch in [self, other]:
+            for h, level in enumerate(sketch.levels):
+                merged._add(h, level)
+        merged._compact()
+        return merged
+
+    def group(self, groups: np.ndarray) -> "QuantileSketch":
+        """
+        Pool rows with the same group code (0 to n - 1)
+        into one row each, e.g. all cells of a metric.
+        Groups smaller than the largest are padded with NaN,
+        which carry no weight.
+        """
+        groups = np.asarray(groups)
+        sizes = np.bincount(groups)
+        n_groups, size = len(sizes), sizes.max()
+        # Position of each row within its group
+        order = np.argsort(groups, kind="stable")
+        starts = np.cumsum(sizes) - sizes
+        slot = np.empty_like(order)
+        slot[order] = (
+            np.arange(len(groups)) - starts[groups[order]]
+        )
+        pooled = QuantileSketch(
+            n_groups, self.k, seed=self.rng.integers(2**32)
+        )
+        pooled.error = self.error * size
+        for h, level in enumerate(self.levels):
+            width = level.shape[1]
+            items = np.full((n_groups, size * width), np.nan)
+            columns = slot[:, None] * width + np.arange(width)
+            items[groups[:, None], columns] = level
+            pooled._add(h, items)
+        pooled._compact()
+        return pooled
+
+    def quantile(self, q: float) -> np.ndarray:
+        "`q`-quantile of each row, NaN for rows without values"
+        items = np.concatenate(self.levels, axis=1)
+        weights = np.concatenate(
+            [
+                np.full(level.shape[1], 2.0**h)
+                for h, level in enumerate(self.levels)
+            ]
+        )
+        order = np.argsort(items, axis=1)  # NaN sort last
+        items = np.take_along_axis(items, order, axis=1)
+        weights = np.where(np.isnan(items), 0, weights[order])
+        cumulative = np.cumsum(weights, axis=1)
+        total = cumulative[:, -1:]
+        # Each item stands for the values around it: place it
+        # mid-way through its weight, and interpolate
+        middle = np.where(
+            weights > 0, cumulative - weights / 2, np.inf
+        )
+        target = q * total
+        upper = (middle < target).sum(axis=1)
+        upper = np.clip(upper, 1, items.shape[1] - 1)
+        rows = np.arange(self.n_rows)
+        lower = upper - 1
+        low, high = middle[rows, lower], middle[rows, upper]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            share = np.clip(
+                (target[:, 0] - low) / (high - low), 0, 1
+            )
+        share = np.nan_to_num(share, nan=0, posinf=0)
+        result = items[rows, lower] + share * (
+            items[rows, upper] - items[rows, lower]
+        )
+        return np.where(total[:, 0] > 0, result, np.nan)
+
+    def _add(self, h: int, items: np.ndarray):
+        while len(self.levels) <= h:
+            self.levels.append(np.empty((self.n_rows, 0)))
+        self.levels[h] = np.concatenate(
+            [self.levels[h], items], axis=1
+        )
+
+    def capacity(self, h: int) -> int:
+        "Lower levels hold fewer items, as in KLL"
+        top = len(self.levels) - 1
+        return max(2, int(self.k * (2 / 3) ** (top - h)))
+
+    def _compact(self):
+        h = 0
+        while h < len(self.levels):
+            level = self.levels[h]
+            if level.shape[1] <= self.capacity(h):
+                h += 1
+                continue
+            level = np.sort(level, axis=1)
+            # An odd item out stays at this level
+            pairs = level.shape[1] // 2
+            kept = level[:, 2 * pairs :]
+            offsets = self.rng.integers(0, 2, self.n_rows)
+            columns = offsets[:, None] + 2 * np.arange(pairs)
+            promoted = level[
+                np.arange(self.n_rows)[:, None], columns
+            ]
+            self.levels[h] = kept
+            self.error += 2**h
+            self._add(h + 1, promoted)
+            h += 1
+
+
+@dataclass
+class PermutationSketch:
+    """
+    Summary of permutation tests for each metric and
+    breakdown cell, updated block by block, so the tests
+    themselves need not stay in memory.
+    Means, standard deviations, minima and maxima are exact;
+    quantiles come from QuantileSketch, within its rank
+    error. Sketches of the same rows merge, e.g. from
+    separate runs or workers.
+    """
+
+    index: pd.Index
+    k: int = SKETCH_SIZE
+    seed: int = None
+    # Quantile sketch of each statistic
+    quantiles: dict = field(default_factory=dict)
+    # Count, sum and sum of squares of each statistic
+    moments: dict = field(default_factory=dict)
+    minimum: dict = field(default_factory=dict)
+    maximum: dict = field(default_factory=dict)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(s.nbytes for s in self.quantiles.values())
+
+    @property
+    def rank_error(self) -> float:
+        return max(
+            [s.rank_error for s in self.quantiles.values()],
+            default=0,
+        )
+
+    def update(
+        self,
+        stats: dict,
+        quantiles: list = None,
+    ) -> "PermutationSketch":
+        """
+        Add a block of tests: `stats` maps each statistic to
+        (permutations, rows) values, in the order of `index`.
+        Only the statistics in `quantiles` get a sketch.
+        """
+        for col, values in stats.items():
+            values = np.asarray(values, dtype=float)
+            valid = ~np.isnan(values)
+            count = valid.sum(axis=0)
+            total = np.nansum(values, axis=0)
+            squares = np.nansum(values**2, axis=0)
+            if col in self.moments:
+                previous = self.moments[col]
+                count, total, squares = (
+                    previous[0] + count,
+                    previous[1] + total,
+                    previous[2] + squares,
+                )
+            self.moments[col] = (count, total, squares)
+            with np.errstate(invalid="ignore"):
+                low = np.where(valid, values, np.inf).min(0)
+                high = np.where(valid, values, -np.inf).max(0)
+            self.minimum[col] = np.minimum(
+                self.minimum.get(col, np.inf), low
+            )
+            self.maximum[col] = np.maximum(
+                self.maximum.get(col, -np.inf), high
+            )
+            if col in (quantiles or []):
+                if col not in self.quantiles:
+                    self.quantiles[col] = QuantileSketch(
+                        len(self.index),
+                        self.k,
+                        seed=self.seed,
+                    )
+                self.quantiles[col].update(values)
+        return self
+
+    def update_frame(
+        self,
+        tests: pd.DataFrame,
+        permutation: str,
+        quantiles: list = None,
+    ) -> "PermutationSketch":
+        """
+        Add a frame of tests indexed like `index`, with one
+        `permutation` id column, in any row order.
+        """
+        columns = [
+            c for c in tests.columns if c != permutation
+        ]
+        wide = (
+            tests.reset_index()
+            .pivot(
+                index=permutation,
+                columns=list(self.index.names),
+                values=columns,
+            )
+            .astype(float)
+        )
+        return self.update(
+            {
+                col: wide[col]
+                .reindex(columns=self.index)
+                .to_numpy()
+                for col in columns
+            },
+            quantiles,
+        )
+
+    def merge(
+        self, other: "PermutationSketch"
+    ) -> "PermutationSketch":
+        merged = PermutationSketch(self.index, self.k)
+        for col in self.moments:
+            merged.moments[col] = tuple(
+                a + b
+                for a, b in zip(
+                    self.moments[col], other.moments[col]
+                )
+            )
+            merged.minimum[col] = np.minimum(
+                self.minimum[col], other.minimum[col]
+            )
+            merged.maximum[col] = np.maximum(
+                self.maximum[col], other.maximum[col]
+            )
+        for col in self.quantiles:
+            merged.quantiles[col] = self.quantiles[col].merge(
+                other.quantiles[col]
+            )
+        return merged
+
+    def group(self, level: str) -> "PermutationSketch":
+        "Pool all rows sharing a value of an index `level`"
+        codes, labels = pd.factorize(
+            self.index.get_level_values(level), sort=True
+        )
+        grouped = PermutationSketch(
+            pd.Index(labels, name=level), self.k
+        )
+        for col, moments in self.moments.items():
+            grouped.moments[col] = tuple(
+                np.bincount(codes, weights=m) for m in moments
+            )
+            grouped.minimum[col] = (
+                pd.Series(self.minimum[col])
+                .groupby(codes)
+                .min()
+            ).to_numpy()
+            grouped.maximum[col] = (
+                pd.Series(self.maximum[col])
+                .groupby(codes)
+                .max()
+            ).to_numpy()
+        for col, sketch in self.quantiles.items():
+            grouped.quantiles[col] = sketch.group(codes)
+        return grouped
+
+    def count(self, col: str) -> np.ndarray:
+        return self.moments[col][0]
+
+    def mean(self, col: str) -> np.ndarray:
+        count, total, _ = self.moments[col]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return total / count
+
+    def std(self, col: str) -> np.ndarray:
+        "Sample standard deviation, as pandas computes it"
+        count, total, squares = self.moments[col]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            variance = (squares - total**2 / count) / (
+                count - 1
+            )
+        return np.maximum(variance, 0) ** 0.5
+
+    def quantile(self, col: str, q: float) -> np.ndarray:
+        return self.quantiles[col].quantile(q)
+
+    def describe(self, col: str) -> pd.DataFrame:
+        "Same columns as pandas' describe, for each row"
+        empty = self.count(col) == 0
+        return pd.DataFrame(
+            {
+                "count": self.count(col).astype(int),
+                "mean": self.mean(col),
+                "std": self.std(col),
+                "min": np.where(
+                    empty, np.nan, self.minimum[col]
+                ),
+                "25%": self.quantile(col, 0.25),
+                "50%": self.quantile(col, 0.5),
+                "75%": self.quantile(col, 0.75),
+                "max": np.where(
+                    empty, np.nan, self.maximum[col]
+                ),
+            },
+            index=self.index,
+        )
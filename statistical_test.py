@@ -1,17 +1,11 @@
 import os, sys, logging
 from warnings import warn
 from dataclasses import dataclass
+from functools import partial
 import pandas as pd
 import numpy as np
 from tqdm import tqdm
-from scipy.stats import t
-from random import choices
-from pandera import (
-    DataFrameSchema,
-    Column,
-    check_input,
-    check_output,
-)
+from pandera import DataFrameSchema, Column
 from pandera.dtypes import Int64, Int32
 
 sys.path.append("..")
@@ -21,21 +15,30 @@ from utils.params import (
     UNIT_ID,
     STEP_NAME,
     VARIANT,
+    FIRST_EVENT,
     NUMERATOR,
     DENOMINATOR,
     METRIC_NAME,
     UserFlowStep,
     STEPS_LABEL_URL,
-    Assignment,
+    ARMS,
     ABTestStats,
     PowerAnalyticStats,
+    PermutationMethod,
     ABTestSettings,
     AB_TEST_PICKLE_FILE,
-    PERMUTATIONS_PICKLE_FILE,
+    PERMUTATION_ID,
     store_file,
     ALPHA,
     BETA,
     N_PERMUTATIONS,
+    PERMUTATION_BLOCK_SIZE,
+    PERMUTATION_BLOCK_BUDGET,
+    MIN_ADAPTIVE_PERMUTATIONS,
+    ADAPTIVE_CONFIDENCE,
+    PLANNED_DAYS,
+    BOOTSTRAP_REPLICATES,
+    AVERAGED,
 )
 from analytics.reporting import (
     Report,
@@ -45,7 +48,35 @@ from analytics.reporting import (
     pivoted_cr_schema,
     conversion_rate_raw_schema,
 )
+from analytics.permutation_engine import (
+    CompactProgress,
+    ProgressMatrices,
+    permutation_blocks,
+    run_permutations,
+    mean_interval,
+    quantile_interval,
+    database_index,
+    database_user_cells,
+    database_block,
+    contrast_index,
+    stratify,
+    stratified_assignments,
+)
+from analytics.kernels import compare_arms
+from analytics.sketches import PermutationSketch
+from analytics.bootstrap import poisson_bootstrap
+from utils.store import (
+    PermutationStore,
+    TEST_COLUMNS,
+    fingerprint,
+)
 from utils.helper import get_index
+from utils.validation import (
+    check_input,
+    check_output,
+    validate,
+    policy,
+)
 
 # Dataframe structures for type hinting
 ab_test_result_schema = DataFrameSchema(
@@ -63,6 +94,9 @@ ab_test_result_schema = DataFrameSchema(
         ABTestStats.P_VALUE.value: Column(
             float, nullable=True
         ),
+        ABTestStats.ADJUSTED_P_VALUE.value: Column(
+            float, nullable=True, required=False
+        ),
         ABTestStats.MDE.value: Column(float, nullable=True),
         ABTestStats.SIGNIFICANT.value: Column(
             bool, nullable=True
@@ -111,6 +145,9 @@ power_analysis_schema = DataFrameSchema(
         PowerAnalyticStats.REL_DET_EFFECT.value: Column(
             float
         ),
+        PowerAnalyticStats.N_PERMUTATIONS.value: Column(
+            int, required=False
+        ),
     }
 )
 
@@ -124,69 +161,39 @@ def compute_t_test(
     count_name: str = DENOMINATOR,
     event_name: str = NUMERATOR,
     metric_name: str = METRIC_NAME,
-    variant: list = Assignment.list(),
+    variant: list = ARMS,
 ) -> pd.DataFrame:  # ABTestResult:
     """
     Compute the t-test for the given conversion rate table,
     returns the same dataframe with the columns ABTestStats.
+    The statistics come from the batched kernel, run on the
+    whole table at once.
+    With more than two arms, each row is repeated for every
+    arm compared to Control, in an extra variant level, and
+    p-values are adjusted with Dunnett's test.
     """
-    v0 = variant[0]
-    v1 = variant[1]
+    variants = list(variant)
     # We use the Welch's t-test as variances can be uneven.
-    c[(ABTestStats.VARIANCE.value, v0)] = (
-        c[metric_name][v1]
-        * (1 - c[metric_name][v1])
-        / c[count_name][v1]
-    )  # .fillna(0).replace(np.inf, 0)
-    c[(ABTestStats.VARIANCE.value, v1)] = (
-        c[metric_name][v0]
-        * (1 - c[metric_name][v0])
-        / c[count_name][v0]
-    )  # .replace(np.inf, 0)
-    c[ABTestStats.STDEV.value] = (
-        c[ABTestStats.VARIANCE.value][v0]
-        + c[ABTestStats.VARIANCE.value][v1]
-    ) ** 0.5
-    c[ABTestStats.DIFFERENCE.value] = (
-        c[metric_name][v1] - c[metric_name][v0]
+    stats = compare_arms(
+        numerators=(
+            c[metric_name][variants] * c[count_name][variants]
+        ).to_numpy(),
+        denominators=c[count_name][variants].to_numpy(),
+        alpha=alpha,
+        variance=True,
     )
-    c[ABTestStats.T_SCORE.value] = (
-        c[ABTestStats.DIFFERENCE.value]
-        / c[ABTestStats.STDEV.value]
-    )
-    c[ABTestStats.DEGREES_OF_FREEDOM.value] = (
-        (
-            (
-                c[ABTestStats.VARIANCE.value][v0]
-                + c[ABTestStats.VARIANCE.value][v1]
-            )
-            ** 2
-            / (
-                c[ABTestStats.VARIANCE.value][v0] ** 2
-                / (c[count_name][v0] - 1)
-                + c[ABTestStats.VARIANCE.value][v1] ** 2
-                / (c[count_name][v1] - 1)
-            )
+    variance = stats.pop(ABTestStats.VARIANCE.value)
+    for i, v in enumerate(variants):
+        c[(ABTestStats.VARIANCE.value, v)] = variance[..., i]
+    if len(variants) > 2:
+        n_contrasts = len(variants) - 1
+        arms = np.tile(variants[1:], len(c))
+        c = c.iloc[np.repeat(np.arange(len(c)), n_contrasts)]
+        c = c.set_index(
+            pd.Index(arms, name=VARIANT), append=True
         )
-        .fillna(0)
-        .replace(np.inf, 0)
-        .astype(int)
-    )
-    c[ABTestStats.P_VALUE.value] = (
-        t.sf(
-            np.abs(c[ABTestStats.T_SCORE.value]),
-            c[ABTestStats.DEGREES_OF_FREEDOM.value],
-        )
-        * 2
-    )  # two-sided p-value
-    c[ABTestStats.MDE.value] = c[
-        ABTestStats.STDEV.value
-    ] * t.ppf(
-        1 - alpha / 2, c[ABTestStats.DEGREES_OF_FREEDOM.value]
-    )
-    c[ABTestStats.SIGNIFICANT.value] = (
-        c[ABTestStats.P_VALUE.value] < alpha
-    )
+    for stat, values in stats.items():
+        c[stat] = np.ravel(values)
 
     c.columns = [
         "_".join(cn).lower().rstrip("_") for cn in c.columns
@@ -194,6 +201,95 @@ def compute_t_test(
     return c
 
 
+def sample_treatment_counts(
+    sizes: np.ndarray,
+    n_permutations: int,
+    n_treatment: int = None,
+    rng: np.random.Generator = None,
+) -> np.ndarray:
+    """
+    Number of users of each profile that land in Treatment,
+    for many random splits at once.
+    Users sharing a profile are interchangeable, so there is
+    no need to shuffle them: with `n_treatment` users in
+    Treatment, the counts follow a multivariate
+    hypergeometric distribution. Without it, each user is
+    assigned by a coin flip, like `random.choices`, and the
+    counts are independent binomials.
+    Returns an array shaped (permutations, profiles).
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    if n_treatment is None:
+        return rng.binomial(
+            sizes, 0.5, size=(n_permutations, len(sizes))
+        )
+    return rng.multivariate_hypergeometric(
+        sizes, n_treatment, size=n_permutations
+    )
+
+
+def _draw_profile_counts(
+    sizes: np.ndarray,
+    rng: np.random.Generator,
+    n: int,
+    n_arms: int = 2,
+    arm_sizes: np.ndarray = None,
+) -> list:
+    """
+    Counts per profile of each arm but Control, for the
+    permutation engine.
+    Without `arm_sizes`, each user picks an arm at random:
+    binomial counts, multinomial with more than two arms.
+    With the observed number of users of each arm, every
+    split keeps them: counts are multivariate
+    hypergeometric, drawn arm after arm from the users left.
+    """
+    if arm_sizes is None:
+        if n_arms == 2:
+            return [sample_treatment_counts(sizes, n, rng=rng)]
+        counts = rng.multinomial(
+            sizes,
+            np.full(n_arms, 1 / n_arms),
+            size=(n, len(sizes)),
+        )
+        return [counts[..., arm] for arm in range(1, n_arms)]
+    counts = [
+        sample_treatment_counts(
+            sizes, n, n_treatment=int(arm_sizes[1]), rng=rng
+        )
+    ]
+    left = sizes - counts[0]
+    for arm in range(2, n_arms):
+        counts.append(
+            np.stack(
+                [
+                    rng.multivariate_hypergeometric(
+                        row, int(arm_sizes[arm])
+                    )
+                    for row in left
+                ]
+            )
+        )
+        left -= counts[-1]
+    return counts
+
+
+def _draw_stratified(
+    order: np.ndarray,
+    groups: np.ndarray,
+    variants: np.ndarray,
+    rng: np.random.Generator,
+    n: int,
+    n_arms: int = 2,
+) -> list:
+    "Users of each arm but Control, shuffled by stratum"
+    codes = stratified_assignments(
+        rng, n, order, groups, variants
+    )
+    return [codes == arm for arm in range(1, n_arms)]
+
+
 @dataclass
 class ABTest(ABTestSettings):
     """
@@ -207,6 +303,9 @@ class ABTest(ABTestSettings):
     conversion_rate_raw: pd.DataFrame = None
     conversion_rate: pd.DataFrame = None
     results: pd.DataFrame = None
+    # Poisson bootstrap replicates, for confidence intervals
+    n_bootstrap: int = None
+    bootstrap_results: pd.DataFrame = None
 
     def __post_init__(self):
         self.check_consistency()
@@ -227,7 +326,7 @@ class ABTest(ABTestSettings):
             ABTestStats.SIGNIFICANT.value,
         ]
         ranking_metric = "_".join(
-            [DENOMINATOR, Assignment.CONTROL.value]
+            [DENOMINATOR, self.arms[0]]
         ).lower()
         clean_summary = self.results.sort_values(
             ranking_metric
@@ -263,7 +362,12 @@ class ABTest(ABTestSettings):
         # Verify that the database table has the right schema
         c = self.conversion_rate_raw
         c[STEP_NAME] = c[STEP_NAME].map(STEPS_LABEL_URL)
-        conversion_rate_raw_schema.validate(c)
+        validate(
+            conversion_rate_raw_schema,
+            c,
+            "ABTest.format_conversion_rate",
+            self,
+        )
 
         # Filtering the data
         if self.breakdown:
@@ -302,7 +406,7 @@ class ABTest(ABTestSettings):
             .fillna(0)
         )
         for total in [NUMERATOR, DENOMINATOR]:
-            for assignement in Assignment.list():
+            for assignement in self.arms:
                 c[(total, assignement)] = c[
                     (total, assignement)
                 ].astype(int)
@@ -320,11 +424,14 @@ class ABTest(ABTestSettings):
         Coordinate the A/B test computation
         Store results and returns the results
         """
+        policy.reset()
         self.update_self_with_param(kwargs)
         # self.import_param_and_check(**kwargs)
         self.format_conversion_rate()
         results = compute_t_test(
-            self.conversion_rate, self.alpha
+            self.conversion_rate,
+            self.alpha,
+            variant=self.arms,
         )
         self.results = results
         # TODO: Define a decorator to store the results
@@ -336,8 +443,76 @@ class ABTest(ABTestSettings):
         )
         store_file(AB_TEST_PICKLE_FILE, results)
         logging.info(repr(self))
+        if self.n_bootstrap:
+            self.bootstrap()
         return results
 
+    def bootstrap(
+        self, n_bootstrap: int = None
+    ) -> pd.DataFrame:
+        """
+        Poisson bootstrap of the difference between variants,
+        user by user, from the detailed report: standard
+        error and percentile confidence interval at level
+        1 - alpha, for each breakdown cell and step, stored
+        next to ab_test_result, in ab_test_bootstrap.
+        Per-user averages of the report, with `metrics` such
+        as METRICS_DEFINITIONS, are bootstrapped too, as
+        means of per-user means (delay_home, …).
+        """
+        n_bootstrap = (
+            n_bootstrap
+            or self.n_bootstrap
+            or BOOTSTRAP_REPLICATES
+        )
+        progress = PowerAnalysis(
+            conn=self.conn,
+            categories=self.categories,
+            metrics=self.metrics,
+            filters=self.filters,
+            breakdown=self.breakdown,
+            steps=self.steps,
+            validation=self.validation,
+            arms=self.arms,
+        )
+        progress.load_user_progress()
+        if progress.user_progress is None:
+            progress.user_progress = self.conn.execute(
+                "SELECT * FROM user_progress"
+            ).df()
+        matrices = [progress.progress_matrices(per_user=True)]
+        if progress._averages:
+            matrices.append(progress.average_matrices())
+        # With a seed, every user gets the same weights in
+        # the replicates of reach and of averages
+        bootstrap = pd.concat(
+            [
+                poisson_bootstrap(
+                    m,
+                    progress.compact_progress.user_variants(),
+                    n_bootstrap,
+                    alpha=self.alpha,
+                    seed=self.seed,
+                    arms=self.arms,
+                )
+                for m in matrices
+            ]
+        )
+        # Same index as the t-test results
+        bootstrap = bootstrap.rename(
+            index=lambda m: m.removeprefix("reach_"),
+            level=METRIC_NAME,
+        ).rename_axis(index={METRIC_NAME: STEP_NAME})
+        self.bootstrap_results = bootstrap
+        cells = bootstrap.reset_index()
+        self.conn.execute(
+            """
+            CREATE OR REPLACE TABLE ab_test_bootstrap AS
+            SELECT * FROM cells
+            """
+        )
+        return bootstrap
+
 
 @dataclass
 class PowerAnalysis(ABTestSettings):
@@ -349,20 +524,49 @@ class PowerAnalysis(ABTestSettings):
     Repeats that permutation a given number of times;
     we recommend 10_000 times.
     Summarises the observation into a power analysis.
+    Users with the same breakdown values who reached the
+    same steps are interchangeable: permutations draw how
+    many users of each such profile land in each variant,
+    which is exact, rather than assign users one by one.
+    With the hypergeometric method, permutations draw how
+    many users of each profile land in each arm instead,
+    keeping the observed size of every arm.
+    With the database method, DuckDB runs the permutations
+    on the user_progress table, which never leaves it.
+    With the stratified method, permutations shuffle the
+    observed variants inside each breakdown cell, so every
+    cell keeps its split between variants.
     """
 
     conn: DBConnection
+    method: PermutationMethod = PermutationMethod.USERS
     user_progress: pd.DataFrame = None
+    # Packed once from user_progress, for permutations
+    compact_progress: CompactProgress = None
     aggregated_user_progress: pd.DataFrame = None
     permutation_tests: pd.DataFrame = None
     power_results: pd.DataFrame = None
     permutation_results: pd.DataFrame = None
+    store: PermutationStore = None
+    # Summarise tests in quantile sketches of that size,
+    # rather than loading them
+    sketch_size: int = None
+    sketch: PermutationSketch = None
+    # Power analysis for several simulated test durations
+    duration_results: pd.DataFrame = None
     should_run: bool = True
 
     def __post_init__(self):
         self.import_local_and_check()
         if self.n_permutations is None:
             self.n_permutations = N_PERMUTATIONS
+        # The method may come as its value, or from another
+        # import of the params module
+        self.method = PermutationMethod(
+            getattr(self.method, "value", self.method)
+        )
+        if self.store is None:
+            self.store = PermutationStore(self.conn)
 
     @property
     def details(self) -> list:
@@ -375,16 +579,29 @@ class PowerAnalysis(ABTestSettings):
                 VARIANT,
             ]
 
+    @property
+    def ordered_steps(self) -> list:
+        "Steps under test, in the order of the user flow"
+        ref_steps = UserFlowStep.list()
+        if self.steps:
+            return [
+                step for step in ref_steps if step in self.steps
+            ]
+        return ref_steps
+
     @check_output(user_progress_schema)
     def get_detailed_report(
         self,
     ) -> pd.DataFrame:  # UserProgress:
         "Compute the individual report in the database."
+        self.compact_progress = None
         self.user_progress = DetailedReport(
             conn=self.conn,
             categories=self.categories,
             filters=self.filters,
+            breakdown=self.breakdown,
             steps=self.steps,
+            metrics=self.metrics,
         ).run()
         return self.user_progress
 
@@ -414,6 +631,59 @@ class PowerAnalysis(ABTestSettings):
         )
         return agg
 
+    def pack_user_progress(self) -> CompactProgress:
+        "Pack the detailed report once, for permutations"
+        # TODO: Find a more reliable version
+        # than hard-coding ”reach”
+        if self.compact_progress is None:
+            self.compact_progress = (
+                CompactProgress.from_user_progress(
+                    self.user_progress,
+                    metrics=[
+                        col
+                        for col in self.user_progress.columns
+                        if col.startswith("reach_")
+                    ],
+                    averages=[
+                        col
+                        for col in self.user_progress.columns
+                        if col.startswith(AVERAGED)
+                    ],
+                    arms=self.arms,
+                )
+            )
+        return self.compact_progress
+
+    def progress_matrices(
+        self, per_user: bool = False, durations: list = None
+    ) -> ProgressMatrices:
+        """
+        Index the detailed report per user, once, for the
+        permutation engine.
+        Group identical users into weighted profiles,
+        unless `per_user` asks for one row per user.
+        With `durations`, repeat every cell for each number
+        of days since the first user arrived.
+        """
+        matrices = ProgressMatrices.from_compact(
+            self.pack_user_progress(),
+            metrics=self._metrics,
+            breakdown=self.breakdown,
+        )
+        if durations:
+            matrices = matrices.by_duration(
+                self.compact_progress.user_first_days(),
+                durations,
+            )
+        if per_user:
+            return matrices
+        matrices, _ = matrices.profiles()
+        logging.info(
+            f"Splitting {matrices.n_users:,} profiles "
+            f"instead of assigning individual users"
+        )
+        return matrices
+
     @check_output(pivoted_cr_schema)
     def reformat_progress(
         self,
@@ -426,29 +696,23 @@ class PowerAnalysis(ABTestSettings):
         requires a table with a different granularity
         and structure.
         """
-        ref_steps = UserFlowStep.list()
-        if self.steps:
-            steps = [
-                step for step in ref_steps if step in self.steps
-            ]
-        else:
-            steps = ref_steps
-
-        agg = self.reformat(
-            df=self.user_progress,
-            steps=steps,
-            details=self.details,
+        # Observed assignment, summed over every grouping
+        # set in one pass
+        matrices = self.progress_matrices(per_user=True)
+        numerators, denominators = matrices.aggregate(
+            self.compact_progress.user_variants()[None, :],
+            len(self.arms),
         )
-        col_names = [
-            (metric, variant.value)
-            for metric in [NUMERATOR, DENOMINATOR]
-            for variant in Assignment
-        ]
-        agg.columns = pd.MultiIndex.from_tuples(col_names)
-        agg.index.set_names(
-            (list(self.breakdown) if self.breakdown else [])
-            + [METRIC_NAME],
-            inplace=True,
+        agg = pd.DataFrame(
+            {
+                (metric, variant): totals[0, :, arm]
+                for metric, totals in [
+                    (NUMERATOR, numerators),
+                    (DENOMINATOR, denominators),
+                ]
+                for arm, variant in enumerate(self.arms)
+            },
+            index=matrices.index,
         )
         if type(agg.index) == pd.Index:
             self.values = {agg.index.name: agg.index.values}
@@ -460,39 +724,21 @@ class PowerAnalysis(ABTestSettings):
             warn("The aggregate results don’t have a known "+
                 f"index type: {agg.index}")
 
-        if self.breakdown:
-            # Addding the overall conversion rate
-            _overall_agg_ = self.reformat(
-                df=self.user_progress,
-                steps=steps,
-                details=[VARIANT],
-            )
-            _overall_agg_.index.name = METRIC_NAME
-            for col in self.breakdown:
-                _overall_agg_[col] = "All"
-                _overall_agg_.set_index(
-                    col, append=True, inplace=True
-                )
-            _overall_agg_ = _overall_agg_.reorder_levels(
-                list(self.breakdown) + [METRIC_NAME]
-            )
-            agg = pd.concat([agg, _overall_agg_])
-
         for metric in [NUMERATOR, DENOMINATOR]:
-            for variant in Assignment:
-                agg[(metric, variant.value)] = (
-                    agg[(metric, variant.value)]
+            for variant in self.arms:
+                agg[(metric, variant)] = (
+                    agg[(metric, variant)]
                     .fillna(0)
                     .astype(int)
                 )
 
         # Storing the conversion rate table infered
         # from the detailed report
-        for variant in Assignment:
-            agg[METRIC_NAME, variant.value] = (
-                agg[NUMERATOR][variant.value]
+        for variant in self.arms:
+            agg[METRIC_NAME, variant] = (
+                agg[NUMERATOR][variant]
                 * 1.0
-                / agg[DENOMINATOR][variant.value]
+                / agg[DENOMINATOR][variant]
             )
         self.aggregated_user_progress = agg
         self.conn.execute(
@@ -507,35 +753,494 @@ class PowerAnalysis(ABTestSettings):
     def compute_permutation_test(
         self,
     ) -> pd.DataFrame:  # PermutationTestDetails:
+        """
+        Process each permutation, store the results, and
+        load them all back.
+        Prefer stream_permutation_tests and
+        read_permutation_tests to only load what you need.
+        """
+        self.stream_permutation_tests()
+        self.permutation_tests = self.read_permutation_tests()
+        return self.permutation_tests
+
+    def fingerprint(self) -> str:
+        "Key of the stored permutation tests for this analysis"
+        progress = self.user_progress
+        if self.method is PermutationMethod.DATABASE:
+            progress = self.conn.execute(
+                """
+                SELECT SUM(hash(p))::VARCHAR, COUNT(*)
+                FROM user_progress p
+                """
+            ).fetchall()
+        return fingerprint(
+            progress,
+            self.ordered_steps,
+            self.breakdown,
+            self.filters,
+            self.alpha,
+            self.seed,
+            self.method,
+            # Arms compared, and what sets the block sizes
+            list(self.arms),
+            PERMUTATION_BLOCK_SIZE,
+            PERMUTATION_BLOCK_BUDGET,
+        )
+
+    def stream_permutation_tests(self) -> None:
         """
         Process each permutation.
-        This can be a very slow method,
+        Random assignments are drawn in blocks, and all the
+        tests of a block are computed at once on per-user
+        arrays, rather than re-aggregating the detailed
+        report for every permutation.
+        This can still be slow with many users,
         so it displays a progress bar in the console.
-        We also store the results to a pickle file.
+        Each block is written to the permutation store as
+        soon as it is computed, so memory stays bounded and
+        finished blocks survive a crash.
+        Blocks already stored for the same inputs are kept:
+        only the missing ones are computed.
+        """
+        for _ in self._stream_blocks():
+            pass
+
+    def _stream_blocks(self, read_stored: bool = False):
+        """
+        Yield the permutation tests block by block, in
+        permutation order, computing and storing the blocks
+        missing from the store.
+        Stored blocks are only read back with `read_stored`,
+        otherwise they yield None.
+        """
+        self.store.key = self.fingerprint()
+        if self.method is PermutationMethod.DATABASE:
+            block_size = PERMUTATION_BLOCK_SIZE
+        else:
+            matrices, draw = self._method_matrices()
+            block_size = matrices.block_size()
+        plan = permutation_blocks(
+            self.n_permutations, block_size, self.seed
+        )
+        stored = self.store.blocks()
+        missing = [
+            block
+            for block, (n, _) in enumerate(plan)
+            if stored.get(block) != n
+        ]
+        if len(missing) < len(plan):
+            logging.info(
+                f"Reusing {len(plan) - len(missing)} stored "
+                f"blocks of permutation tests"
+            )
+        if self.method is PermutationMethod.DATABASE:
+            computed = self._database_blocks(
+                block_size, only=missing
+            )
+        else:
+            computed = self._permutation_blocks(
+                matrices,
+                self.n_permutations,
+                draw=draw,
+                only=missing,
+            )
+        try:
+            for block, (n, _) in enumerate(plan):
+                if block not in missing:
+                    yield (
+                        self.store.read(
+                            columns=TEST_COLUMNS
+                            + [PERMUTATION_ID],
+                            block=block,
+                        )
+                        if read_stored
+                        else None
+                    )
+                    continue
+                tests = next(computed)
+                tests[PERMUTATION_ID] = block * block_size + (
+                    np.arange(len(tests)) // (len(tests) // n)
+                )
+                self.store.write(tests, block, n)
+                yield tests
+        finally:
+            computed.close()
+            self.store.touch()
+            self.store.evict()
+
+    def read_permutation_tests(
+        self,
+        columns: list = None,
+        permutations: int = None,
+        **where,
+    ) -> pd.DataFrame:
+        """
+        Load only some columns, cells or permutations of the
+        stored permutation tests; `where` maps breakdown and
+        metric columns to the values to keep.
+        Reads the first `n_permutations` by default, even if
+        more are stored.
         """
+        return self.store.read(
+            columns=columns,
+            where=where,
+            permutations=permutations or self.n_permutations,
+        )
+
+    def _method_matrices(
+        self, durations: list = None
+    ) -> tuple:
+        """
+        Matrices to permute with the configured method, and
+        how to draw random splits of their rows.
+        """
+        if self.method is PermutationMethod.HYPERGEOMETRIC:
+            profiles = self.progress_matrices(
+                durations=durations
+            )
+            # Splits keep the observed size of each arm
+            arm_sizes = np.bincount(
+                self.compact_progress.user_variants(),
+                minlength=len(self.arms),
+            )
+            return profiles, partial(
+                _draw_profile_counts,
+                profiles.sizes,
+                n_arms=len(self.arms),
+                arm_sizes=arm_sizes,
+            )
+        if self.method is PermutationMethod.STRATIFIED:
+            # Per user: each keeps their observed variant
+            # until shuffled within their breakdown cell
+            matrices = self.progress_matrices(
+                per_user=True, durations=durations
+            )
+            order, groups = stratify(
+                self.compact_progress.user_strata(
+                    self.breakdown
+                )
+            )
+            return matrices, partial(
+                _draw_stratified,
+                order,
+                groups,
+                self.compact_progress.user_variants(),
+                n_arms=len(self.arms),
+            )
+        profiles = self.progress_matrices(durations=durations)
+        # Profiles of identical users: draw how many of each
+        # go to each variant
+        return profiles, partial(
+            _draw_profile_counts,
+            profiles.sizes,
+            n_arms=len(self.arms),
+        )
+
+    def _permutation_blocks(
+        self,
+        matrices: ProgressMatrices,
+        n_permutations: int,
+        draw=None,
+        only: list = None,
+    ):
         result_cols = ABTestStats.list()
         result_cols.remove(ABTestStats.VARIANCE.value)
-        results = []
-        k = len(self.user_progress)
-        for _ in tqdm(
-            range(self.n_permutations),
+        plan = permutation_blocks(
+            n_permutations, matrices.block_size()
+        )
+        if only is not None:
+            plan = [plan[block] for block in only]
+        with tqdm(
+            total=sum(n for n, _ in plan),
             desc="Permutation tests",
-        ):
-            # Randomize variant assignment
-            variants = [var.value for var in Assignment]
-            self.user_progress[VARIANT] = choices(
-                variants, k=k
+        ) as progress:
+            yield from run_permutations(
+                matrices,
+                n_permutations=n_permutations,
+                alpha=self.alpha,
+                columns=result_cols,
+                seed=self.seed,
+                progress=progress,
+                draw=draw,
+                n_workers=self.n_workers,
+                only=only,
+                arms=self.arms,
             )
-            c = self.reformat_progress()
-            results.append(
-                compute_t_test(c, self.alpha)[result_cols]
+
+    @property
+    def _metrics(self) -> list:
+        return [
+            "reach_" + step.lower()
+            for step in self.ordered_steps
+        ]
+
+    @property
+    def _averages(self) -> list:
+        "Per-user averages of the detailed report, by step"
+        available = self.pack_user_progress().averages
+        return [
+            f"{metric}{step.lower()}"
+            for metric in AVERAGED
+            for step in self.ordered_steps
+            if f"{metric}{step.lower()}" in available
+        ]
+
+    def average_matrices(self) -> ProgressMatrices:
+        """
+        Per-user matrices of the averages of the detailed
+        report, such as delays, for the steps under test
+        """
+        return ProgressMatrices.from_averages(
+            self.pack_user_progress(),
+            self._averages,
+            breakdown=self.breakdown,
+        )
+
+    def _cell_index(self) -> pd.Index:
+        "Metric and breakdown cell of the permuted tables"
+        if self.method is PermutationMethod.DATABASE:
+            return database_index(
+                self.conn, self._metrics, self.breakdown
             )
-        self.permutation_tests = pd.concat(results)
-        store_file(
-            PERMUTATIONS_PICKLE_FILE,
-            self.permutation_tests
+        return self._method_matrices()[0].index
+
+    def permutation_index(self) -> pd.Index:
+        """
+        Metric and breakdown cell, and arm compared to
+        Control with more than two arms, of each permutation
+        test
+        """
+        return contrast_index(
+            self._cell_index(), self.arms
         )
-        return self.permutation_tests
+
+    def _database_blocks(
+        self, block_size: int, only: list = None
+    ):
+        """
+        Run blocks of permutations as DuckDB queries on the
+        user_progress table, without loading it.
+        """
+        index = self._cell_index()
+        table = database_user_cells(
+            self.conn, self._metrics, self.breakdown
+        )
+        result_cols = ABTestStats.list()
+        result_cols.remove(ABTestStats.VARIANCE.value)
+        # Same seed, same hash: the whole run is reproducible
+        state = np.random.SeedSequence(self.seed)
+        seed = int(state.generate_state(1)[0])
+        plan = permutation_blocks(
+            self.n_permutations, block_size
+        )
+        if only is None:
+            only = range(len(plan))
+        with tqdm(
+            total=sum(plan[block][0] for block in only),
+            desc="Permutation tests",
+        ) as progress:
+            for block in only:
+                n = plan[block][0]
+                yield database_block(
+                    self.conn,
+                    index,
+                    self._metrics,
+                    start=block * block_size,
+                    n=n,
+                    seed=seed,
+                    breakdown=self.breakdown,
+                    alpha=self.alpha,
+                    columns=result_cols,
+                    arms=self.arms,
+                    table=table,
+                )
+                progress.update(n)
+
+    def _permute(
+        self,
+        matrices: ProgressMatrices,
+        n_permutations: int,
+        draw=None,
+    ) -> pd.DataFrame:
+        return pd.concat(
+            self._permutation_blocks(
+                matrices, n_permutations, draw=draw
+            )
+        )
+
+    def power_by_cell(
+        self, permutation_tests: pd.DataFrame
+    ) -> pd.DataFrame:
+        """
+        Power analysis for each metric and breakdown cell
+        of a set of permutation tests.
+        """
+        power = permutation_tests.groupby(
+            level=list(permutation_tests.index.names)
+        ).agg(
+            {
+                ABTestStats.MDE.value: "mean",
+                ABTestStats.DIFFERENCE.value: self.q_beta,
+            }
+        )
+        power[PowerAnalyticStats.REL_DET_EFFECT.value] = (
+            power[ABTestStats.DIFFERENCE.value]
+            + power[ABTestStats.MDE.value]
+        )
+        power.columns = [
+            PowerAnalyticStats.MEAN_MDE.value,
+            PowerAnalyticStats.QUANT_DIFF.value,
+            PowerAnalyticStats.REL_DET_EFFECT.value,
+        ]
+        return power
+
+    @check_output(power_analysis_schema)
+    def power_by_duration(
+        self, durations: tuple = PLANNED_DAYS
+    ) -> pd.DataFrame:
+        """
+        Power analysis of the test had it run for each of
+        `durations`, in days: users whose first event came
+        later are left out. One load of the detailed report,
+        and one run of permutations for all durations, as
+        each permutation assigns a user once for all of them.
+        Permutations run in memory, whatever the method.
+        """
+        self.load_user_progress()
+        if self.user_progress is None:
+            self.compact_progress = None
+            self.user_progress = self.conn.execute(
+                "SELECT * FROM user_progress"
+            ).df()
+        if FIRST_EVENT not in self.user_progress:
+            self.get_detailed_report()
+        matrices, draw = self._method_matrices(
+            durations=list(durations)
+        )
+        tests = pd.concat(
+            self._permutation_blocks(
+                matrices, self.n_permutations, draw=draw
+            )
+        )
+        # In the order of the matrices, for cell_array
+        power = self.power_by_cell(
+            tests[
+                [
+                    ABTestStats.MDE.value,
+                    ABTestStats.DIFFERENCE.value,
+                ]
+            ]
+        ).reindex(
+            contrast_index(matrices.index, self.arms)
+        )
+        self.duration_results = power
+        self.conn.execute(
+            """
+            CREATE OR REPLACE TABLE power_by_duration AS
+            SELECT * FROM power"""
+        )
+        return power
+
+    def run_adaptive_power_analysis(
+        self, tolerance: float = None
+    ) -> pd.DataFrame:
+        """
+        Power analysis for each metric and breakdown cell,
+        stopping each cell once the confidence intervals of
+        its beta-quantile of differences and of its mean MDE
+        are narrower than ±`tolerance`.
+        Permutations run block by block, up to
+        `n_permutations`, until every cell has converged.
+        Reports how many permutations each cell used.
+        """
+        tolerance = tolerance or self.tolerance
+        index = self.permutation_index()
+        n_rows = len(index)
+        stats = {
+            ABTestStats.MDE.value: mean_interval,
+            ABTestStats.DIFFERENCE.value: partial(
+                quantile_interval, q=1 - self.beta
+            ),
+        }
+        samples = {col: [] for col in stats}
+        estimates = {
+            col: np.full(n_rows, np.nan) for col in stats
+        }
+        used = np.zeros(n_rows, dtype=int)
+        active = np.ones(n_rows, dtype=bool)
+        unconverged = np.zeros(n_rows, dtype=bool)
+        n_done = 0
+
+        blocks = self._stream_blocks(read_stored=True)
+        for tests in blocks:
+            tests = tests.reset_index()
+            for col in stats:
+                samples[col].append(
+                    tests.pivot(
+                        index=PERMUTATION_ID,
+                        columns=index.names,
+                        values=col,
+                    )
+                    .reindex(columns=index)
+                    .to_numpy(dtype=float)
+                )
+            n_done += len(samples[col][-1])
+            if n_done < min(
+                MIN_ADAPTIVE_PERMUTATIONS, self.n_permutations
+            ):
+                continue
+            converged = active.copy()
+            intervals = {}
+            for col, interval in stats.items():
+                intervals[col] = interval(
+                    np.concatenate(samples[col])[:, active],
+                    confidence=ADAPTIVE_CONFIDENCE,
+                )
+                # NaN intervals, from empty cells, cannot shrink
+                converged[active] &= ~(
+                    intervals[col][1] > tolerance
+                )
+            stop = converged | (
+                active & (n_done >= self.n_permutations)
+            )
+            for col, (estimate, _) in intervals.items():
+                estimates[col][stop & active] = estimate[
+                    stop[active]
+                ]
+            used[stop & active] = n_done
+            unconverged |= stop & active & ~converged
+            active &= ~stop
+            if not active.any():
+                blocks.close()
+                break
+
+        if unconverged.any():
+            warn(
+                f"{unconverged.sum()} cells did not converge "
+                f"within {self.n_permutations:,} permutations."
+            )
+        power = pd.DataFrame(
+            {
+                PowerAnalyticStats.MEAN_MDE.value: estimates[
+                    ABTestStats.MDE.value
+                ],
+                PowerAnalyticStats.QUANT_DIFF.value: estimates[
+                    ABTestStats.DIFFERENCE.value
+                ],
+            },
+            index=index,
+        )
+        power[PowerAnalyticStats.REL_DET_EFFECT.value] = (
+            power[PowerAnalyticStats.MEAN_MDE.value]
+            + power[PowerAnalyticStats.QUANT_DIFF.value]
+        )
+        power[PowerAnalyticStats.N_PERMUTATIONS.value] = used
+        logging.info(
+            f"Adaptive power analysis used {n_done:,} "
+            f"permutations; cells needed "
+            f"{used.min():,} to {used.max():,}"
+        )
+        return power
 
     def check_permutation_tests(self, breakdown=None):
         # Check index from permutation tests
@@ -568,16 +1273,10 @@ class PowerAnalysis(ABTestSettings):
     def q_beta(self, x) -> float:
         return x.quantile(1 - self.beta)
 
-    @check_output(power_analysis_schema)
-    def run_power_analysis(
-        self,
-        breakdown: set = None,
-        metrics: set = None,
-    ) -> pd.DataFrame:  # PowerResults:
+    def load_user_progress(self) -> pd.DataFrame:
         """
-        Given a (hopefully large) dataframe with
-        the results of the permutation tests,
-        compute the power analysis overall statistics.
+        Load the detailed report from the database,
+        or compute it if it is missing or lacks categories.
         """
         q_exists = """
             SELECT * FROM information_schema.tables
@@ -586,10 +1285,22 @@ class PowerAnalysis(ABTestSettings):
         if self.conn.execute(q_exists).df().empty:
             self.get_detailed_report()
         else:
-            self.user_progress = self.conn.execute(
-                "SELECT * FROM user_progress"
-            ).df()
-            cols = self.user_progress.columns
+            if self.method is PermutationMethod.DATABASE:
+                # Permutations run in the database: only
+                # check the columns of the table
+                cols = (
+                    self.conn.execute(
+                        "DESCRIBE user_progress"
+                    )
+                    .df()["column_name"]
+                    .values
+                )
+            else:
+                self.compact_progress = None
+                self.user_progress = self.conn.execute(
+                    "SELECT * FROM user_progress"
+                ).df()
+                cols = self.user_progress.columns
             if self.categories:
                 if self.breakdown:
                     if not self.breakdown.issubset(cols):
@@ -597,37 +1308,62 @@ class PowerAnalysis(ABTestSettings):
                 else:
                     if not set(self.categories.keys()).issubset(cols):
                         self.get_detailed_report()
+        return self.user_progress
+
+    @check_output(power_analysis_schema)
+    def run_power_analysis(
+        self,
+        breakdown: set = None,
+        metrics: set = None,
+    ) -> pd.DataFrame:  # PowerResults:
+        """
+        Given a (hopefully large) dataframe with
+        the results of the permutation tests,
+        compute the power analysis overall statistics.
+        With a `tolerance`, run permutations adaptively
+        instead, and report each breakdown cell.
+        With a `sketch_size`, tests are summarised as they
+        stream, and never loaded all at once.
+        """
+        self.load_user_progress()
 
         if breakdown:
             self.breakdown = breakdown
         if metrics:
             self.metrics = metrics
-
-        permutation_test = (
-            self.compute_permutation_test().reset_index()
-        )
-        self.check_permutation_tests()
+        if self.tolerance:
+            power = self.run_adaptive_power_analysis()
+            self.power_results = power
+            self.conn.execute(
+                """
+                CREATE OR REPLACE TABLE power_results AS
+                SELECT * FROM power"""
+            )
+            return power
 
         col_names = [
             ABTestStats.MDE.value,
             ABTestStats.DIFFERENCE.value,
         ]
-        distribution_diffences = permutation_test[
-            (list(self.breakdown) if self.breakdown else [])
-            + [METRIC_NAME]
-            + col_names
-        ]
-        distribution_diffences = (
-            distribution_diffences.set_index(METRIC_NAME)
-        )
-        quantile_df = distribution_diffences.groupby(
-            METRIC_NAME
-        ).agg(
-            {
-                ABTestStats.MDE.value: "mean",
-                ABTestStats.DIFFERENCE.value: self.q_beta,
-            }
-        )
+        if self.sketch_size:
+            sketch = self.sketch_permutation_tests().group(
+                METRIC_NAME
+            )
+            self.values = get_index(self.sketch.index)
+            quantile_df = pd.DataFrame(
+                {
+                    ABTestStats.MDE.value: sketch.mean(
+                        ABTestStats.MDE.value
+                    ),
+                    ABTestStats.DIFFERENCE.value: sketch.quantile(
+                        ABTestStats.DIFFERENCE.value,
+                        1 - self.beta,
+                    ),
+                },
+                index=sketch.index,
+            )
+        else:
+            quantile_df = self._power_quantiles(col_names)
         quantile_df[
             PowerAnalyticStats.REL_DET_EFFECT.value
         ] = (
@@ -660,8 +1396,22 @@ class PowerAnalysis(ABTestSettings):
         Aggregate the overall statistics of the
         permutation tests.
         Reformat the number types of the results.
+        With a `sketch_size`, the quartiles of p-values come
+        from the sketches.
         """
-        stats = self.permutation_tests.groupby(
+        if self.sketch_size:
+            stats = self._sketch_permutation_stats()
+            pd.options.display.float_format = "{:,.3g}".format
+            self.permutation_results = stats
+            return stats
+        permutation_tests = self.read_permutation_tests(
+            columns=[
+                ABTestStats.SIGNIFICANT.value,
+                ABTestStats.DIFFERENCE.value,
+                ABTestStats.P_VALUE.value,
+            ]
+        )
+        stats = permutation_tests.groupby(
             METRIC_NAME
         ).agg(
             {
@@ -681,43 +1431,119 @@ class PowerAnalysis(ABTestSettings):
         self.permutation_results = stats
         return stats
 
+    def _power_quantiles(self, col_names: list) -> pd.DataFrame:
+        self.stream_permutation_tests()
+        self.permutation_tests = self.read_permutation_tests(
+            columns=col_names
+        )
+        permutation_test = self.permutation_tests.reset_index()
+        self.check_permutation_tests()
+
+        distribution_diffences = permutation_test[
+            (list(self.breakdown) if self.breakdown else [])
+            + [METRIC_NAME]
+            + col_names
+        ]
+        distribution_diffences = (
+            distribution_diffences.set_index(METRIC_NAME)
+        )
+        return distribution_diffences.groupby(
+            METRIC_NAME
+        ).agg(
+            {
+                ABTestStats.MDE.value: "mean",
+                ABTestStats.DIFFERENCE.value: self.q_beta,
+            }
+        )
+
+    def sketch_permutation_tests(self) -> PermutationSketch:
+        """
+        Summarise the permutation tests block by block, as
+        they are computed or read back from the store, into
+        sketches of `sketch_size` items per metric and
+        breakdown cell: only the sketch stays in memory.
+        """
+        index = self.permutation_index()
+        self.sketch = PermutationSketch(
+            index, self.sketch_size, seed=self.seed
+        )
+        for tests in self._stream_blocks(read_stored=True):
+            self.sketch.update_frame(
+                tests[
+                    [
+                        ABTestStats.MDE.value,
+                        ABTestStats.DIFFERENCE.value,
+                        ABTestStats.SIGNIFICANT.value,
+                        ABTestStats.P_VALUE.value,
+                        PERMUTATION_ID,
+                    ]
+                ],
+                permutation=PERMUTATION_ID,
+                quantiles=[
+                    ABTestStats.DIFFERENCE.value,
+                    ABTestStats.P_VALUE.value,
+                ],
+            )
+        logging.info(
+            f"Permutation tests sketched in "
+            f"{self.sketch.nbytes / 2**20:,.1f} MB, with a "
+            f"rank error under {self.sketch.rank_error:.2%}"
+        )
+        return self.sketch
+
+    def _sketch_permutation_stats(self) -> pd.DataFrame:
+        if self.sketch is None:
+            self.sketch_permutation_tests()
+        sketch = self.sketch.group(METRIC_NAME)
+        p_values = sketch.describe(ABTestStats.P_VALUE.value)
+        p_values.columns = pd.MultiIndex.from_product(
+            [[ABTestStats.P_VALUE.value], p_values.columns]
+        )
+        stats = pd.DataFrame(
+            {
+                (ABTestStats.SIGNIFICANT.value, "mean"): (
+                    sketch.mean(ABTestStats.SIGNIFICANT.value)
+                ),
+                (ABTestStats.DIFFERENCE.value, "std"): (
+                    sketch.std(ABTestStats.DIFFERENCE.value)
+                ),
+            },
+            index=sketch.index,
+        )
+        return pd.concat([stats, p_values], axis=1)
+
     def load_or_run(self, **kwargs):
         """
         Main access function for this class.
-        Check that there isn’t a pickle file,
-        loads and check that it matches.
-        If not, reload the power analysis,
+        Check that there are enough permutation tests stored
+        for the same inputs, without loading them.
+        If not, run the missing permutations,
         aggregate the results and store both.
         """
+        policy.reset()
         self.__dict__.update(kwargs)
 
-        if os.path.exists(PERMUTATIONS_PICKLE_FILE):
-            self.permutation_tests = pd.read_pickle(
-                PERMUTATIONS_PICKLE_FILE
-            )            
-            permutation_test_detail_schema.validate(
-                self.permutation_tests
+        self.load_user_progress()
+        self.store.key = self.fingerprint()
+        n_stored = self.store.count()
+        if n_stored >= self.n_permutations:
+            validate(
+                permutation_test_detail_schema,
+                self.read_permutation_tests(permutations=1),
+                "PowerAnalysis.load_or_run",
+                self,
+            )
+            self.store.touch()
+            logging.info(
+                f"""Permutation analysis re-loaded:
+                {n_stored:,} permutations stored"""
+            )
+            return
+        if n_stored:
+            logging.info(
+                f"Extending {n_stored:,} stored permutations "
+                f"to {self.n_permutations:,}..."
             )
-            if self.permutation_tests.shape[0] % \
-                self.n_permutations == 0:
-                logging.info(
-                    f"""Permutation analysis re-loaded:
-                    {self.permutation_results}"""
-                )
-                return
-            else:
-                pa_args = self.__dict__
-                _pa = set({k:v for k, v in pa_args.items()
-                           if type(v) is not pd.DataFrame })
-                _kw = set({k:v for k, v in kwargs.items()
-                           if type(v) is not pd.DataFrame })                
-                logging.info(
-                    f"Power analysis file obsolete."
-                    f"Previous version had: {_pa^_kw}"
-                    f"Current version expects: {_kw^_pa}"
-                    f"Re-processing..."
-                )
-                self = PowerAnalysis.filtered_init(self.__dict__)
 
         if self.should_run:
             self.run_power_analysis()
@@ -726,6 +1552,10 @@ class PowerAnalysis(ABTestSettings):
                 f"""Permutation analysis complete:
                 {self.permutation_results}"""
             )
+            logging.info(
+                f"Schema validation:\n"
+                f"{policy.report()}"
+            )
         else:
             warn("Issue with loading the permutation tests.")
 
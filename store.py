@@ -0,0 +1,251 @@
+import os, sys, glob, shutil, hashlib, logging
+from dataclasses import dataclass
+import pandas as pd
+
+sys.path.append("..")
+sys.path.append("permutation")
+from utils.db import DBConnection
+from utils.params import (
+    PERMUTATIONS_FOLDER,
+    PERMUTATIONS_CACHE_BYTES,
+    PERMUTATION_ID,
+    ABTestStats,
+)
+
+# Columns of the permutation tests, besides the index
+TEST_COLUMNS = [
+    stat
+    for stat in ABTestStats.list()
+    if stat != ABTestStats.VARIANCE.value
+]
+# Position of each row within its permutation, as written
+PERMUTATION_ROW = "permutation_row"
+# Layout of the stored files: fingerprints change with it, so
+# files written before are not read back
+STORE_VERSION = 2
+
+
+def _quote(column: str) -> str:
+    return f'"{column}"'
+
+
+def fingerprint(*inputs) -> str:
+    """
+    Hash of everything permutation tests depend on: data
+    frames by content, other inputs by their sorted repr.
+    """
+    digest = hashlib.sha256(repr(STORE_VERSION).encode())
+    for value in inputs:
+        if isinstance(value, pd.DataFrame):
+            digest.update(
+                pd.util.hash_pandas_object(
+                    value, index=False
+                ).values.tobytes()
+            )
+            digest.update(repr(list(value.columns)).encode())
+        elif isinstance(value, (set, frozenset)):
+            digest.update(repr(sorted(value)).encode())
+        elif isinstance(value, dict):
+            digest.update(
+                repr(sorted(value.items())).encode()
+            )
+        else:
+            digest.update(repr(value).encode())
+    return digest.hexdigest()[:16]
+
+
+@dataclass
+class PermutationStore:
+    """
+    Permutation tests stored as Parquet datasets, one file
+    per block of permutations, written as soon as the block
+    is computed.
+    Each analysis gets its own folder, named after the
+    fingerprint of its inputs (`key`), so several analyses
+    can sit side by side, and blocks computed earlier can be
+    reused to extend a run. The least recently used analyses
+    are evicted past `max_bytes`.
+    Reads go through DuckDB, which only loads the columns and
+    the breakdown cells that are asked for.
+    """
+
+    conn: DBConnection
+    root: os.path = PERMUTATIONS_FOLDER
+    key: str = None
+    max_bytes: int = PERMUTATIONS_CACHE_BYTES
+
+    @property
+    def folder(self) -> os.path:
+        if self.key is None:
+            return self.root
+        return os.path.join(self.root, self.key)
+
+    @property
+    def files(self) -> str:
+        return os.path.join(self.folder, "*.parquet")
+
+    def exists(self) -> bool:
+        return len(glob.glob(self.files)) > 0
+
+    def clear(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def blocks(self) -> dict:
+        "Number of permutations in each stored block"
+        stored = {}
+        for path in glob.glob(self.files):
+            name = os.path.basename(path).split(".")[0]
+            _, block, n = name.split("_")
+            stored[int(block)] = int(n)
+        return stored
+
+    def count(self) -> int:
+        "Number of permutations stored, from the first block on"
+        stored = self.blocks()
+        count, block = 0, 0
+        while block in stored:
+            count += stored[block]
+            block += 1
+        return count
+
+    def drop_block(self, block: int):
+        pattern = f"block_{block:06d}_*.parquet"
+        for path in glob.glob(
+            os.path.join(self.folder, pattern)
+        ):
+            os.remove(path)
+
+    def write(self, tests: pd.DataFrame, block: int, n: int):
+        """
+        Write one block of `n` permutations; the frame needs
+        a PERMUTATION_ID column to keep permutations apart,
+        and keeps the order of its rows within each.
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        self.drop_block(block)
+        path = os.path.join(
+            self.folder, f"block_{block:06d}_{n}.parquet"
+        )
+        rows = tests.groupby(PERMUTATION_ID).cumcount()
+        self.conn.register(
+            "permutation_block",
+            tests.reset_index().assign(
+                **{PERMUTATION_ROW: rows.to_numpy()}
+            ),
+        )
+        self.conn.execute(
+            f"""
+            COPY (SELECT * FROM permutation_block)
+            TO '{path}' (FORMAT PARQUET)
+            """
+        )
+        self.conn.unregister("permutation_block")
+
+    def touch(self):
+        "Mark this analysis as recently used"
+        if os.path.isdir(self.folder):
+            os.utime(self.folder)
+
+    def evict(self):
+        """
+        Delete the least recently used analyses, other than
+        this one, until the store fits in `max_bytes`.
+        """
+        folders = [
+            path
+            for path in glob.glob(
+                os.path.join(self.root, "*")
+            )
+            if os.path.isdir(path)
+        ]
+        sizes = {
+            path: sum(
+                os.path.getsize(f)
+                for f in glob.glob(os.path.join(path, "*"))
+            )
+            for path in folders
+        }
+        total = sum(sizes.values())
+        for path in sorted(folders, key=os.path.getmtime):
+            if total <= self.max_bytes:
+                break
+            if os.path.abspath(path) == os.path.abspath(
+                self.folder
+            ):
+                continue
+            logging.info(f"Evicting permutation tests {path}")
+            shutil.rmtree(path, ignore_errors=True)
+            total -= sizes[path]
+
+    def index_columns(self) -> list:
+        "Breakdown and metric columns, stored as plain columns"
+        columns = self.conn.execute(
+            f"DESCRIBE SELECT * FROM read_parquet('{self.files}')"
+        ).df()["column_name"]
+        stored = TEST_COLUMNS + [
+            PERMUTATION_ID,
+            PERMUTATION_ROW,
+        ]
+        return [col for col in columns if col not in stored]
+
+    def values(self) -> dict:
+        "Distinct values of each breakdown and metric column"
+        return {
+            col: self.conn.execute(
+                f"""
+                SELECT DISTINCT {_quote(col)}
+                FROM read_parquet('{self.files}')
+                ORDER BY 1
+                """
+            )
+            .df()[col]
+            .values
+            for col in self.index_columns()
+        }
+
+    def read(
+        self,
+        columns: list = None,
+        where: dict = None,
+        permutations: int = None,
+        block: int = None,
+    ) -> pd.DataFrame:
+        """
+        Load permutation tests, in permutation order,
+        indexed like the frame that was written.
+        `where` maps index columns to a value or a tuple of
+        values; `permutations` keeps only the first ones, and
+        `block` only reads that block.
+        """
+        files = self.files
+        if block is not None:
+            files = os.path.join(
+                self.folder, f"block_{block:06d}_*.parquet"
+            )
+        index = self.index_columns()
+        columns = TEST_COLUMNS if columns is None else columns
+        conditions, parameters = [], []
+        for col, values in (where or {}).items():
+            if not isinstance(values, (tuple, list, set)):
+                values = (values,)
+            values = list(values)
+            conditions.append(
+                f"{_quote(col)} IN "
+                f"({', '.join('?' * len(values))})"
+            )
+            parameters += values
+        if permutations is not None:
+            conditions.append(f"{PERMUTATION_ID} < ?")
+            parameters.append(permutations)
+        query = f"""
+            SELECT {', '.join(map(_quote, index + columns))}
+            FROM read_parquet('{files}')
+            {'WHERE ' + ' AND '.join(conditions)
+             if conditions else ''}
+            ORDER BY {PERMUTATION_ID}, {PERMUTATION_ROW}
+            """
+        return (
+            self.conn.execute(query, parameters)
+            .df()
+            .set_index(index)
+        )
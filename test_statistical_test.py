@@ -1,8 +1,11 @@
-import unittest
+import unittest, tempfile, os, glob
 from unittest.mock import Mock, patch
+import duckdb
 import pandas as pd
 import numpy as np
 from scipy.stats import t
+from pandera import DataFrameSchema, Column
+from pandera.errors import SchemaError
 
 import sys
 
@@ -10,6 +13,67 @@ sys.path.append("..")
 from permutation.analytics.statistical_test import (
     compute_t_test,
     ABTest,
+    PowerAnalysis,
+    sample_treatment_counts,
+    _draw_profile_counts,
+)
+from permutation.analytics.kernels import (
+    welch_t_test,
+    critical_value,
+    two_sided_p_value,
+    msprt,
+    dunnett_test,
+)
+from permutation.utils.validation import (
+    ValidationPolicy,
+    check_input,
+)
+from permutation.analytics.reporting import (
+    FlexibleReport,
+    ReportCache,
+    filter_conditions,
+    date_window,
+)
+from permutation.analytics.dimensions import (
+    refresh_local_time,
+    refresh_user_dimensions,
+)
+from permutation.analytics.categories import (
+    CATEGORY_EXAMPLES,
+)
+from permutation.utils.store import (
+    PermutationStore,
+    TEST_COLUMNS,
+)
+from permutation.utils.params import (
+    ValidationMode,
+    PermutationMethod,
+    ALPHA,
+    T_TABLE_DOF,
+    SequentialStats,
+    PowerAnalyticStats,
+    VARIANT,
+    METRIC_NAME,
+)
+from permutation.analytics.sequential import SequentialTest
+from permutation.analytics.sketches import QuantileSketch
+from permutation.analytics.bootstrap import poisson_bootstrap
+from permutation.analytics.planner import (
+    SampleSizePlanner,
+    sample_size,
+    minimum_detectable_effect,
+)
+from permutation.analytics.permutation_engine import (
+    CompactProgress,
+    ProgressMatrices,
+    run_permutations,
+    cell_array,
+    stratify,
+    stratified_assignments,
+    quantile_interval,
+    database_index,
+    database_user_cells,
+    database_counts,
 )
 
 # TODO: Mock-test PowerAnalysis
@@ -71,5 +135,1695 @@ class TestABTest(unittest.TestCase):
         )
 
 
+class TestValidationPolicy(unittest.TestCase):
+    def test_modes(self):
+        schema = DataFrameSchema({"x": Column(int)})
+        bad = pd.DataFrame({"x": ["a"]})
+        policy = ValidationPolicy(mode=ValidationMode.OFF)
+        policy.validate(schema, bad, "off")
+        policy.mode = ValidationMode.ONCE
+        owner = Mock()
+        policy.validate(
+            schema, pd.DataFrame({"x": [1]}), "once", owner
+        )
+        policy.validate(schema, bad, "once", owner)
+        self.assertEqual(policy.timings["once"][0], 1)
+        # Free functions have no object to check once
+        with self.assertRaises(SchemaError):
+            policy.validate(schema, bad, "once")
+        policy.reset()
+        with self.assertRaises(SchemaError):
+            policy.validate(schema, bad, "once", owner)
+        policy.mode = ValidationMode.SAMPLE
+        with self.assertRaises(SchemaError):
+            policy.validate(schema, bad, "sample")
+        self.assertListEqual(
+            list(policy.report().columns),
+            ["calls", "seconds"],
+        )
+
+    def test_check_input_by_keyword(self):
+        schema = DataFrameSchema({"x": Column(int)})
+
+        @check_input(schema)
+        def total(df: pd.DataFrame, scale: int = 1) -> int:
+            return int(df["x"].sum()) * scale
+
+        self.assertEqual(
+            total(df=pd.DataFrame({"x": [1, 2]})), 3
+        )
+        with self.assertRaises(SchemaError):
+            total(scale=2, df=pd.DataFrame({"x": ["a"]}))
+
+
+class TestWelchTTest(unittest.TestCase):
+    def test_batch_matches_single_tables(self):
+        rng = np.random.default_rng(0)
+        denominators = rng.integers(10, 1_000, (50, 4, 2))
+        numerators = rng.binomial(denominators, 0.3)
+        batch = welch_t_test(numerators, denominators)
+        self.assertEqual(batch["p-value"].shape, (50, 4))
+        single = welch_t_test(
+            numerators[7, 2], denominators[7, 2]
+        )
+        for stat, values in single.items():
+            np.testing.assert_allclose(
+                batch[stat][7, 2], values
+            )
+        # Same p-value as the textbook Welch's t-test
+        rate = numerators[7, 2] / denominators[7, 2]
+        var = rate * (1 - rate) / denominators[7, 2]
+        dof = int(
+            var.sum() ** 2
+            / (var**2 / (denominators[7, 2] - 1)).sum()
+        )
+        t_score = (rate[1] - rate[0]) / var.sum() ** 0.5
+        self.assertAlmostEqual(
+            single["p-value"], t.sf(abs(t_score), dof) * 2
+        )
+
+    def test_cached_t_distribution(self):
+        dof = np.array([0, 1, 5, 300, T_TABLE_DOF, 10**7])
+        t_score = np.array([1.0, -2.0, 2.5, 1.96, -3.0, 0.5])
+        np.testing.assert_allclose(
+            two_sided_p_value(t_score, dof)[1:],
+            t.sf(np.abs(t_score[1:]), dof[1:]) * 2,
+            rtol=1e-5,
+        )
+        np.testing.assert_allclose(
+            critical_value(dof)[1:],
+            t.ppf(1 - ALPHA / 2, dof[1:]),
+            rtol=1e-5,
+        )
+        self.assertTrue(np.isnan(critical_value(0)))
+
+
+class TestProgressMatrices(unittest.TestCase):
+    def setUp(self):
+        self.steps = ["home", "cart"]
+        self.user_progress = pd.DataFrame(
+            {
+                "user_domain_id": ["a", "b", "c", "d", "d"],
+                "variant": [
+                    "Control",
+                    "Treatment",
+                    "Treatment",
+                    "Control",
+                    "Control",
+                ],
+                "utm_source": ["x", "x", "y", "x", "y"],
+                "reach_home": [True, True, True, False, True],
+                "reach_cart": [
+                    False,
+                    True,
+                    False,
+                    False,
+                    True,
+                ],
+            }
+        )
+        self.matrices = ProgressMatrices.from_user_progress(
+            self.user_progress,
+            metrics=["reach_" + step for step in self.steps],
+            breakdown=["utm_source"],
+        )
+
+    def test_aggregate_matches_reformat(self):
+        # Re-apply the observed assignment, user by user
+        assignments = np.array([[0, 1, 1, 0]], dtype=np.int8)
+        numerators, denominators = self.matrices.aggregate(
+            assignments
+        )
+        expected = PowerAnalysis.reformat(
+            self.user_progress,
+            steps=self.steps,
+            details=["variant", "utm_source"],
+        ).fillna(0)
+        for i, (source, metric) in enumerate(
+            self.matrices.index[:-2]
+        ):
+            row = expected.loc[(source, metric)]
+            np.testing.assert_array_equal(
+                numerators[0, i],
+                row["conversions"][["Control", "Treatment"]],
+            )
+            np.testing.assert_array_equal(
+                denominators[0, i],
+                row["visitors"][["Control", "Treatment"]],
+            )
+        # Overall cell: user “d” only counts once
+        np.testing.assert_array_equal(
+            denominators[0, -1], [2, 2]
+        )
+
+    def test_compact_progress_roundtrip(self):
+        metrics = ["reach_home", "reach_cart"]
+        compact = CompactProgress.from_user_progress(
+            self.user_progress, metrics
+        )
+        self.assertEqual(compact.reached.dtype, np.uint8)
+        np.testing.assert_array_equal(
+            compact.metric_values(metrics[::-1]),
+            self.user_progress[metrics[::-1]].astype(int),
+        )
+        cells, labels = compact.cells(["utm_source"])
+        self.assertEqual(labels, [("x",), ("y",)])
+        np.testing.assert_array_equal(cells, [0, 0, 1, 0, 1])
+
+    def test_by_duration_keeps_early_users(self):
+        progress = self.user_progress.assign(
+            first_event=pd.to_datetime(
+                [
+                    "2024-01-01 10:00",
+                    "2024-01-03",
+                    "2024-01-01 23:00",
+                    "2024-01-02",
+                    "2024-01-01 12:00",
+                ]
+            )
+        )
+        compact = CompactProgress.from_user_progress(
+            progress, ["reach_home", "reach_cart"]
+        )
+        # User “d” counts from their earliest row
+        np.testing.assert_array_equal(
+            compact.user_first_days(), [0, 2, 0, 0]
+        )
+        matrices = self.matrices.by_duration(
+            compact.user_first_days(), [1, 3]
+        )
+        self.assertEqual(matrices.index.names[0], "days")
+        visitors = matrices.totals(matrices.denominators)
+        # Cells x, y and overall, after one day then three
+        np.testing.assert_array_equal(
+            visitors, [2, 2, 3, 3, 2, 4]
+        )
+
+    def test_every_grouping_set_in_one_pass(self):
+        progress = self.user_progress.assign(
+            device=["m", "d", "m", "d", "m"]
+        )
+        matrices = ProgressMatrices.from_user_progress(
+            progress,
+            metrics=["reach_home"],
+            breakdown=["utm_source", "device"],
+        )
+        visitors = pd.Series(
+            matrices.totals(matrices.denominators),
+            index=matrices.index.droplevel("conversion_rate"),
+        )
+        # Each column on its own, then overall
+        self.assertEqual(visitors[("x", "All")], 3)
+        self.assertEqual(visitors[("All", "m")], 3)
+        self.assertEqual(visitors[("All", "All")], 4)
+        array, cells, rows = cell_array(
+            visitors.to_frame().set_index(matrices.index),
+            ["utm_source", "device"],
+        )
+        self.assertEqual(
+            array[0, cells[("All", "d")], 0, 0], 2
+        )
+        self.assertEqual(list(rows), ["reach_home"])
+
+    def test_seeded_runs_match_across_workers(self):
+        def run(n_workers):
+            return pd.concat(
+                run_permutations(
+                    self.matrices,
+                    n_permutations=25,
+                    seed=7,
+                    block_size=10,
+                    n_workers=n_workers,
+                )
+            )
+
+        pd.testing.assert_frame_equal(run(1), run(2))
+
+    def test_profiles_keep_totals(self):
+        # Two more copies of every user
+        copies = pd.concat(
+            [
+                self.user_progress.assign(
+                    user_domain_id=lambda df: df[
+                        "user_domain_id"
+                    ]
+                    + str(copy)
+                )
+                for copy in range(3)
+            ]
+        )
+        matrices = ProgressMatrices.from_user_progress(
+            copies,
+            metrics=["reach_" + step for step in self.steps],
+            breakdown=["utm_source"],
+        )
+        profiles, sizes = matrices.profiles()
+        self.assertEqual(profiles.n_users, 4)
+        np.testing.assert_array_equal(sizes, [3] * 4)
+        for totals in ["numerators", "denominators"]:
+            np.testing.assert_array_equal(
+                profiles.totals(getattr(profiles, totals)),
+                matrices.totals(getattr(matrices, totals)),
+            )
+        # Grouping profiles again keeps their sizes
+        again, sizes = profiles.profiles()
+        self.assertEqual(again.n_users, 4)
+        np.testing.assert_array_equal(sizes, [3] * 4)
+
+
+class TestSampleTreatmentCounts(unittest.TestCase):
+    def test_counts_fit_profiles(self):
+        sizes = np.array([5, 10, 3])
+        rng = np.random.default_rng(0)
+        counts = sample_treatment_counts(
+            sizes, 100, n_treatment=9, rng=rng
+        )
+        self.assertEqual(counts.shape, (100, 3))
+        self.assertTrue((counts.sum(axis=1) == 9).all())
+        self.assertTrue((counts <= sizes).all())
+        counts = sample_treatment_counts(sizes, 100, rng=rng)
+        self.assertTrue((counts <= sizes).all())
+
+    def test_profile_counts_keep_arm_sizes(self):
+        sizes = np.array([5, 10, 3])
+        rng = np.random.default_rng(0)
+        counts = _draw_profile_counts(
+            sizes,
+            rng,
+            50,
+            n_arms=3,
+            arm_sizes=np.array([6, 7, 5]),
+        )
+        self.assertEqual(len(counts), 2)
+        for arm, expected in zip(counts, [7, 5]):
+            self.assertTrue(
+                (arm.sum(axis=1) == expected).all()
+            )
+        self.assertTrue((sum(counts) <= sizes).all())
+
+
+class TestStratifiedAssignments(unittest.TestCase):
+    def test_shuffles_keep_each_stratum_split(self):
+        strata = np.array([2, 0, 1, 0, 1, 1, 2, 0])
+        variants = np.array([1, 0, 0, 1, 1, 0, 0, 0], np.int8)
+        order, groups = stratify(strata)
+        codes = stratified_assignments(
+            np.random.default_rng(0),
+            200,
+            order,
+            groups,
+            variants,
+        )
+        self.assertEqual(codes.shape, (200, 8))
+        for stratum in range(3):
+            members = strata == stratum
+            np.testing.assert_array_equal(
+                codes[:, members].sum(axis=1),
+                variants[members].sum(),
+            )
+        # Users do move within their stratum
+        self.assertGreater(len(np.unique(codes, axis=0)), 1)
+
+
+class TestStratifiedBreakdown(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        n = 3_000
+        users = rng.integers(0, 400, n)
+        events = pd.DataFrame(
+            {
+                "user_domain_id": users.astype(str),
+                "click_id": users.astype(str),
+                "event_timestamp": (
+                    pd.Timestamp("2024-01-01")
+                    + pd.to_timedelta(
+                        rng.uniform(0, 7, n), unit="D"
+                    )
+                ).astype(str),
+                "page_url_path": rng.choice(
+                    ["/home", "/cart"], n
+                ),
+                "source": np.where(users % 3, "ads", "seo"),
+                "variant": np.where(
+                    users % 2, "Treatment", "Control"
+                ),
+            }
+        )
+        self.conn = duckdb.connect()
+        self.conn.execute(
+            "CREATE TABLE events AS SELECT * FROM events"
+        )
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.conn.close()
+        self.folder.cleanup()
+
+    def power_analysis(self, **kwargs) -> PowerAnalysis:
+        return PowerAnalysis(
+            self.conn,
+            categories={"source": "source"},
+            breakdown={"source"},
+            steps={"home", "cart"},
+            method=PermutationMethod.STRATIFIED,
+            n_permutations=40,
+            seed=0,
+            store=PermutationStore(
+                self.conn, root=self.folder.name
+            ),
+            **kwargs,
+        )
+
+    def test_load_or_run(self):
+        analysis = self.power_analysis()
+        analysis.load_or_run()
+        self.assertIn("source", analysis.user_progress)
+        self.assertEqual(analysis.store.count(), 40)
+        cells = analysis.permutation_index()
+        self.assertEqual(
+            set(cells.get_level_values("source")),
+            {"ads", "seo", "All"},
+        )
+
+    def test_adaptive(self):
+        power = self.power_analysis(
+            tolerance=0.05
+        ).run_power_analysis()
+        self.assertEqual(
+            set(power.index.get_level_values("source")),
+            {"ads", "seo", "All"},
+        )
+
+
+class TestIncrementalReport(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+        self.conn = duckdb.connect()
+        events = self.events(2_000, "2024-01-01", 5)
+        self.conn.execute(
+            "CREATE TABLE events AS SELECT * FROM events"
+        )
+
+    def tearDown(self):
+        self.conn.close()
+
+    def events(
+        self, n: int, start: str, days: int, session: int = 0
+    ):
+        "Events of one `session` per user"
+        users = self.rng.integers(0, 300, n)
+        return pd.DataFrame(
+            {
+                "user_domain_id": users.astype(str),
+                "click_id": (users * 10 + session).astype(
+                    str
+                ),
+                "event_timestamp": (
+                    pd.Timestamp(start)
+                    + pd.to_timedelta(
+                        self.rng.uniform(0, days, n), unit="D"
+                    )
+                ).astype(str),
+                "page_url_path": self.rng.choice(
+                    ["/home", "/cart"], n
+                ),
+                "source": self.rng.choice(["ads", "seo"], n),
+                "variant": np.where(
+                    users % 2, "Treatment", "Control"
+                ),
+            }
+        )
+
+    def add_events(self):
+        """
+        Late events on the second day, and a new day, in new
+        sessions: some users become returning
+        """
+        late = self.events(300, "2024-01-02", 1, session=1)
+        new = self.events(300, "2024-01-06", 1, session=2)
+        for batch in (late, new):
+            self.conn.execute(
+                "INSERT INTO events SELECT * FROM batch"
+            )
+
+    def compare(self, categories: dict):
+        report = FlexibleReport(
+            conn=self.conn,
+            categories=categories,
+            incremental=True,
+            use_cache=False,
+        )
+        report.run()
+        self.add_events()
+        report.run()
+        refreshed = self.conn.execute(
+            "SELECT * FROM conversion_rate"
+        ).df()
+        FlexibleReport(
+            conn=self.conn,
+            categories=categories,
+            use_cache=False,
+        ).run()
+        full = self.conn.execute(
+            "SELECT * FROM conversion_rate"
+        ).df()
+        columns = list(full.columns)
+        pd.testing.assert_frame_equal(
+            *(
+                df[columns]
+                .sort_values(columns)
+                .reset_index(drop=True)
+                for df in (refreshed, full)
+            ),
+            check_dtype=False,
+        )
+
+    def test_refresh_matches_full_run(self):
+        self.compare({"source": "source"})
+
+    def test_refresh_reads_past_the_mark(self):
+        report = FlexibleReport(
+            conn=self.conn,
+            categories={"source": "source"},
+            incremental=True,
+            use_cache=False,
+        )
+        report.run()
+        new = self.events(300, "2024-01-06", 1, session=2)
+        self.conn.execute(
+            "INSERT INTO events SELECT * FROM new"
+        )
+        # Only the new day, from its first event
+        self.assertEqual(
+            report.stale_partitions(),
+            [(pd.Timestamp("2024-01-06").date(), None)],
+        )
+        with self.assertNoLogs(level="INFO"):
+            report.stale_partitions()
+        report.run()
+        # Only the users of the new events were read
+        read = self.conn.execute(
+            "SELECT DISTINCT user_domain_id FROM day_users"
+        ).df()
+        self.assertTrue(
+            read["user_domain_id"]
+            .isin(new["user_domain_id"])
+            .all()
+        )
+        (mark,) = self.conn.execute(
+            """
+            SELECT processed_until
+            FROM conversion_rate_partitions
+            WHERE day = '2024-01-06'
+            """
+        ).fetchone()
+        self.assertEqual(
+            mark,
+            pd.Timestamp(new["event_timestamp"].max()).floor(
+                "us"
+            ),
+        )
+
+    def test_user_categories_run_in_full(self):
+        categories = {
+            "is_returning": """CASE
+                WHEN user_min_session != user_max_session
+                  THEN 'returning'
+                ELSE 'new' END"""
+        }
+        with self.assertWarns(UserWarning):
+            self.compare(categories)
+        with self.assertRaises(ValueError):
+            FlexibleReport(
+                conn=self.conn, categories=categories
+            ).refresh()
+
+
+class TestReportArguments(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        n = 2_000
+        users = rng.integers(0, 300, n)
+        self.events = pd.DataFrame(
+            {
+                "user_domain_id": users.astype(str),
+                "click_id": users.astype(str),
+                "event_timestamp": (
+                    pd.Timestamp("2024-01-01")
+                    + pd.to_timedelta(
+                        rng.uniform(0, 5, n), unit="D"
+                    )
+                ).astype(str),
+                "page_url_path": rng.choice(
+                    ["/home", "/cart"], n
+                ),
+                "source": rng.choice(
+                    ["ads", "seo", "it's"], n
+                ),
+                "variant": np.where(
+                    users % 2, "Treatment", "Control"
+                ),
+            }
+        )
+        self.conn = self.connect(self.events)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def connect(self, events: pd.DataFrame):
+        conn = duckdb.connect()
+        conn.execute(
+            "CREATE TABLE events AS SELECT * FROM events"
+        )
+        return conn
+
+    def report(self, conn=None, **kwargs) -> pd.DataFrame:
+        conn = conn or self.conn
+        FlexibleReport(
+            conn=conn,
+            categories={"source": "source"},
+            use_cache=False,
+            **kwargs,
+        ).run()
+        columns = ["variant", "source", "page_url_path"]
+        return (
+            conn.execute("SELECT * FROM conversion_rate")
+            .df()
+            .sort_values(columns)
+            .reset_index(drop=True)
+        )
+
+    def test_filter_value_with_quote(self):
+        self.assertEqual(
+            filter_conditions({"source": ("it's",)}),
+            (["list_contains(?, source)"], [["it's"]]),
+        )
+        report = self.report(filters={"source": ("it's",)})
+        self.assertEqual(
+            set(report["source"].dropna()), {"it's"}
+        )
+        users = self.events[self.events["source"] == "it's"]
+        self.assertEqual(
+            report.groupby("variant")["visitors"].max().sum(),
+            users["user_domain_id"].nunique(),
+        )
+
+    def test_empty_filter_keeps_no_event(self):
+        self.assertTrue(
+            self.report(filters={"source": ()}).empty
+        )
+
+    def test_matches_inline_sql(self):
+        dates = dict(
+            start_date="2024-01-02", end_date="2024-01-04"
+        )
+        self.assertEqual(
+            date_window(**dates),
+            (
+                "event_timestamp BETWEEN CAST(? AS TIMESTAMP)"
+                " AND CAST(? AS TIMESTAMP)",
+                ["2024-01-02", "2024-01-04"],
+            ),
+        )
+        self.assertEqual(date_window("2024-01-02"), ("", []))
+        bound = self.report(
+            filters={"source": ("ads", "seo")}, **dates
+        )
+        # The conditions the report used to write inline
+        events = self.conn.execute(
+            """
+            SELECT * FROM events
+            WHERE event_timestamp
+                BETWEEN '2024-01-02' AND '2024-01-04'
+                AND source IN ('ads', 'seo')
+            """
+        ).df()
+        inline = self.connect(events)
+        pd.testing.assert_frame_equal(
+            bound, self.report(inline), check_dtype=False
+        )
+        inline.close()
+
+
+class TestLocalTime(unittest.TestCase):
+    def test_matches_pandas_across_dst(self):
+        # Around the spring DST change of each timezone, and
+        # at the New Year, for the week of the year
+        utc = pd.to_datetime(
+            [
+                "2024-03-31 00:30",
+                "2024-03-31 01:30",
+                "2024-03-10 06:30",
+                "2024-03-10 07:30",
+                "2024-12-31 23:30",
+                "2024-06-01 12:00",
+                "2024-06-01 12:00",
+            ]
+        )
+        zones = [
+            "Europe/Berlin",
+            "Europe/Berlin",
+            "America/New_York",
+            "America/New_York",
+            "Asia/Kolkata",
+            "Mars/Olympus_Mons",
+            None,
+        ]
+        events = pd.DataFrame(
+            {
+                "user_domain_id": list("abcdefg"),
+                "event_timestamp": utc.astype(str),
+                "geo_timezone": zones,
+            }
+        )
+        conn = duckdb.connect()
+        conn.execute(
+            "CREATE TABLE events AS SELECT * FROM events"
+        )
+        with self.assertWarns(UserWarning):
+            self.assertEqual(refresh_local_time(conn), 7)
+        self.assertEqual(refresh_local_time(conn), 0)
+        # The events table is left as it was
+        self.assertListEqual(
+            list(
+                conn.execute("SELECT * FROM events LIMIT 0")
+                .df()
+                .columns
+            ),
+            list(events.columns),
+        )
+        local = (
+            conn.execute(
+                "SELECT * FROM event_local_time "
+                "ORDER BY user_domain_id"
+            )
+            .df()
+            .reset_index(drop=True)
+        )
+        # Unknown timezones, and none, stay in UTC
+        known = [
+            "UTC" if z in (None, "Mars/Olympus_Mons") else z
+            for z in zones
+        ]
+        expected = pd.DatetimeIndex(
+            [
+                t.tz_localize("UTC")
+                .tz_convert(z)
+                .tz_localize(None)
+                for t, z in zip(utc, known)
+            ]
+        )
+        np.testing.assert_array_equal(
+            local["local_hour"], expected.hour
+        )
+        np.testing.assert_array_equal(
+            local["local_weekday"],
+            (expected.dayofweek + 1) % 7,
+        )
+        np.testing.assert_array_equal(
+            local["week_of_year"],
+            expected.isocalendar().week.to_numpy(),
+        )
+        conn.close()
+
+
+class TestUserDimensions(unittest.TestCase):
+    # Definitions over windows of the events of each user,
+    # before the user_dimensions table
+    WINDOWS = {
+        "international": """CASE
+            WHEN MIN(geo_country) OVER (
+                    PARTITION BY user_domain_id)
+                != MAX(geo_country) OVER (
+                    PARTITION BY user_domain_id)
+              THEN 'international'
+            ELSE 'domestic' END""",
+        "interface": """CASE
+            WHEN MIN(device_type) OVER (
+                    PARTITION BY user_domain_id)
+                != MAX(device_type) OVER (
+                    PARTITION BY user_domain_id)
+              THEN 'hybrid'
+            ELSE device_type END""",
+        "activity_level": """CASE
+            WHEN COUNT(1) OVER (
+                    PARTITION BY user_domain_id) < 3
+              THEN 'low_activity'
+            WHEN COUNT(1) OVER (
+                    PARTITION BY user_domain_id) < 30
+              THEN 'some_activity'
+            ELSE 'high_activity' END""",
+    }
+
+    def events(self, n, start, seed):
+        rng = np.random.default_rng(seed)
+        return pd.DataFrame(
+            {
+                "user_domain_id": rng.geometric(0.02, n),
+                "event_timestamp": pd.Timestamp(start)
+                + pd.to_timedelta(
+                    rng.integers(0, 3 * 86400, n), unit="s"
+                ),
+                "geo_country": rng.choice(
+                    ["US", "FR", None], n, p=[0.8, 0.15, 0.05]
+                ),
+                "device_type": rng.choice(
+                    ["desktop", "mobile"], n, p=[0.9, 0.1]
+                ),
+                "click_id": rng.integers(0, 200, n),
+            }
+        )
+
+    def compare(self, conn):
+        refresh_user_dimensions(conn)
+        names = list(self.WINDOWS)
+        windows = ", ".join(
+            f"{self.WINDOWS[name]} AS {name}"
+            for name in names
+        )
+        dimensions = ", ".join(
+            f"{CATEGORY_EXAMPLES[name]} AS {name}"
+            for name in names
+        )
+        order = "ORDER BY 1, 2, 3"
+        before = conn.execute(
+            "SELECT user_domain_id, event_timestamp, "
+            f"click_id, {windows} FROM events {order}"
+        ).df()
+        after = conn.execute(
+            "SELECT user_domain_id, event_timestamp, "
+            f"click_id, {dimensions} FROM events "
+            f"LEFT JOIN user_dimensions USING "
+            f"(user_domain_id) {order}"
+        ).df()
+        pd.testing.assert_frame_equal(before, after)
+        return before
+
+    def test_matches_window_definitions(self):
+        conn = duckdb.connect()
+        batch = self.events(2_000, "2024-01-01", 0)
+        conn.execute(
+            "CREATE TABLE events AS SELECT * FROM batch"
+        )
+        before = self.compare(conn)
+        for name in self.WINDOWS:
+            self.assertGreater(before[name].nunique(), 1)
+        # Late and new events, on old and new days
+        batch = self.events(500, "2024-01-02", 1)
+        conn.execute("INSERT INTO events SELECT * FROM batch")
+        self.compare(conn)
+        conn.close()
+
+
+class TestReportCache(unittest.TestCase):
+    def test_key_follows_events_version(self):
+        cache = ReportCache()
+        conn = duckdb.connect()
+        conn.execute(
+            """
+            CREATE TABLE events AS
+            SELECT range AS user_domain_id
+                , 'a' AS source
+                , TIMESTAMP '2024-01-01'
+                    + range * INTERVAL 1 MINUTE
+                    AS event_timestamp
+            FROM range(100)
+            """
+        )
+        statements = [("SELECT source FROM events", [])]
+        keys = [cache.key(conn, statements)]
+        self.assertEqual(cache.key(conn, statements), keys[0])
+        conn.execute(
+            "INSERT INTO events VALUES "
+            "(100, 'a', TIMESTAMP '2024-01-02')"
+        )
+        keys.append(cache.key(conn, statements))
+        # Same rows and last timestamp: writers say so
+        conn.execute(
+            "UPDATE events SET source = 'b' "
+            "WHERE user_domain_id = 3"
+        )
+        cache.events_changed(conn)
+        keys.append(cache.key(conn, statements))
+        # Same events, but tables of another connection
+        events = conn.execute("SELECT * FROM events").df()
+        conn.close()
+        other = duckdb.connect()
+        other.execute(
+            "CREATE TABLE events AS SELECT * FROM events"
+        )
+        keys.append(cache.key(other, statements))
+        self.assertEqual(len(set(keys)), 4)
+        # The cache leaves the connection's tables alone
+        self.assertEqual(
+            other.execute(
+                "SELECT COUNT(*) FROM information_schema.tables"
+            ).fetchall(),
+            [(1,)],
+        )
+        other.close()
+
+
+class TestQuantileInterval(unittest.TestCase):
+    def test_interval_shrinks_and_covers(self):
+        rng = np.random.default_rng(0)
+        samples = rng.normal(size=(10_000, 2))
+        samples[:, 1] = np.nan
+        small, small_width = quantile_interval(
+            samples[:1_000], 0.8
+        )
+        large, large_width = quantile_interval(samples, 0.8)
+        self.assertLess(large_width[0], small_width[0])
+        self.assertLess(
+            abs(large[0] - 0.8416), large_width[0]
+        )
+        self.assertTrue(np.isnan(large[1]))
+
+
+class TestQuantileSketch(unittest.TestCase):
+    def test_merged_quantiles_within_error(self):
+        rng = np.random.default_rng(0)
+        values = rng.normal(size=(8_000, 3))
+        first = QuantileSketch(3, k=128, seed=0)
+        second = QuantileSketch(3, k=128, seed=1)
+        for block in np.split(values[:4_000], 4):
+            first.update(block)
+        second.update(values[4_000:])
+        merged = first.merge(second)
+        self.assertEqual(merged.n, 8_000)
+        for q in [0.2, 0.5, 0.8]:
+            ranks = (values < merged.quantile(q)).mean(axis=0)
+            self.assertTrue(
+                (abs(ranks - q) <= merged.rank_error).all()
+            )
+        # Pooling rows gives one row with all their values
+        pooled = merged.group(np.array([0, 0, 1]))
+        self.assertEqual(pooled.quantile(0.5).shape, (2,))
+
+
+class TestSampleSizePlanner(unittest.TestCase):
+    def test_sample_size_inverts_mde(self):
+        baseline = np.array([0.1, 0.3, 0.9])
+        n = sample_size(baseline, 0.02, alpha=0.05, beta=0.2)
+        # Textbook value for a 10% baseline, 50/50 split
+        self.assertAlmostEqual(n[0] / 2, 3_532, delta=1)
+        np.testing.assert_allclose(
+            minimum_detectable_effect(baseline, n),
+            0.02,
+            rtol=1e-3,
+        )
+
+    def test_grid(self):
+        planner = SampleSizePlanner(days=7)
+        planner.baselines = pd.DataFrame(
+            {
+                "baseline": [0.1, 0.3],
+                "visitors": [7_000.0, 14_000.0],
+                "visitors_per_day": [1_000.0, 2_000.0],
+            },
+            index=pd.Index(
+                ["cart", "home"], name="page_url_path"
+            ),
+        )
+        plan = planner.sample_sizes(
+            alphas=(0.05, 0.01),
+            betas=(0.2,),
+            effects=(0.01, 0.02),
+        )
+        self.assertEqual(len(plan), 2 * 2 * 1 * 2)
+        row = plan.loc[("home", 0.01, 0.2, 0.02)]
+        self.assertEqual(
+            row["days"], np.ceil(row["sample_size"] / 2_000)
+        )
+        self.assertEqual(
+            row["sample_size"],
+            sample_size(0.3, 0.02, alpha=0.01, beta=0.2),
+        )
+
+
+class TestPoissonBootstrap(unittest.TestCase):
+    def test_matches_welch_standard_error(self):
+        rng = np.random.default_rng(0)
+        n = 4_000
+        user_progress = pd.DataFrame(
+            {
+                "user_domain_id": np.arange(n).astype(str),
+                "variant": rng.choice(
+                    ["Control", "Treatment"], n
+                ),
+                "reach_cart": rng.random(n) < 0.3,
+            }
+        )
+        compact = CompactProgress.from_user_progress(
+            user_progress, ["reach_cart"]
+        )
+        matrices = ProgressMatrices.from_compact(
+            compact, ["reach_cart"]
+        )
+        variants = compact.user_variants()
+        bootstrap = poisson_bootstrap(
+            matrices, variants, 1_000, seed=1, block_size=300
+        )
+        counts = user_progress.groupby("variant")[
+            "reach_cart"
+        ]
+        welch = welch_t_test(
+            counts.sum().to_numpy(),
+            counts.count().to_numpy(),
+        )
+        self.assertAlmostEqual(
+            bootstrap["bootstrap_stdev"].iloc[0],
+            welch["stdev"],
+            delta=0.1 * welch["stdev"],
+        )
+        self.assertLess(
+            bootstrap["ci_lower"].iloc[0], welch["difference"]
+        )
+        self.assertGreater(
+            bootstrap["ci_upper"].iloc[0], welch["difference"]
+        )
+        pd.testing.assert_frame_equal(
+            bootstrap,
+            poisson_bootstrap(
+                matrices,
+                variants,
+                1_000,
+                seed=1,
+                block_size=300,
+            ),
+        )
+
+    def test_averages_are_means_of_user_means(self):
+        rng = np.random.default_rng(0)
+        n = 4_000
+        users = rng.integers(0, n // 2, n)
+        delays = rng.exponential(30.0, n)
+        delays[rng.random(n) < 0.2] = np.nan
+        user_progress = pd.DataFrame(
+            {
+                "user_domain_id": users.astype(str),
+                "variant": np.where(
+                    users % 2 == 0, "Control", "Treatment"
+                ),
+                "reach_cart": rng.random(n) < 0.3,
+                "delay_cart": delays,
+            }
+        )
+        compact = CompactProgress.from_user_progress(
+            user_progress, ["reach_cart"], ["delay_cart"]
+        )
+        matrices = ProgressMatrices.from_averages(
+            compact, ["delay_cart"]
+        )
+        variants = compact.user_variants()
+        per_user = ["variant", "user_domain_id"]
+        means = (
+            user_progress.groupby(per_user)
+            .delay_cart.mean()
+            .dropna()
+        )
+        for arm, variant in enumerate(means.index.levels[0]):
+            rows = variants == arm
+            self.assertAlmostEqual(
+                matrices.numerators[rows].sum()
+                / matrices.denominators[rows].sum(),
+                means[variant].mean(),
+                places=3,
+            )
+        bootstrap = poisson_bootstrap(
+            matrices, variants, 1_000, seed=1
+        )
+        stdev = np.sqrt(
+            (
+                means.groupby("variant").var()
+                / means.groupby("variant").count()
+            ).sum()
+        )
+        self.assertAlmostEqual(
+            bootstrap["bootstrap_stdev"].iloc[0],
+            stdev,
+            delta=0.1 * stdev,
+        )
+
+
+class TestMSPRT(unittest.TestCase):
+    def test_always_valid_under_daily_looks(self):
+        rng = np.random.default_rng(0)
+        # 1,000 A/A tests, looked at after each of 30 days
+        visitors = np.full((1_000, 30, 2), 500)
+        conversions = rng.binomial(visitors, 0.2)
+        stats = msprt(
+            conversions.cumsum(axis=1),
+            visitors.cumsum(axis=1),
+            tau=0.02,
+        )
+        p_value = np.minimum.accumulate(
+            stats["always_valid_p-value"], axis=1
+        )
+        # Peeking every day keeps false positives under alpha
+        self.assertLess((p_value[:, -1] < 0.05).mean(), 0.05)
+        # whereas a t-test at every look would not
+        t_test = welch_t_test(
+            conversions.cumsum(axis=1),
+            visitors.cumsum(axis=1),
+        )
+        self.assertGreater(
+            (t_test["p-value"] < 0.05).any(axis=1).mean(), 0.1
+        )
+
+
+class TestSequentialTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        n_users, n = 300, 3_000
+        users = rng.integers(0, n_users, n)
+        treated = users % 2 == 1
+        # Users arrive on different days
+        arrival = rng.integers(0, 5, n_users)
+        arrival[0] = 0
+        days = arrival[users] + rng.uniform(
+            0, 5 - arrival[users]
+        )
+        # Some users change country from one event to the
+        # next, and one travels from the fourth day on
+        mixed = (rng.random(n_users) < 0.2)[users]
+        country = np.where(
+            mixed & (rng.random(n) < 0.5), "FR", "US"
+        )
+        country[users == 0] = "US"
+        country[(users == 0) & (days >= 3)] = "FR"
+        self.events = pd.DataFrame(
+            {
+                "user_domain_id": [f"u{u}" for u in users],
+                "click_id": np.arange(n),
+                "event_timestamp": pd.Timestamp("2024-01-01")
+                + pd.to_timedelta(days, unit="D"),
+                "variant": np.where(
+                    treated, "Treatment", "Control"
+                ),
+                "geo_country": country,
+                "device_type": "desktop",
+                "page_url_path": np.where(
+                    rng.random(n)
+                    < np.where(treated, 0.4, 0.25),
+                    "/cart",
+                    "/home",
+                ),
+            }
+        )
+        self.conn = duckdb.connect()
+        events = self.events
+        self.conn.execute(
+            "CREATE TABLE events AS SELECT * FROM events"
+        )
+        self.test = SequentialTest(
+            conn=self.conn,
+            categories={
+                "international": CATEGORY_EXAMPLES[
+                    "international"
+                ]
+            },
+            breakdown={"international"},
+            steps={"home", "cart"},
+        )
+
+    def tearDown(self):
+        self.conn.close()
+
+    def recompute(self, days: int) -> pd.DataFrame:
+        "Totals over the first `days` days, in one pass"
+        events = self.events.assign(
+            day=self.events["event_timestamp"].dt.floor("D")
+        )
+        events["day"] = (
+            events["day"] - events["day"].min()
+        ).dt.days
+        events = events[events["day"] < days]
+        # Countries up to the first day of each user
+        first = events.groupby("user_domain_id")["day"].min()
+        known = events[
+            events["day"]
+            <= events["user_domain_id"].map(first)
+        ].groupby("user_domain_id")["geo_country"]
+        international = (known.nunique() > 1).map(
+            {True: "international", False: "domestic"}
+        )
+        users = events.groupby(
+            ["user_domain_id", "variant"]
+        ).agg(
+            reach_home=(
+                "page_url_path",
+                lambda pages: (pages == "/home").any(),
+            ),
+            reach_cart=(
+                "page_url_path",
+                lambda pages: (pages == "/cart").any(),
+            ),
+        )
+        users = users.reset_index()
+        users["international"] = users["user_domain_id"].map(
+            international
+        )
+        totals = pd.concat(
+            [users, users.assign(international="All")]
+        )
+        return (
+            totals.groupby(["variant", "international"])
+            .agg(
+                visitors=("user_domain_id", "size"),
+                reach_home=("reach_home", "sum"),
+                reach_cart=("reach_cart", "sum"),
+            )
+            .reset_index()
+        )
+
+    def test_daily_updates_match_one_pass(self):
+        p_value = SequentialStats.P_VALUE.value
+        p_values = []
+        for days, day in enumerate(
+            pd.date_range("2024-01-01", periods=5), start=1
+        ):
+            p_values.append(self.test.update(day)[p_value])
+            totals = self.conn.execute(
+                """
+                SELECT variant, international, visitors
+                    , reach_home, reach_cart
+                FROM sequential_totals
+                ORDER BY variant, international
+                """
+            ).df()
+            expected = self.recompute(days)
+            pd.testing.assert_frame_equal(
+                totals, expected, check_dtype=False
+            )
+        # The always-valid p-value never goes back up
+        p_values = pd.concat(p_values, axis=1)
+        self.assertFalse(
+            (p_values.diff(axis=1) > 0).any().any()
+        )
+        self.assertFalse(p_values.iloc[:, -1].isna().any())
+
+    def test_users_keep_their_first_cell(self):
+        self.test.run()
+        cells = self.conn.execute(
+            """
+            SELECT international FROM sequential_users
+            WHERE user_domain_id = 'u0'
+                AND international != 'All'
+            """
+        ).fetchall()
+        self.assertEqual(cells, [("domestic",)])
+        # whereas all their events make them international
+        (now,) = self.conn.execute(
+            """
+            SELECT user_min_country != user_max_country
+            FROM user_dimensions
+            WHERE user_domain_id = 'u0'
+            """
+        ).fetchone()
+        self.assertTrue(now)
+        # Looks never read later events
+        self.test.reset()
+        self.test.update("2024-01-01")
+        self.assertEqual(
+            self.conn.execute(
+                "SELECT COUNT(*) FROM sequential_dimensions"
+            ).fetchone()[0],
+            self.recompute(1)
+            .query("international == 'All'")["visitors"]
+            .sum(),
+        )
+
+
+class TestDatabaseMethod(unittest.TestCase):
+    metrics = ["reach_home", "reach_cart"]
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        n = 4_000
+        self.user_progress = pd.DataFrame(
+            {
+                "user_domain_id": [f"u{i}" for i in range(n)],
+                "variant": rng.choice(
+                    ["Control", "Treatment"], n
+                ),
+                "utm_source": rng.choice(
+                    ["ads", "seo", None], n, p=[0.5, 0.4, 0.1]
+                ),
+                "reach_home": rng.random(n) < 0.8,
+                "reach_cart": rng.random(n) < 0.2,
+            }
+        )
+        self.conn = duckdb.connect()
+        user_progress = self.user_progress
+        self.conn.execute(
+            """
+            CREATE TABLE user_progress AS
+            SELECT * FROM user_progress
+            """
+        )
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.conn.close()
+        self.folder.cleanup()
+
+    def counts(self, n: int, n_arms: int = 2) -> tuple:
+        index = database_index(
+            self.conn, self.metrics, ["utm_source"]
+        )
+        table = database_user_cells(
+            self.conn, self.metrics, ["utm_source"]
+        )
+        return index, database_counts(
+            self.conn,
+            index,
+            self.metrics,
+            start=0,
+            n=n,
+            seed=1,
+            breakdown=["utm_source"],
+            n_arms=n_arms,
+            table=table,
+        )
+
+    def test_aggregates_match_engine(self):
+        matrices = ProgressMatrices.from_user_progress(
+            self.user_progress,
+            metrics=self.metrics,
+            breakdown=["utm_source"],
+        )
+        index, (numerators, denominators) = self.counts(20)
+        self.assertTrue(index.equals(matrices.index))
+        # The arms of every user, from the same hash
+        arms = (
+            self.conn.execute(
+                """
+                SELECT (hash(p.range, user_domain_id, 1)
+                    >> 32) % 2
+                FROM user_progress
+                CROSS JOIN range(0, 20) p
+                ORDER BY p.range, rowid
+                """
+            )
+            .df()
+            .to_numpy()
+            .reshape(20, -1)
+        )
+        expected = matrices.aggregate(arms, n_arms=2)
+        np.testing.assert_array_equal(numerators, expected[0])
+        np.testing.assert_array_equal(
+            denominators, expected[1]
+        )
+        # Whatever the split, arms add up to the observed
+        # aggregates of every cell
+        np.testing.assert_array_equal(
+            numerators.sum(axis=-1),
+            np.tile(
+                matrices.totals(matrices.numerators), (20, 1)
+            ),
+        )
+
+    def test_power_matches_engine(self):
+        effect = PowerAnalyticStats.REL_DET_EFFECT.value
+        power = {}
+        for method in [
+            PermutationMethod.USERS,
+            PermutationMethod.DATABASE,
+        ]:
+            analysis = PowerAnalysis(
+                self.conn,
+                categories={"utm_source": "utm_source"},
+                breakdown={"utm_source"},
+                steps={"home", "cart"},
+                method=method,
+                n_permutations=1_000,
+                seed=0,
+                store=PermutationStore(
+                    self.conn, root=self.folder.name
+                ),
+            )
+            analysis.load_or_run()
+            power[method] = analysis.power_by_cell(
+                analysis.read_permutation_tests()
+            )[effect]
+        users = power[PermutationMethod.USERS]
+        database = power[PermutationMethod.DATABASE]
+        np.testing.assert_allclose(
+            database.reindex(users.index), users, rtol=0.1
+        )
+
+    def test_modulo_split_balances_three_arms(self):
+        n_users = len(self.user_progress)
+        _, (_, denominators) = self.counts(300, n_arms=3)
+        visitors = denominators[:, ::2]
+        cells = visitors.sum(axis=-1)
+        # Every user lands in exactly one arm
+        self.assertTrue((cells == cells[0]).all())
+        self.assertEqual(cells[0, -1], n_users)
+        # One third of each cell in every arm, on average,
+        # with multinomial spread from one split to the next
+        shares = visitors / cells[..., None]
+        np.testing.assert_allclose(
+            shares.mean(axis=0), 1 / 3, atol=0.01
+        )
+        spread = np.sqrt(cells[0] * 2 / 9)
+        np.testing.assert_allclose(
+            visitors.std(axis=0),
+            np.repeat(spread[:, None], 3, axis=1),
+            rtol=0.15,
+        )
+
+
+class TestPermutationStore(unittest.TestCase):
+    def setUp(self):
+        self.conn = duckdb.connect()
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.conn.close()
+        self.folder.cleanup()
+
+    def store(self, key: str = None, **kwargs):
+        return PermutationStore(
+            self.conn,
+            root=self.folder.name,
+            key=key,
+            **kwargs,
+        )
+
+    def block(self, permutations: range) -> pd.DataFrame:
+        "Tests of every cell, in a non-alphabetical order"
+        index = pd.MultiIndex.from_product(
+            [
+                permutations,
+                ["seo", "ads", "All"],
+                ["reach_home", "reach_cart"],
+            ],
+            names=["permutation", "utm_source", "metric"],
+        )
+        rng = np.random.default_rng(permutations.start)
+        tests = pd.DataFrame(
+            rng.random((len(index), len(TEST_COLUMNS))),
+            columns=TEST_COLUMNS,
+            index=index,
+        )
+        tests["significant"] = tests["p-value"] < 0.05
+        return tests.reset_index("permutation")
+
+    def test_round_trip(self):
+        store = self.store("a")
+        written = [
+            self.block(range(0, 3)),
+            self.block(range(3, 5)),
+        ]
+        for block, tests in enumerate(written):
+            store.write(tests, block, 3 - block)
+        self.assertEqual(store.blocks(), {0: 3, 1: 2})
+        self.assertEqual(store.count(), 5)
+        # Rows come back in the order they were written,
+        # within each permutation
+        expected = pd.concat(written)[TEST_COLUMNS]
+        pd.testing.assert_frame_equal(
+            store.read(), expected, check_dtype=False
+        )
+        pd.testing.assert_frame_equal(
+            store.read(
+                columns=["p-value"],
+                where={"utm_source": ("All", "seo")},
+                permutations=2,
+            ),
+            expected[
+                expected.index.isin(["seo", "All"], level=0)
+            ][["p-value"]].iloc[:8],
+            check_dtype=False,
+        )
+        pd.testing.assert_frame_equal(
+            store.read(block=1),
+            written[1][TEST_COLUMNS],
+            check_dtype=False,
+        )
+
+    def test_lru_eviction(self):
+        stores = [self.store(key) for key in "abc"]
+        for age, store in enumerate(stores):
+            store.write(self.block(range(0, 5)), 0, 5)
+            os.utime(store.folder, (age, age))
+        size = sum(
+            os.path.getsize(path)
+            for path in glob.glob(stores[0].files)
+        )
+        # The oldest, a, was used again: b goes first
+        stores[0].touch()
+        current = self.store("c", max_bytes=int(2.5 * size))
+        current.evict()
+        self.assertEqual(
+            [store.exists() for store in stores],
+            [True, False, True],
+        )
+        # The current analysis is never evicted
+        self.store("c", max_bytes=0).evict()
+        self.assertEqual(
+            [store.exists() for store in stores],
+            [False, False, True],
+        )
+
+
+class TestStoredPowerAnalysis(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        n = 2_000
+        user_progress = pd.DataFrame(
+            {
+                "user_domain_id": [f"u{i}" for i in range(n)],
+                "variant": rng.choice(
+                    ["Control", "Treatment"], n
+                ),
+                "utm_source": rng.choice(["ads", "seo"], n),
+                "reach_home": rng.random(n) < 0.8,
+                "reach_cart": rng.random(n) < 0.2,
+            }
+        )
+        self.conn = duckdb.connect()
+        self.conn.execute(
+            """
+            CREATE TABLE user_progress AS
+            SELECT * FROM user_progress
+            """
+        )
+        self.folder = tempfile.TemporaryDirectory()
+        # Blocks of 100 permutations in the database
+        self.module = sys.modules[PowerAnalysis.__module__]
+        patcher = patch.object(
+            self.module, "PERMUTATION_BLOCK_SIZE", 100
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.conn.close()
+        self.folder.cleanup()
+
+    def analysis(self, root=None, **kwargs) -> PowerAnalysis:
+        settings = dict(
+            categories={"utm_source": "utm_source"},
+            breakdown={"utm_source"},
+            steps={"home", "cart"},
+            method=PermutationMethod.DATABASE,
+            n_permutations=300,
+            seed=0,
+        )
+        settings.update(kwargs)
+        analysis = PowerAnalysis(
+            self.conn,
+            store=PermutationStore(
+                self.conn, root=root or self.folder.name
+            ),
+            **settings,
+        )
+        analysis.load_user_progress()
+        return analysis
+
+    def test_resume_partial_run(self):
+        first = self.analysis()
+        first.stream_permutation_tests()
+        self.assertEqual(first.store.count(), 300)
+        blocks = sorted(glob.glob(first.store.files))
+        written = [os.path.getmtime(path) for path in blocks]
+        before = first.read_permutation_tests()
+
+        resumed = self.analysis(n_permutations=600)
+        with self.assertLogs(level="INFO") as logs:
+            resumed.stream_permutation_tests()
+        self.assertIn(
+            "Reusing 3 stored blocks", "".join(logs.output)
+        )
+        self.assertEqual(resumed.store.count(), 600)
+        # Stored blocks are kept as they were
+        self.assertEqual(
+            [os.path.getmtime(path) for path in blocks],
+            written,
+        )
+        pd.testing.assert_frame_equal(
+            resumed.read_permutation_tests(permutations=300),
+            before,
+        )
+        # and the whole run is the same as in one go
+        with tempfile.TemporaryDirectory() as folder:
+            fresh = self.analysis(
+                root=folder, n_permutations=600
+            )
+            fresh.stream_permutation_tests()
+            pd.testing.assert_frame_equal(
+                resumed.read_permutation_tests(),
+                fresh.read_permutation_tests(),
+            )
+
+    def test_fingerprint_follows_inputs(self):
+        key = self.analysis().fingerprint()
+        self.assertEqual(self.analysis().fingerprint(), key)
+        self.assertNotEqual(
+            self.analysis(seed=1).fingerprint(), key
+        )
+        self.assertNotEqual(
+            self.analysis(breakdown=None).fingerprint(), key
+        )
+        self.assertNotEqual(
+            self.analysis(
+                arms=("Control", "Treatment", "B")
+            ).fingerprint(),
+            key,
+        )
+        # More permutations extend the same stored run
+        self.assertEqual(
+            self.analysis(n_permutations=600).fingerprint(),
+            key,
+        )
+
+
+class TestThreeArms(unittest.TestCase):
+    arms = ("Control", "Treatment", "Treatment B")
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        n = 6_000
+        variant = rng.choice(self.arms, n)
+        # Treatment converts like Control, Treatment B more
+        cart = np.where(variant == "Treatment B", 0.3, 0.2)
+        user_progress = pd.DataFrame(
+            {
+                "user_domain_id": [f"u{i}" for i in range(n)],
+                "variant": variant,
+                "utm_source": rng.choice(["ads", "seo"], n),
+                "reach_home": rng.random(n) < 0.8,
+                "reach_cart": rng.random(n) < cart,
+            }
+        )
+        self.conn = duckdb.connect()
+        self.conn.execute(
+            """
+            CREATE TABLE user_progress AS
+            SELECT * FROM user_progress
+            """
+        )
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.conn.close()
+        self.folder.cleanup()
+
+    def analysis(self, **kwargs) -> PowerAnalysis:
+        analysis = PowerAnalysis(
+            self.conn,
+            categories={"utm_source": "utm_source"},
+            steps={"home", "cart"},
+            n_permutations=200,
+            seed=0,
+            arms=self.arms,
+            store=PermutationStore(
+                self.conn, root=self.folder.name
+            ),
+            **kwargs,
+        )
+        analysis.load_user_progress()
+        return analysis
+
+    def test_only_the_effective_arm_is_significant(self):
+        analysis = self.analysis()
+        bootstrap = poisson_bootstrap(
+            analysis.progress_matrices(per_user=True),
+            analysis.compact_progress.user_variants(),
+            1_000,
+            seed=1,
+            arms=self.arms,
+        ).xs("reach_cart", level=METRIC_NAME)
+        self.assertEqual(
+            list(bootstrap.index), list(self.arms[1:])
+        )
+        # Treatment B converts 10 points more than Control
+        effect = bootstrap.loc["Treatment B"]
+        self.assertGreater(effect["ci_lower"], 0.05)
+        self.assertLess(effect["ci_lower"], 0.1)
+        self.assertGreater(effect["ci_upper"], 0.1)
+        # Treatment converts like Control
+        same = bootstrap.loc["Treatment"]
+        self.assertLess(same["ci_lower"], 0)
+        self.assertGreater(same["ci_upper"], 0)
+
+    def test_permutations_compare_every_arm(self):
+        for method in [
+            PermutationMethod.USERS,
+            PermutationMethod.HYPERGEOMETRIC,
+            PermutationMethod.STRATIFIED,
+            PermutationMethod.DATABASE,
+        ]:
+            with self.subTest(method=method.value):
+                analysis = self.analysis(method=method)
+                tests = analysis.compute_permutation_test()
+                self.assertEqual(
+                    set(
+                        tests.index.get_level_values(VARIANT)
+                    ),
+                    set(self.arms[1:]),
+                )
+                self.assertEqual(
+                    len(tests),
+                    200 * len(analysis.permutation_index()),
+                )
+
+
+class TestDunnettTest(unittest.TestCase):
+    def test_two_arms_match_welch(self):
+        conversions = np.array([[100, 130]])
+        visitors = np.array([[1_000, 1_100]])
+        dunnett = dunnett_test(conversions, visitors)
+        welch = welch_t_test(conversions, visitors)
+        np.testing.assert_allclose(
+            dunnett["adjusted_p-value"][..., 0],
+            welch["p-value"],
+            rtol=1e-2,
+        )
+
+    def test_familywise_error_under_alpha(self):
+        rng = np.random.default_rng(0)
+        # 2,000 A/A/A/A tests: three arms against Control
+        visitors = np.full((2_000, 4), 2_000)
+        conversions = rng.binomial(visitors, 0.1)
+        stats = dunnett_test(conversions, visitors)
+        self.assertEqual(stats["p-value"].shape, (2_000, 3))
+        self.assertTrue(
+            (
+                stats["adjusted_p-value"] >= stats["p-value"]
+            ).all()
+        )
+        any_significant = stats["significant"].any(axis=1)
+        self.assertAlmostEqual(
+            any_significant.mean(), 0.05, delta=0.015
+        )
+        # Unadjusted, some arm looks significant more often
+        raw = (stats["p-value"] < 0.05).any(axis=1)
+        self.assertGreater(raw.mean(), 0.1)
+
+
 if __name__ == "__main__":
     unittest.main()
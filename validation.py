@@ -0,0 +1,180 @@
+import sys, time, inspect, logging, weakref
+from functools import wraps
+from dataclasses import dataclass, field
+import pandas as pd
+from pandera import DataFrameSchema
+
+sys.path.append("..")
+sys.path.append("permutation")
+from utils.params import (
+    ABTestSettings,
+    ValidationMode,
+    VALIDATION_MODE,
+    VALIDATION_SAMPLE_ROWS,
+)
+
+
+@dataclass
+class ValidationPolicy:
+    """
+    Decides how much of each dataframe the pandera schemas
+    check, and records the time they take.
+    `mode` applies to every check, unless the object whose
+    method is checked (an ABTestSettings) sets its own
+    `validation`.
+    The `once` mode runs each check of a method once per
+    object until `reset`, which runs start; checks of free
+    functions have no object, and always run.
+    """
+
+    mode: ValidationMode = VALIDATION_MODE
+    sample_rows: int = VALIDATION_SAMPLE_ROWS
+    seed: int = None
+    # Checks already run, for the `once` mode: by object id,
+    # a weak reference to the object and the checks' names
+    seen: dict = field(default_factory=dict)
+    # Calls and seconds spent, for each check
+    timings: dict = field(default_factory=dict)
+
+    def reset(self):
+        "Start a new run: checks run once more, timings clear"
+        self.seen.clear()
+        self.timings.clear()
+
+    def validate(
+        self,
+        schema: DataFrameSchema,
+        df: pd.DataFrame,
+        name: str,
+        owner=None,
+    ) -> pd.DataFrame:
+        mode = self.mode
+        if (
+            isinstance(owner, ABTestSettings)
+            and owner.validation
+        ):
+            mode = owner.validation
+        # Modes can also be given by their value
+        mode = ValidationMode(getattr(mode, "value", mode))
+        if mode is ValidationMode.OFF:
+            return df
+        if mode is ValidationMode.ONCE and owner is not None:
+            ref, names = self.seen.get(
+                id(owner), (None, None)
+            )
+            if ref is None or ref() is not owner:
+                # A new object, even if it reuses an old id
+                names = set()
+                self.seen[id(owner)] = (
+                    weakref.ref(owner),
+                    names,
+                )
+            if name in names:
+                return df
+            names.add(name)
+        start = time.perf_counter()
+        if (
+            mode is ValidationMode.SAMPLE
+            and len(df) > self.sample_rows
+        ):
+            schema.validate(
+                df,
+                sample=self.sample_rows,
+                random_state=self.seed,
+            )
+        else:
+            schema.validate(df)
+        elapsed = time.perf_counter() - start
+        calls, seconds = self.timings.get(name, (0, 0.0))
+        self.timings[name] = (calls + 1, seconds + elapsed)
+        logging.debug(f"Validated {name} in {elapsed:.4f}s")
+        return df
+
+    def report(self) -> pd.DataFrame:
+        "Calls and seconds spent validating, for each check"
+        return pd.DataFrame(
+            self.timings.values(),
+            index=pd.Index(self.timings.keys(), name="check"),
+            columns=["calls", "seconds"],
+        ).sort_values("seconds", ascending=False)
+
+
+# Shared by every schema check of the package
+policy = ValidationPolicy()
+
+
+def validate(
+    schema: DataFrameSchema,
+    df: pd.DataFrame,
+    name: str = None,
+    owner=None,
+) -> pd.DataFrame:
+    "Check a dataframe against a schema, following the policy"
+    return policy.validate(
+        schema, df, name or schema.name or "schema", owner
+    )
+
+
+def _owner(fn, args: tuple):
+    "Object whose method `fn` is, if it is called as one"
+    if (
+        args
+        and "." in fn.__qualname__
+        and getattr(type(args[0]), fn.__name__, None)
+        is not None
+    ):
+        return args[0]
+    return None
+
+
+def check_input(schema: DataFrameSchema, obj_getter=0):
+    """
+    Same as pandera's check_input, for the argument at
+    position `obj_getter` of the signature, or of that name,
+    however it is passed, following the validation policy.
+    """
+
+    def decorator(fn):
+        signature = inspect.signature(fn)
+        name = obj_getter
+        if isinstance(obj_getter, int):
+            name = list(signature.parameters)[obj_getter]
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            call = signature.bind(*args, **kwargs)
+            call.apply_defaults()
+            validate(
+                schema,
+                call.arguments[name],
+                f"{fn.__qualname__} input",
+                _owner(fn, args),
+            )
+            return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def check_output(schema: DataFrameSchema):
+    """
+    Same as pandera's check_output, following the validation
+    policy.
+    """
+
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            out = fn(*args, **kwargs)
+            validate(
+                schema,
+                out,
+                f"{fn.__qualname__} output",
+                _owner(fn, args),
+            )
+            return out
+
+        return wrapper
+
+    return decorator